@@ -1,5 +1,7 @@
 """ Objects for grammars and grammar rules. """
 import re
+import json
+import zlib
 import logging
 import numpy as np
 from .tree import escape, unescape
@@ -15,6 +17,31 @@ BITPAR_NONINT = re.compile('(?:^|\n)[0-9]+\.[0-9]+[ \t]')
 LEXICON_NONINT = re.compile('[ \t][0-9]+[./][0-9]+[ \t\n]')
 # Detect rule format of bitpar
 BITPARRE = re.compile(r'^[-.e0-9]+\b')
+# Binary grammar files produced by Grammar.tofile() start with this number,
+# followed by the rest of a header of GRAMMARHEADER 64-bit integers; the last
+# of these is the size of the file.
+DEF GRAMMARMAGIC = 0x3352474f444f4344  # 'DCODOGR3'
+DEF GRAMMARHEADER = 22
+# Marks an empty slot in the hash table of words.
+DEF NOWORD = 0xffffffff
+
+def labelchecksum(list labels):
+    """Return a checksum identifying a sequence of labels."""
+    return zlib.crc32('\n'.join(labels).encode('utf8')) & 0xffffffff
+
+
+def mappingoptions(striplabelre=None, neverblockre=None, splitprune=False,
+                   markorigin=False, mapping=None):
+    """Return a string identifying the options of a mapping.
+
+    The arguments are those of :py:meth:`Grammar.getmapping`; the result is
+    stored with a saved mapping."""
+    return json.dumps([
+        None if striplabelre is None else striplabelre.pattern,
+        None if neverblockre is None else neverblockre.pattern,
+        bool(splitprune), bool(markorigin),
+        None if mapping is None else sorted(mapping.items())])
+
 
 # comparison functions for sorting rules on LHS/RHS labels.
 cdef int cmp0(const void * p1, const void * p2) nogil:
@@ -121,8 +148,9 @@ cdef class Grammar:
         weights = self.models[0]
         for n in range(self.numrules):
             weights[self.bylhs[0][n].no] = self.bylhs[0][n].prob
-        for n, lexrule in enumerate(self.lexical, self.numrules):
+        for n, lexrule in enumerate(self._lexical, self.numrules):
             weights[n] = lexrule.prob
+        self._indexlexicon()
         self.switch(u'default', True)  # enable log probabilities
 
     @cython.wraparound(True)
@@ -185,19 +213,19 @@ cdef class Grammar:
         """ Make objects for lexical rules. """
         cdef int x
         cdef double w
-        self.lexical = []
-        self.lexicalbyword = {}
-        self.lexicalbylhs = {}
+        self._lexical = []
+        self._lexicalbyword = {}
+        self._lexicalbylhs = {}
         for line in self.origlexicon.splitlines():
             if not line.strip():
                 continue
             x = line.index('\t')
             word = escape(line[:x])
             fields = line[x + 1:].split()
-            if word in self.lexicalbyword:
+            if word in self._lexicalbyword:
                 raise ValueError('word %r appears more than once '
                                  'in lexicon file' % unescape(word))
-            self.lexicalbyword[word] = []
+            self._lexicalbyword[word] = []
             for tag, weight in zip(fields[::2], fields[1::2]):
                 if tag not in self.toid:
                     self.toid[tag] = len(self.toid)
@@ -215,13 +243,17 @@ cdef class Grammar:
                     raise ValueError('weights should be positive '
                                      'and non-zero:\n%r' % line)
                 lexrule = LexicalRule(self.toid[tag], word, w)
-                if lexrule.lhs not in self.lexicalbylhs:
-                    self.lexicalbylhs[lexrule.lhs] = {}
-                self.lexical.append(lexrule)
-                self.lexicalbyword[word].append(lexrule)
-                self.lexicalbylhs[lexrule.lhs][word] = lexrule
-            if not (self.lexical and self.lexicalbyword and self.lexicalbylhs):
+                if lexrule.lhs not in self._lexicalbylhs:
+                    self._lexicalbylhs[lexrule.lhs] = {}
+                self._lexical.append(lexrule)
+                self._lexicalbyword[word].append(lexrule)
+                self._lexicalbylhs[lexrule.lhs][word] = lexrule
+            if not (self._lexical and self._lexicalbyword
+                    and self._lexicalbylhs):
                 raise ValueError('no lexical rules found.')
+        self.numlexical = len(self._lexical)
+        self.numwords = len(self._lexicalbyword)
+        self.lexicallhs = sorted(self._lexicalbylhs)
 
     def _allocate(self):
         """Allocate memory to store rules."""
@@ -249,7 +281,7 @@ cdef class Grammar:
         if self.fanout is NULL:
             raise MemoryError('allocation error')
         self.models = np.empty(
-            (1, self.numrules + len(self.lexical)), dtype='d')
+            (1, self.numrules + self.numlexical), dtype='d')
         self.mask = <uint64_t * >malloc(
             BITNSLOTS(self.numrules) * sizeof(uint64_t))
         if self.mask is NULL:
@@ -259,6 +291,173 @@ cdef class Grammar:
         if self.revmap is NULL:
             raise MemoryError('allocation error')
 
+    def _indexlexicon(self):
+        """Store lexical rules in arrays, grouped by word.
+
+        Also builds a hash table to look up words; this avoids Python objects
+        when parsing."""
+        cdef LexicalRule lexrule
+        cdef uint32_t n, m = 0
+        cdef bytes words
+        cdef list encoded = []
+        self.lexlhs = <uint32_t * >malloc(self.numlexical * sizeof(uint32_t))
+        self.lexprobs = <double * >malloc(self.numlexical * sizeof(double))
+        self.lexwordidx = <uint32_t * >malloc(
+                (self.numwords + 1) * sizeof(uint32_t))
+        self.wordoffsets = <uint32_t * >malloc(
+                (self.numwords + 1) * sizeof(uint32_t))
+        if (self.lexlhs is NULL or self.lexprobs is NULL
+                or self.lexwordidx is NULL or self.wordoffsets is NULL):
+            raise MemoryError('allocation error')
+        # lexical rules are clustered by word (see _convertlexicon)
+        prev = None
+        self.wordoffsets[0] = 0
+        for n, lexrule in enumerate(self._lexical):
+            self.lexlhs[n] = lexrule.lhs
+            self.lexprobs[n] = lexrule.prob
+            if lexrule.word != prev:
+                prev = lexrule.word
+                encoded.append(lexrule.word.encode('utf8'))
+                self.lexwordidx[m] = n
+                self.wordoffsets[m + 1] = (self.wordoffsets[m]
+                                           + len(encoded[m]))
+                m += 1
+        self.lexwordidx[m] = self.numlexical
+        words = b''.join(encoded)
+        self.wordbuf = <char * >malloc(max(len(words), 1))
+        if self.wordbuf is NULL:
+            raise MemoryError('allocation error')
+        memcpy(self.wordbuf, <char * >words, len(words))
+        self.numbuckets = self.numwords // 4 + 1
+        self.numslots = self.numwords + self.numwords // 4 + 1
+        self.worddisp = <uint32_t * >malloc(self.numbuckets * sizeof(uint32_t))
+        self.wordslots = <uint32_t * >malloc(self.numslots * sizeof(uint32_t))
+        if self.worddisp is NULL or self.wordslots is NULL:
+            raise MemoryError('allocation error')
+        self._buildwordhash()
+
+    def _buildwordhash(self):
+        """Construct a perfect hash function for the words in the lexicon.
+
+        Uses the hash and displace method: each word is assigned to a bucket
+        with one hash function; for each bucket, starting with the largest, a
+        displacement is searched such that the words of the bucket land in
+        empty slots of the table. A lookup therefore takes two hashes and a
+        single string comparison.
+        """
+        cdef uint32_t n, m, b, d
+        cdef list buckets = [[] for _ in range(self.numbuckets)]
+        cdef list slots = []
+        for n in range(self.numslots):
+            self.wordslots[n] = NOWORD
+        for n in range(self.numbuckets):
+            self.worddisp[n] = 0
+        for n in range(self.numwords):
+            buckets[wordhash(&(self.wordbuf[self.wordoffsets[n]]),
+                             self.wordoffsets[n + 1] - self.wordoffsets[n],
+                             0) % self.numbuckets].append(n)
+        for b in sorted(range(self.numbuckets),
+                        key=lambda b: len(buckets[b]), reverse=True):
+            if not buckets[b]:
+                break
+            d = 0
+            while True:
+                d += 1
+                slots = [wordhash(&(self.wordbuf[self.wordoffsets[n]]),
+                                  self.wordoffsets[n + 1]
+                                  - self.wordoffsets[n], d) % self.numslots
+                         for n in buckets[b]]
+                if (len(set(slots)) == len(slots) and all(
+                        self.wordslots[n] == NOWORD for n in slots)):
+                    break
+            self.worddisp[b] = d
+            for n, m in zip(buckets[b], slots):
+                self.wordslots[m] = n
+
+    cdef int wordid(self, str word) except -2:
+        """Return the index of ``word`` in the lexicon, or -1 if unknown.
+
+        The lexical rules for this word are
+        ``lexlhs[lexwordidx[n]:lexwordidx[n + 1]]``."""
+        cdef bytes tmp = word.encode('utf8')
+        cdef const char * ptr = tmp
+        cdef size_t length = len(tmp)
+        cdef uint32_t n
+        n = self.wordslots[wordhash(ptr, length, self.worddisp[
+                wordhash(ptr, length, 0) % self.numbuckets]) % self.numslots]
+        if (n == NOWORD
+                or self.wordoffsets[n + 1] - self.wordoffsets[n] != length
+                or memcmp(ptr, &(self.wordbuf[self.wordoffsets[n]]),
+                          length) != 0):
+            return -1
+        return n
+
+    cdef int lexruleno(self, uint32_t lhs, str word) except -1:
+        """Return the number of the lexical rule ``lhs => word``.
+
+        This is its index in the probability models; raises KeyError if there
+        is no such rule."""
+        cdef int n = self.wordid(word)
+        cdef uint32_t m
+        if n != -1:
+            for m in range(self.lexwordidx[n], self.lexwordidx[n + 1]):
+                if self.lexlhs[m] == lhs:
+                    return self.numrules + m
+        raise KeyError((self.tolabel[lhs], word))
+
+    cdef double lexprob(self, uint32_t lhs, str word) except? -1:
+        """Return the probability of the lexical rule ``lhs => word``.
+
+        Raises KeyError if there is no such rule."""
+        return self.lexprobs[self.lexruleno(lhs, word) - self.numrules]
+
+    def _buildlexicon(self):
+        """Create objects for the lexical rules of a mapped grammar.
+
+        The objects are created from the arrays of a grammar loaded with
+        ``fromfile()``."""
+        cdef LexicalRule lexrule
+        cdef uint32_t n, m
+        self._lexical = []
+        self._lexicalbyword = {}
+        self._lexicalbylhs = {}
+        for n in range(self.numwords):
+            word = self.wordbuf[self.wordoffsets[n]:self.wordoffsets[n + 1]
+                                ].decode('utf8')
+            self._lexicalbyword[word] = []
+            for m in range(self.lexwordidx[n], self.lexwordidx[n + 1]):
+                lexrule = LexicalRule(self.lexlhs[m], word, self.lexprobs[m])
+                if lexrule.lhs not in self._lexicalbylhs:
+                    self._lexicalbylhs[lexrule.lhs] = {}
+                self._lexical.append(lexrule)
+                self._lexicalbyword[word].append(lexrule)
+                self._lexicalbylhs[lexrule.lhs][word] = lexrule
+
+    @property
+    def lexical(self):
+        """A list of all lexical rules, as ``LexicalRule`` objects.
+
+        For a grammar loaded with ``fromfile()``, the objects for
+        lexical rules are only created when this or one of the following
+        attributes is accessed; the parsers do not need them."""
+        if self._lexical is None:
+            self._buildlexicon()
+        return self._lexical
+
+    @property
+    def lexicalbyword(self):
+        """A dictionary with lists of lexical rules indexed by word."""
+        if self._lexical is None:
+            self._buildlexicon()
+        return self._lexicalbyword
+
+    @property
+    def lexicalbylhs(self):
+        """Lexical rules in a dict of dicts indexed by POS tag and word."""
+        if self._lexical is None:
+            self._buildlexicon()
+        return self._lexicalbylhs
+
     @cython.wraparound(True)
     cdef _convertrules(Grammar self, list rulelines, dict fanoutdict):
         """Auxiliary function to create Grammar objects. Copies grammar
@@ -333,13 +532,13 @@ cdef class Grammar:
             while self.bylhs[lhs][n].lhs == lhs:
                 mass += self.bylhs[lhs][n].prob
                 n += 1
-            for lexrule in self.lexicalbylhs.get(lhs, {}).values():
+            for lexrule in self._lexicalbylhs.get(lhs, {}).values():
                 mass += lexrule.prob
             n = 0
             while self.bylhs[lhs][n].lhs == lhs:
                 self.bylhs[lhs][n].prob /= mass
                 n += 1
-            for lexrule in self.lexicalbylhs.get(lhs, {}).values():
+            for lexrule in self._lexicalbylhs.get(lhs, {}).values():
                 lexrule.prob /= mass
 
     cdef _indexrules(Grammar self, ProbRule ** dest, int idx, int filterlen):
@@ -404,14 +603,16 @@ cdef class Grammar:
             '256 probabilistic models should be enough for anyone.')
         if name in self.modelnames:
             raise ValueError('model %r already exists' % name)
-        if len(weights) != self.numrules + len(self.lexical):
+        if len(weights) != self.numrules + self.numlexical:
             raise ValueError('length mismatch: %d grammar rules, '
                              '%d weights given.' % (
-                                 self.numrules + len(self.lexical), len(weights)))
-        self.models.resize(m + 1, self.numrules + len(self.lexical))
+                                 self.numrules + self.numlexical, len(weights)))
+        if not self.models.flags.owndata:  # weights backed by grammar file
+            self.models = np.array(self.models)
+        self.models.resize(m + 1, self.numrules + self.numlexical)
         self.modelnames.append(name)
         tmp = self.models[m]
-        for n in range(self.numrules + len(self.lexical)):
+        for n in range(self.numrules + self.numlexical):
             tmp[n] = weights[n]
 
     def switch(self, str name, bint logprob=True):
@@ -430,8 +631,11 @@ cdef class Grammar:
             self.rbinary[0][n].prob = tmp[self.rbinary[0][n].no]
         for n in range(self.numunary):
             self.unary[0][n].prob = tmp[self.unary[0][n].no]
-        for n, lexrule in enumerate(self.lexical, self.numrules):
-            lexrule.prob = tmp[n]
+        for n in range(self.numlexical):
+            self.lexprobs[n] = tmp[self.numrules + n]
+        if self._lexical is not None:
+            for n, lexrule in enumerate(self._lexical, self.numrules):
+                lexrule.prob = tmp[n]
         self.logprob = logprob
         self.currentmodel = m
 
@@ -468,7 +672,6 @@ cdef class Grammar:
         """Test whether all left-hand sides sum to 1 +/-epsilon for the
         currently selected weights."""
         cdef ProbRule * rule
-        cdef LexicalRule lexrule
         cdef uint32_t n, maxlabel = 0
         cdef list weights = [[] for _ in self.toid]
         cdef double[:] tmp = self.models[self.currentmodel, :]
@@ -477,8 +680,8 @@ cdef class Grammar:
         for n in range(self.numrules):
             rule = &(self.bylhs[0][n])
             weights[rule.lhs].append(tmp[rule.no])
-        for n, lexrule in enumerate(self.lexical, self.numrules):
-            weights[lexrule.lhs].append(tmp[n])
+        for n in range(self.numlexical):
+            weights[self.lexlhs[n]].append(tmp[self.numrules + n])
         maxdiff = epsilon
         for lhs, lhsweights in enumerate(weights[1:], 1):
             mass = fsum(lhsweights)
@@ -525,6 +728,8 @@ cdef class Grammar:
         cdef set seen = {0}
         if coarse is None:
             coarse = self
+        self._mappingoptions = mappingoptions(
+            striplabelre, neverblockre, splitprune, markorigin, mapping)
         if self.mapping is not NULL:
             free(self.mapping)
         self.mapping = <uint32_t * >malloc(sizeof(uint32_t) * self.nonterminals)
@@ -579,6 +784,109 @@ cdef class Grammar:
                        'coarse labels without mapping: { %s }' % diff)
         return msg
 
+    def savemapping(Grammar self, filename, Grammar coarse=None):
+        """Store the mapping established by :py:meth:`getmapping`.
+
+        The mapping is written to an ``.npz`` file, so that it can be restored
+        with :py:meth:`loadmapping` instead of being recomputed.
+
+        :param coarse: the grammar that was passed to ``getmapping()``; a
+                checksum of its labels is stored to detect outdated mappings,
+                together with the other options passed to ``getmapping()``.
+        """
+        cdef uint32_t[::1] buf
+        cdef int64_t[::1] offsets
+        cdef size_t n, components = 0
+        if self.mapping is NULL:
+            raise ValueError('need to call getmapping() first.')
+        if coarse is None:
+            coarse = self
+        mapping = np.empty(self.nonterminals, dtype=np.uint32)
+        buf = mapping
+        memcpy(&(buf[0]), self.mapping, self.nonterminals * sizeof(uint32_t))
+        # offset of the components of each label in the array splitmapping;
+        # -1 for labels that are not split. Empty if there is no splitmapping.
+        splitoffsets = np.empty(0 if self.splitmapping is NULL
+                                else self.nonterminals, dtype=np.int64)
+        splitoffsets.fill(-1)
+        offsets = splitoffsets
+        if self.splitmapping is not NULL:
+            for n in range(1, self.nonterminals):
+                if self.splitmapping[n] is not NULL:
+                    offsets[n] = self.splitmapping[n] - self.splitmapping[0]
+                    components = max(components, offsets[n] + self.fanout[n])
+        splitmapping = np.empty(components, dtype=np.uint32)
+        if components:
+            buf = splitmapping
+            memcpy(&(buf[0]), self.splitmapping[0],
+                   components * sizeof(uint32_t))
+        np.savez(filename, mapping=mapping, splitoffsets=splitoffsets,
+                 splitmapping=splitmapping,
+                 options=np.array(self._mappingoptions),
+                 checksums=np.array([labelchecksum(self.tolabel),
+                                     labelchecksum(coarse.tolabel)],
+                                    dtype=np.uint32))
+
+    def loadmapping(Grammar self, filename, Grammar coarse=None,
+                    striplabelre=None, neverblockre=None,
+                    bint splitprune=False, bint markorigin=False,
+                    dict mapping=None):
+        """Restore a mapping stored with :py:meth:`savemapping`.
+
+        Replaces a call to :py:meth:`getmapping` with the same arguments.
+
+        :raises ValueError: if the labels of this grammar or ``coarse``, or
+                the other arguments, are not the same as when the mapping was
+                stored."""
+        cdef uint32_t[::1] buf
+        cdef int64_t[::1] offsets
+        cdef size_t n
+        cdef str options = mappingoptions(
+            striplabelre, neverblockre, splitprune, markorigin, mapping)
+        if coarse is None:
+            coarse = self
+        data = np.load(filename)
+        if list(data['checksums']) != [labelchecksum(self.tolabel),
+                                       labelchecksum(coarse.tolabel)]:
+            raise ValueError('mapping in %r does not match labels of '
+                             'grammars' % filename)
+        if 'options' not in data.files or str(data['options']) != options:
+            raise ValueError('mapping in %r was made with different '
+                             'options' % filename)
+        self._mappingoptions = options
+        buf = np.ascontiguousarray(data['mapping'], dtype=np.uint32)
+        if self.mapping is not NULL:
+            free(self.mapping)
+        self.mapping = <uint32_t * >malloc(sizeof(uint32_t) * self.nonterminals)
+        if self.mapping is NULL:
+            raise MemoryError('allocation error')
+        memcpy(self.mapping, &(buf[0]), self.nonterminals * sizeof(uint32_t))
+        if self.splitmapping is not NULL:
+            if self.splitmapping[0] is not NULL:
+                free(self.splitmapping[0])
+            free(self.splitmapping)
+            self.splitmapping = NULL
+        offsets = np.ascontiguousarray(data['splitoffsets'], dtype=np.int64)
+        if offsets.shape[0] == 0:
+            return
+        splitmapping = np.ascontiguousarray(data['splitmapping'],
+                                            dtype=np.uint32)
+        self.splitmapping = <uint32_t ** >malloc(sizeof(uint32_t * )
+                                                 * self.nonterminals)
+        if self.splitmapping is NULL:
+            raise MemoryError('allocation error')
+        self.splitmapping[0] = <uint32_t * >malloc(sizeof(uint32_t)
+                                                   * max(len(splitmapping), 1))
+        if self.splitmapping[0] is NULL:
+            raise MemoryError('allocation error')
+        if len(splitmapping):
+            buf = splitmapping
+            memcpy(self.splitmapping[0], &(buf[0]),
+                   len(splitmapping) * sizeof(uint32_t))
+        for n in range(1, self.nonterminals):
+            self.splitmapping[n] = (NULL if offsets[n] == -1
+                                    else &(self.splitmapping[0][offsets[n]]))
+
     def getrulemapping(Grammar self, Grammar coarse, striplabelre):
         """Produce a mapping of coarse rules to sets of fine rules.
 
@@ -652,17 +960,235 @@ cdef class Grammar:
 
     def __reduce__(self):
         """Helper function for pickling."""
+        if self._state is not None:  # re-use the mapped grammar file
+            return (Grammar.fromfile, (self._state[1], ),
+                    (self.modelnames[self.currentmodel], self.logprob))
         return (Grammar, (self.origrules, self.origlexicon,
                           self.start, self.binarized))
 
+    def __setstate__(self, state):
+        """Restore selected model after unpickling a mapped grammar."""
+        name, logprob = state
+        if name in self.modelnames:
+            self.switch(name, logprob)
+
+    def tofile(self, filename):
+        """Write grammar to a binary file.
+
+        The file can be loaded with :py:meth:`Grammar.fromfile`, and contains
+        the phrasal rules as they are stored in memory, i.e., sorted and
+        indexed, together with the labels, the lexicon and its hash table, and
+        all registered probabilistic models; the currently selected model is
+        stored as well. Mappings for coarse-to-fine pruning are stored
+        separately, cf. :py:meth:`Grammar.savemapping`."""
+        cdef uint64_t header[GRAMMARHEADER]
+        cdef uint32_t n
+        cdef size_t numrulesall = (self.numrules + 2 * self.numbinary
+                                   + self.numunary + 4)
+        cdef uint64_t[:] idx = np.empty(4 * self.nonterminals, dtype=np.uint64)
+        rulenos = [''] * self.numrules
+        for key, n in self.rulenos.items():
+            rulenos[n] = key
+        text = ['\n'.join(self.tolabel).encode('utf8'),
+                '\n'.join(self.modelnames).encode('utf8'),
+                '\n'.join(rulenos).encode('utf8'),
+                self.origrules.encode('utf8'),
+                self.origlexicon.encode('utf8')]
+        for n in range(4 * self.nonterminals):
+            idx[n] = self.bylhs[n] - self.bylhs[0]
+        header[0] = GRAMMARMAGIC
+        header[1] = self.nonterminals
+        header[2] = self.phrasalnonterminals
+        header[3] = self.numrules
+        header[4] = self.numunary
+        header[5] = self.numbinary
+        header[6] = self.maxfanout
+        header[7] = self.numlexical
+        header[8] = len(self.modelnames)
+        header[9] = self.currentmodel
+        header[10] = self.logprob | self.bitpar << 1 | self.binarized << 2
+        header[11] = self.toid[self.start]
+        header[12] = self.numwords
+        header[13] = self.numbuckets
+        header[14] = self.numslots
+        header[15] = self.wordoffsets[self.numwords]
+        for n, part in enumerate(text):
+            header[16 + n] = len(part)
+        header[21] = 0
+        # write to a temporary file, so that an interrupted write does not
+        # leave a truncated grammar behind.
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as out:
+            # every section starts at a multiple of 8 bytes
+            for data in (
+                    (< char * >header)[:sizeof(header)],
+                    (< char * >self.bylhs[0])[:numrulesall * sizeof(ProbRule)],
+                    np.asarray(idx).tobytes(),
+                    (< char * >self.revmap)[:self.numrules * sizeof(uint32_t)],
+                    (< char * >self.fanout)[:self.nonterminals],
+                    (< char * >self.lexlhs)[
+                        :self.numlexical * sizeof(uint32_t)],
+                    (< char * >self.lexprobs)[
+                        :self.numlexical * sizeof(double)],
+                    (< char * >self.lexwordidx)[
+                        :(self.numwords + 1) * sizeof(uint32_t)],
+                    (< char * >self.wordoffsets)[
+                        :(self.numwords + 1) * sizeof(uint32_t)],
+                    (< char * >self.worddisp)[
+                        :self.numbuckets * sizeof(uint32_t)],
+                    (< char * >self.wordslots)[
+                        :self.numslots * sizeof(uint32_t)],
+                    self.wordbuf[:self.wordoffsets[self.numwords]],
+                    np.ascontiguousarray(self.models).tobytes()):
+                out.write(data)
+                out.write(b'\0' * ((8 - len(data) % 8) % 8))
+            for part in text:
+                out.write(part)
+            header[21] = out.tell()
+            out.seek(0)
+            out.write((< char * >header)[:sizeof(header)])
+        os.rename(tmp, filename)
+
+    @classmethod
+    def fromfile(cls, filename):
+        """Load a grammar written by :py:meth:`Grammar.tofile`.
+
+        The file is mapped into memory instead of being read; rules, the
+        lexicon and weights are used directly from the mapped file, so no
+        parsing, sorting or indexing is necessary. Pages are shared between
+        processes until they are modified, e.g., by switching to a different
+        model; this means that parallel workers use the memory of a single
+        copy of the grammar."""
+        cdef Grammar ob = Grammar.__new__(Grammar)
+        cdef Py_buffer buffer
+        cdef Py_ssize_t size = 0
+        cdef char * ptr = NULL
+        cdef uint64_t * header = NULL
+        cdef uint64_t * idx = NULL
+        cdef ProbRule * rules = NULL
+        cdef size_t offset = GRAMMARHEADER * sizeof(uint64_t)
+        cdef size_t n, numrulesall, nummodels
+        fileno = os.open(filename, os.O_RDONLY)
+        try:  # private, copy-on-write mapping; switch() modifies rules.
+            buf = mmap.mmap(fileno, 0, access=mmap.ACCESS_COPY)
+        finally:
+            os.close(fileno)
+        result = getbufptr(buf, & ptr, & size, & buffer)
+        if result != 0:
+            raise ValueError('could not get buffer from mmap.')
+        header = <uint64_t * >ptr
+        if <size_t > size < offset or header[0] != GRAMMARMAGIC:
+            releasebuf( & buffer)
+            raise ValueError('not a binary grammar file: %r' % filename)
+        ob._state = (buf, filename)
+        ob.nonterminals = header[1]
+        ob.phrasalnonterminals = header[2]
+        ob.numrules = header[3]
+        ob.numunary = header[4]
+        ob.numbinary = header[5]
+        ob.maxfanout = header[6]
+        ob.numlexical = header[7]
+        nummodels = header[8]
+        ob.currentmodel = header[9]
+        ob.logprob = header[10] & 1
+        ob.bitpar = header[10] & 2
+        ob.binarized = header[10] & 4
+        ob.numwords = header[12]
+        ob.numbuckets = header[13]
+        ob.numslots = header[14]
+        numrulesall = ob.numrules + 2 * ob.numbinary + ob.numunary + 4
+        # start of each section; check that all of them fit in the file
+        # before creating any pointers.
+        textlen = [header[n] for n in range(16, 21)]
+        offsets = []
+        pos = offset
+        for nbytes in (
+                numrulesall * sizeof(ProbRule),
+                4 * ob.nonterminals * sizeof(uint64_t),
+                ob.numrules * sizeof(uint32_t),
+                ob.nonterminals,
+                ob.numlexical * sizeof(uint32_t),
+                ob.numlexical * sizeof(double),
+                (ob.numwords + 1) * sizeof(uint32_t),
+                (ob.numwords + 1) * sizeof(uint32_t),
+                ob.numbuckets * sizeof(uint32_t),
+                ob.numslots * sizeof(uint32_t),
+                header[15],
+                nummodels * (ob.numrules + ob.numlexical) * sizeof(double),
+                ) + tuple(textlen):
+            offsets.append(pos)
+            if pos + nbytes > size:
+                break
+            pos += nbytes
+            if len(offsets) <= 12:
+                pos += (8 - pos % 8) % 8
+        if (len(offsets) != 17 or pos != size or header[21] != <size_t>size
+                or header[11] >= ob.nonterminals):
+            releasebuf( & buffer)
+            raise ValueError('truncated or corrupt binary grammar file: %r'
+                             % filename)
+        rules = <ProbRule * > & ptr[offsets[0]]
+        idx = <uint64_t * > & ptr[offsets[1]]
+        ob.revmap = <uint32_t * > & ptr[offsets[2]]
+        ob.fanout = <uint8_t * > & ptr[offsets[3]]
+        ob.lexlhs = <uint32_t * > & ptr[offsets[4]]
+        ob.lexprobs = <double * > & ptr[offsets[5]]
+        ob.lexwordidx = <uint32_t * > & ptr[offsets[6]]
+        ob.wordoffsets = <uint32_t * > & ptr[offsets[7]]
+        ob.worddisp = <uint32_t * > & ptr[offsets[8]]
+        ob.wordslots = <uint32_t * > & ptr[offsets[9]]
+        ob.wordbuf = & ptr[offsets[10]]
+        releasebuf( & buffer)
+        ob.models = np.frombuffer(buf, dtype='d',
+                                  count=nummodels * (ob.numrules + ob.numlexical),
+                                  offset=offsets[11]).reshape(
+            nummodels, ob.numrules + ob.numlexical)
+        text = [buf[a:a + b].decode('utf8')
+                for a, b in zip(offsets[12:], textlen)]
+        ob.tolabel = text[0].split('\n')
+        ob.toid = {label: n for n, label in enumerate(ob.tolabel)}
+        ob.start = ob.tolabel[header[11]]
+        ob.modelnames = text[1].split('\n')
+        ob.rulenos = {key: n for n, key in enumerate(text[2].split('\n'))
+                      if key}
+        ob.origrules, ob.origlexicon = text[3], text[4]
+        ob.lexicallhs = sorted({ob.lexlhs[n] for n in range(ob.numlexical)})
+        # index of phrasal rules
+        ob.bylhs = <ProbRule ** >malloc(sizeof(ProbRule * )
+                                        * ob.nonterminals * 4)
+        if ob.bylhs is NULL:
+            raise MemoryError('allocation error')
+        for n in range(4 * ob.nonterminals):
+            ob.bylhs[n] = &(rules[idx[n]])
+        ob.unary = &(ob.bylhs[1 * ob.nonterminals])
+        ob.lbinary = &(ob.bylhs[2 * ob.nonterminals])
+        ob.rbinary = &(ob.bylhs[3 * ob.nonterminals])
+        ob.mask = <uint64_t * >malloc(
+            BITNSLOTS(ob.numrules) * sizeof(uint64_t))
+        if ob.mask is NULL:
+            raise MemoryError('allocation error')
+        ob.setmask(None)
+        # objects for lexical rules are created on demand; see _buildlexicon()
+        return ob
+
     def __dealloc__(self):
         if self.bylhs is NULL:
             return
-        free(self.bylhs[0])
+        if self._state is None:
+            # otherwise, these arrays are part of the mapped grammar file,
+            # which is unmapped when the mmap object is garbage collected.
+            free(self.bylhs[0])
+            free(self.fanout)
+            free(self.revmap)
+            free(self.lexlhs)
+            free(self.lexprobs)
+            free(self.lexwordidx)
+            free(self.wordoffsets)
+            free(self.worddisp)
+            free(self.wordslots)
+            free(self.wordbuf)
         free(self.bylhs)
-        free(self.fanout)
         free(self.mask)
-        free(self.revmap)
         if self.chainvec is not NULL:
             free(self.chainvec)
         if self.mapping is not NULL:
@@ -672,6 +1198,10 @@ cdef class Grammar:
             free(self.splitmapping)
         self.bylhs = self.fanout = self.mask = self.revmap = NULL
         self.chainvec = self.mapping = self.splitmapping = NULL
+        self.lexlhs = self.lexwordidx = self.wordoffsets = NULL
+        self.worddisp = self.wordslots = NULL
+        self.lexprobs = NULL
+        self.wordbuf = NULL
 
 
 cdef inline double convertweight(const char * weight):
@@ -684,3 +1214,19 @@ cdef inline double convertweight(const char * weight):
     elif endptr[0]:
         return 0
     return w
+
+
+cdef inline uint64_t wordhash(const char * word, size_t length,
+                              uint64_t seed) nogil:
+    """Seeded FNV-1a hash of a string, with a finalizer to mix the bits.
+
+    Different seeds give independent hash functions."""
+    cdef uint64_t h = 0xcbf29ce484222325ULL ^ (seed * 0x9e3779b97f4a7c15ULL)
+    cdef size_t n
+    for n in range(length):
+        h ^= <uint8_t>word[n]
+        h *= 0x100000001b3ULL
+    h ^= h >> 33
+    h *= 0xff51afd7ed558ccdULL
+    h ^= h >> 33
+    return h
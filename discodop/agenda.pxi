@@ -353,6 +353,162 @@ cdef class DoubleAgenda(Agenda):
         return entry.key, entry.value
 
 
+@cython.final
+cdef class IndexedAgenda:
+    """Priority Queue for integer keys with C doubles as priorities.
+
+    The heap is an array of structs, and decrease-key is implemented with a
+    table that maps each key to its position in the heap; keys should
+    therefore be small non-negative integers, such as the ids of the items
+    in a ``PackedLCFRSChart``. Entries are ordered in the same way as in a
+    ``DoubleAgenda``, i.e., equivalent values in insertion order."""
+
+    def __cinit__(self):
+        self.heapcap = self.poscap = 64
+        self.heap = <IndexedEntry *>malloc(self.heapcap * sizeof(IndexedEntry))
+        self.pos = <uint32_t *>calloc(self.poscap, sizeof(uint32_t))
+        if self.heap is NULL or self.pos is NULL:
+            raise MemoryError('allocation error')
+        self.counter = 1
+        self.length = 0
+
+    def __dealloc__(self):
+        free(self.heap)
+        free(self.pos)
+
+    cdef bint contains(self, uint32_t key):
+        """Like ``key in agenda``, but bypass Python API."""
+        return key < self.poscap and self.pos[key] != 0
+
+    cdef double getitem(self, uint32_t key):
+        """Like agenda[key], but bypass Python API; key must be present."""
+        return self.heap[self.pos[key] - 1].value
+
+    cdef int setitem(self, uint32_t key, double value) except -1:
+        """Like agenda[key] = value, but bypass Python API."""
+        cdef size_t n, oldcap
+        cdef double oldvalue
+        if key >= self.poscap:
+            oldcap = self.poscap
+            while key >= self.poscap:
+                self.poscap *= 2
+            self.pos = <uint32_t *>realloc(
+                    self.pos, self.poscap * sizeof(uint32_t))
+            if self.pos is NULL:
+                raise MemoryError('allocation error')
+            memset(&(self.pos[oldcap]), 0,
+                   (self.poscap - oldcap) * sizeof(uint32_t))
+        if self.pos[key]:  # change priority, keep insertion order
+            n = self.pos[key] - 1
+            oldvalue = self.heap[n].value
+            self.heap[n].value = value
+            if value < oldvalue:
+                self.siftdown(n)
+            else:
+                self.siftup(n)
+            return 0
+        if self.length == self.heapcap:
+            self.heapcap *= 2
+            self.heap = <IndexedEntry *>realloc(
+                    self.heap, self.heapcap * sizeof(IndexedEntry))
+            if self.heap is NULL:
+                raise MemoryError('allocation error')
+        n = self.length
+        self.heap[n].key = key
+        self.heap[n].value = value
+        self.heap[n].count = self.counter
+        self.pos[key] = n + 1
+        self.length += 1
+        self.counter += 1
+        self.siftdown(n)
+        return 0
+
+    cdef IndexedEntry popentry(self):
+        """Remove and return the entry with the lowest value.
+
+        The agenda should not be empty."""
+        cdef IndexedEntry entry = self.heap[0]
+        self.pos[entry.key] = 0
+        self.length -= 1
+        if self.length:
+            self.heap[0] = self.heap[self.length]
+            self.pos[self.heap[0].key] = 1
+            self.siftup(0)
+        return entry
+
+    cdef void siftdown(self, size_t pos):
+        """Move entry at ``pos`` towards the root to restore heap invariant.
+
+        NB: the naming of siftdown / siftup follows the Python heapq module.
+        """
+        cdef IndexedEntry entry = self.heap[pos]
+        cdef size_t parentpos
+        while pos > 0:
+            parentpos = (pos - 1) // HEAP_ARITY
+            if cmpindexed(&(self.heap[parentpos]), &entry):
+                break
+            self.heap[pos] = self.heap[parentpos]
+            self.pos[self.heap[pos].key] = pos + 1
+            pos = parentpos
+        self.heap[pos] = entry
+        self.pos[entry.key] = pos + 1
+
+    cdef void siftup(self, size_t pos):
+        """Move entry at ``pos`` towards the leaves to restore invariant."""
+        cdef IndexedEntry entry = self.heap[pos]
+        cdef size_t childpos, n, best
+        while True:
+            childpos = pos * HEAP_ARITY + 1
+            if childpos >= self.length:
+                break
+            best = childpos
+            for n in range(childpos + 1, min(childpos + HEAP_ARITY,
+                                             self.length)):
+                if cmpindexed(&(self.heap[n]), &(self.heap[best])):
+                    best = n
+            if not cmpindexed(&(self.heap[best]), &entry):
+                break
+            self.heap[pos] = self.heap[best]
+            self.pos[self.heap[pos].key] = pos + 1
+            pos = best
+        self.heap[pos] = entry
+        self.pos[entry.key] = pos + 1
+
+    def __contains__(self, key):
+        return key >= 0 and self.contains(key)
+
+    def __getitem__(self, key):
+        if key < 0 or not self.contains(key):
+            raise KeyError(key)
+        return self.getitem(key)
+
+    def __setitem__(self, key, value):
+        self.setitem(key, value)
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length != 0
+
+    def popitem(self):
+        cdef IndexedEntry entry
+        if self.length == 0:
+            raise KeyError('popitem(): agenda is empty')
+        entry = self.popentry()
+        return entry.key, entry.value
+
+    def __repr__(self):
+        return '%s({%s})' % (self.__class__.__name__, ', '.join(
+                '%d: %g' % (self.heap[n].key, self.heap[n].value)
+                for n in range(self.length)))
+
+
+cdef inline bint cmpindexed(IndexedEntry * a, IndexedEntry * b):
+    """Comparison function for IndexedEntry structs."""
+    return (a.value < b.value or (a.value == b.value and a.count < b.count))
+
+
 # A quicksort nsmallest implementation.
 cdef list nsmallest(int n, list entries):
     """Return an _unsorted_ list of the n smallest DoubleEntry objects.
@@ -477,10 +477,12 @@ or: discodop grammar merge (rules|lexicon|fragments) \
         xgrammar, backtransform, altweights, _ = dop1(trees, sents,
                                                       maxdepth=int(opts.get('--maxdepth', 3)),
                                                       maxfrontier=int(opts.get('--maxfrontier', 999)),
-                                                      binarized='--bitpar' not in opts)
+                                                      binarized='--bitpar' not in opts,
+                                                      numproc=int(opts.get('--numproc', 1)))
     elif model == 'ptsg':
         xgrammar, backtransform, altweights = compiletsg(xfragments,
-                                                         binarized='--bitpar' not in opts)
+                                                         binarized='--bitpar' not in opts,
+                                                         numproc=int(opts.get('--numproc', 1)))
     elif model == 'param':
         getgrammars(dobinarization(trees, sents, prm.binarization,
                                    prm.relationalrealizational),
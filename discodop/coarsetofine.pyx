@@ -1,17 +1,26 @@
 """Project selected items from a chart to corresponding items in next grammar.
 """
 from __future__ import print_function
-from libc.stdint cimport uint8_t, uint32_t, uint64_t
+from libc.stdint cimport uint8_t, uint32_t, uint64_t, UINT32_MAX
+from libc.stdlib cimport malloc, calloc, realloc, free
+from libc.math cimport exp, log, log1p
 from .tree import Tree
 from .treetransforms import mergediscnodes, unbinarize, fanout, addbitsets
 from .containers cimport Grammar, Chart, ChartItem, Edge, Edges, MoreEdges, \
-    LexicalRule, RankedEdge, cellidx, compactcellidx, \
-    CFGtoSmallChartItem, CFGtoFatChartItem
+    LexicalRule, RankedEdge, SpanSet, CFGWhitelist, cellidx, compactcellidx, \
+    cfgcellbits, CFGtoSmallChartItem, CFGtoFatChartItem, SETBIT
 from .kbest import lazykbest
 import numpy as np
 
 include "constants.pxi"
 
+cdef double INFINITY = float('infinity')
+
+
+cdef struct IOEdge:  # an edge of a parse forest, for inside-outside
+    double prob  # log probability of rule, or lexical probability
+    uint32_t left, right  # index of child items, or UINT32_MAX if absent
+
 # alternative: take coarse chart, return fine chart w/whitelist.
 # cpdef Chart prunechart(coarsechart, Grammar fine, int k,
 # 		bint splitprune, bint markorigin, bint finecfg, bint bitpar):
@@ -79,29 +88,17 @@ def prunechart(Chart coarsechart, Grammar fine, k,
                    len(coarsechart.rankededges[coarsechart.root()][:k]), k))
     # project items to fine grammar
     if finecfg:
-        cfgwhitelist = [set() for _ in range(compactcellidx(
-                        coarsechart.lensent - 1, coarsechart.lensent,
-                        coarsechart.lensent, 1) + 1)]
-        for item in items:
-            label = coarsechart.label(item)
-            finespan = coarsechart.asCFGspan(item, fine.nonterminals)
-            for finelabel in range(1, fine.nonterminals):
-                if (fine.mapping[finelabel] == 0
-                        or fine.mapping[finelabel] == label):
-                    cfgwhitelist[finespan].add(finelabel)
-        return cfgwhitelist, None, msg
+        return cfgwhitelist(coarsechart, fine, items), None, msg
     else:
         whitelist = [None] * fine.nonterminals
-        kbestspans = [set() for _ in coarsechart.grammar.toid]
+        kbestspans = [SpanSet() for _ in coarsechart.grammar.toid]
         kbestspans[0] = None
         # uses ids of labels in coarse chart
         for item in items:
             # we can use coarsechart here because we only use the item to
             # define a span, which is the same for the fine chart.
             chartitem = coarsechart.asChartItem(item)
-            label = chartitem.label
-            chartitem.label = 0
-            kbestspans[label].add(chartitem)
+            kbestspans[chartitem.label].add(chartitem)
         # now construct a list which references these coarse items:
         for label in range(fine.nonterminals):
             if splitprune and markorigin and fine.fanout[label] != 1:
@@ -114,6 +111,46 @@ def prunechart(Chart coarsechart, Grammar fine, k,
         return whitelist, items, msg
 
 
+cdef CFGWhitelist cfgwhitelist(Chart coarsechart, Grammar fine, items):
+    """Project items of coarse chart to the labels of a fine CFG."""
+    cdef CFGWhitelist result = CFGWhitelist(compactcellidx(
+        coarsechart.lensent - 1, coarsechart.lensent,
+        coarsechart.lensent, 1) + 1, fine.nonterminals)
+    cdef size_t numcoarse = coarsechart.grammar.nonterminals
+    cdef uint32_t n, m, label
+    cdef uint64_t * cellbits
+    # fine labels grouped by coarse label: bycoarse[offsets[label]:
+    # offsets[label + 1]]; labels mapped to 0 are never pruned.
+    cdef uint32_t * bycoarse = <uint32_t *>malloc(
+        fine.nonterminals * sizeof(uint32_t))
+    cdef uint32_t * offsets = <uint32_t *>calloc(
+        numcoarse + 2, sizeof(uint32_t))
+    if bycoarse is NULL or offsets is NULL:
+        free(bycoarse)
+        free(offsets)
+        raise MemoryError('allocation error')
+    for n in range(1, fine.nonterminals):
+        if fine.mapping[n] < numcoarse:
+            offsets[fine.mapping[n] + 2] += 1
+    for label in range(2, numcoarse + 2):
+        offsets[label] += offsets[label - 1]
+    for n in range(1, fine.nonterminals):
+        if fine.mapping[n] < numcoarse:
+            bycoarse[offsets[fine.mapping[n] + 1]] = n
+            offsets[fine.mapping[n] + 1] += 1
+    for item in items:
+        label = coarsechart.label(item)
+        cellbits = cfgcellbits(result, coarsechart.asCFGspan(
+            item, fine.nonterminals))
+        for m in range(offsets[0], offsets[1]):
+            SETBIT(cellbits, bycoarse[m])
+        for m in range(offsets[label], offsets[label + 1]):
+            SETBIT(cellbits, bycoarse[m])
+    free(bycoarse)
+    free(offsets)
+    return result
+
+
 def bitparkbestitems(Chart chart, int k, bint finecfg):
     """Produce ChartItems occurring in a dictionary of derivations.
 
@@ -151,118 +188,260 @@ def posteriorthreshold(Chart chart, double threshold):
         raise ValueError('probability threshold should be between 0 and 1.')
     if not chart.itemsinorder:
         raise ValueError('need list of chart items in topological order.')
-    origlogprob = chart.grammar.logprob
-    chart.grammar.switch(
-        chart.grammar.modelnames[chart.grammar.currentmodel],
-        logprob=False)
-    getinside(chart)
-    getoutside(chart)
-    chart.grammar.switch(
-        chart.grammar.modelnames[chart.grammar.currentmodel],
-        logprob=origlogprob)
-    sentprob = chart.inside[chart.root()]
-    threshold *= sentprob
-    if not sentprob:
-        raise ValueError('sentence has zero posterior prob.: %g' % sentprob)
-    posterior = {item for item in chart.getitems()
-                 if chart.inside[item] * chart.outside[item] > threshold}
-
-    unfiltered = len(chart.getitems())
-    numitems = len(chart.outside)
-    numremain = len(posterior)
+    items, inside, outside, sentprob = insideoutside(chart)
+    if sentprob == -INFINITY:
+        raise ValueError('sentence has zero posterior prob.: %g' % exp(
+            sentprob))
+    posterior = inside + outside - sentprob
+    remaining = np.flatnonzero(posterior > log(threshold))
+    numitems = np.count_nonzero(outside != -INFINITY)
     msg = ('coarse items before pruning=%d; filtered: %d;'
            ' pruned: %d; sentprob=%g' % (
-               unfiltered, numitems, numremain, sentprob))
-    return posterior, msg
+               len(chart.getitems()), numitems, len(remaining),
+               exp(sentprob)))
+    return {items[n] for n in remaining}, msg
 
 
-def getinside(Chart chart):
-    """Compute inside probabilities for a chart given its parse forest."""
-    cdef size_t n
+def insideoutside(Chart chart):
+    """Compute inside and outside log probabilities for the items in a chart.
+
+    The parse forest is first copied to an array of edges which refer to
+    items by their index in ``chart.itemsinorder``; the inside and outside
+    passes then only involve C loops, and probabilities are summed in log
+    space, which avoids underflow with long sentences.
+
+    :returns: a tuple ``(items, inside, outside, sentprob)`` where ``items``
+        is a list of the items in the order of ``chart.itemsinorder``,
+        ``inside`` and ``outside`` are arrays with the corresponding (natural)
+        log probabilities, and ``sentprob`` is the log probability of the
+        sentence. Zero probabilities are represented as ``-inf``."""
+    cdef size_t n, m, numitems, numedges = 0, cap = 1024
+    cdef uint32_t root
     cdef Edge * edge
     cdef Edges edges
     cdef MoreEdges * edgelist
-    # this needs to be bottom up, so need order in which items were added
-    # currently separate list, chart.itemsinorder
-    # NB: sorting items by length is not enough,
-    # unaries have to be in the right order...
-
-    # choices for probs:
-    # - normal => underflow (current)
-    # - logprobs => loss of precision w/addition
-    # - normal, scaled => how?
-
-    # packing parse forest:
-    # revitems = {item: n for n, item in enumerate(self.itemsinorder)}
-    # now self.inside[n] and self.outside[n] can be double arrays.
-    chart.inside = dict.fromkeys(chart.getitems(), 0.0)
-
-    # traverse items in bottom-up order
+    cdef IOEdge * ioedge
+    cdef IOEdge * ioedges = NULL
+    cdef IOEdge * tmp
+    cdef size_t * offsets = NULL
+    cdef uint32_t * order = NULL
+    cdef double[:] insidearr, outsidearr
+    cdef dict index = {}
+    cdef list items = []
+    cdef bint origlogprob = chart.grammar.logprob
     for item in chart.itemsinorder:
-        edges = chart.getedges(item)
-        edgelist = edges.head if edges is not None else NULL
-        while edgelist is not NULL:
-            for n in range(edges.len if edgelist is edges.head
-                           else EDGES_SIZE):
-                edge = &(edgelist.data[n])
-                if edge.rule is NULL:
-                    label = chart.label(item)
-                    word = chart.sent[chart.lexidx(edge)]
-                    prob = ( < LexicalRule > chart.grammar.lexicalbylhs[
-                        label].get(word, 1.0)).prob
-                elif edge.rule.rhs2 == 0:
-                    leftitem = chart._left(item, edge)
-                    prob = (edge.rule.prob
-                            * chart.inside[leftitem])
-                else:
-                    leftitem = chart._left(item, edge)
-                    rightitem = chart._right(item, edge)
-                    prob = (edge.rule.prob
-                            * chart.inside[leftitem]
-                            * chart.inside[rightitem])
-                # chart.addprob(item, prob)
-                chart.inside[item] += prob
-            edgelist = edgelist.prev
+        if item not in index:
+            index[item] = len(items)
+            items.append(item)
+    numitems = len(items)
+    rootitem = chart.root()
+    if rootitem not in index:
+        raise ValueError('root item not in chart.')
+    root = index[rootitem]
+    insidearr = np.empty(numitems, dtype='d')
+    outsidearr = np.empty(numitems, dtype='d')
+    ioedges = <IOEdge *>malloc(cap * sizeof(IOEdge))
+    offsets = <size_t *>malloc((numitems + 1) * sizeof(size_t))
+    order = <uint32_t *>malloc(numitems * sizeof(uint32_t))
+    if ioedges is NULL or offsets is NULL or order is NULL:
+        free(ioedges)
+        free(offsets)
+        free(order)
+        raise MemoryError
+    if not origlogprob:
+        chart.grammar.switch(
+            chart.grammar.modelnames[chart.grammar.currentmodel],
+            logprob=True)
+    try:
+        # copy parse forest to array of edges
+        for n in range(numitems):
+            item = items[n]
+            offsets[n] = numedges
+            edges = chart.getedges(item)
+            edgelist = edges.head if edges is not None else NULL
+            while edgelist is not NULL:
+                for m in range(edges.len if edgelist is edges.head
+                               else EDGES_SIZE):
+                    edge = &(edgelist.data[m])
+                    if numedges == cap:
+                        cap *= 2
+                        tmp = <IOEdge *>realloc(ioedges, cap * sizeof(IOEdge))
+                        if tmp is NULL:
+                            raise MemoryError
+                        ioedges = tmp
+                    ioedge = &(ioedges[numedges])
+                    ioedge.left = ioedge.right = UINT32_MAX
+                    if edge.rule is NULL:
+                        ioedge.prob = -chart.lexprob(item, edge)
+                    else:
+                        ioedge.prob = -edge.rule.prob
+                        leftitem = chart._left(item, edge)
+                        if leftitem not in index:
+                            continue
+                        ioedge.left = index[leftitem]
+                        if edge.rule.rhs2 != 0:
+                            rightitem = chart._right(item, edge)
+                            if rightitem not in index:
+                                continue
+                            ioedge.right = index[rightitem]
+                    numedges += 1
+                edgelist = edgelist.prev
+        offsets[numitems] = numedges
+        # NB: chart.itemsinorder is not necessarily bottom-up; e.g., with
+        # exhaustive agenda-based parsing, an item may receive an edge after
+        # it has been added.
+        if toposort(ioedges, offsets, numitems, order) == -1:
+            raise MemoryError
+        with nogil:
+            computeinside(ioedges, offsets, order, numitems, &(insidearr[0]))
+            computeoutside(ioedges, offsets, order, numitems, root,
+                           &(insidearr[0]), &(outsidearr[0]))
+    finally:
+        free(ioedges)
+        free(offsets)
+        free(order)
+        if not origlogprob:
+            chart.grammar.switch(
+                chart.grammar.modelnames[chart.grammar.currentmodel],
+                logprob=False)
+    return (items, np.asarray(insidearr), np.asarray(outsidearr),
+            insidearr[root])
+
+
+cdef int toposort(IOEdge * edges, size_t * offsets, size_t numitems,
+                  uint32_t * order) nogil:
+    """Order items such that the children of each edge precede its head.
+
+    Edges that would close a cycle (e.g., unary cycles) are ignored.
+
+    :returns: 0, or -1 if memory could not be allocated."""
+    cdef uint8_t * state = <uint8_t *>calloc(numitems, sizeof(uint8_t))
+    cdef size_t * cursor = <size_t *>malloc(numitems * sizeof(size_t))
+    cdef uint32_t * stack = <uint32_t *>malloc(numitems * sizeof(uint32_t))
+    cdef size_t n, m, top, numordered = 0
+    cdef uint32_t item, child
+    if state is NULL or cursor is NULL or stack is NULL:
+        free(state)
+        free(cursor)
+        free(stack)
+        return -1
+    # iterative depth-first search; state 1: on stack, 2: done.
+    # cursor[n] is the next child of item n to visit: 2 * edge + left/right.
+    for n in range(numitems):
+        if state[n]:
+            continue
+        stack[0], top, state[n], cursor[n] = n, 1, 1, 2 * offsets[n]
+        while top:
+            item = stack[top - 1]
+            if cursor[item] == 2 * offsets[item + 1]:
+                state[item] = 2
+                order[numordered] = item
+                numordered += 1
+                top -= 1
+                continue
+            m = cursor[item]
+            cursor[item] += 1
+            child = edges[m // 2].right if m & 1 else edges[m // 2].left
+            if child != UINT32_MAX and state[child] == 0:
+                state[child], cursor[child] = 1, 2 * offsets[child]
+                stack[top] = child
+                top += 1
+    free(state)
+    free(cursor)
+    free(stack)
+    return 0
+
+
+cdef void computeinside(IOEdge * edges, size_t * offsets, uint32_t * order,
+                        size_t numitems, double * inside) nogil:
+    """Bottom-up pass.
+
+    The edges of item ``n`` are ``edges[offsets[n]:offsets[n + 1]]``."""
+    cdef size_t i, n, m
+    cdef double x, maxx, total
+    for n in range(numitems):
+        inside[n] = -INFINITY
+    for i in range(numitems):
+        n = order[i]
+        maxx = -INFINITY
+        for m in range(offsets[n], offsets[n + 1]):
+            x = edgeinside(&(edges[m]), inside)
+            if x > maxx:
+                maxx = x
+        if maxx == -INFINITY:
+            inside[n] = -INFINITY
+            continue
+        total = 0.0
+        for m in range(offsets[n], offsets[n + 1]):
+            total += exp(edgeinside(&(edges[m]), inside) - maxx)
+        inside[n] = maxx + log(total)
+
+
+cdef void computeoutside(IOEdge * edges, size_t * offsets, uint32_t * order,
+                         size_t numitems, uint32_t root, double * inside,
+                         double * outside) nogil:
+    """Top-down pass, given inside probabilities."""
+    cdef size_t i, n, m
+    cdef double x
+    for n in range(numitems):
+        outside[n] = -INFINITY
+    outside[root] = 0.0
+    i = numitems
+    while i:
+        i -= 1
+        n = order[i]
+        if outside[n] == -INFINITY:
+            continue
+        for m in range(offsets[n], offsets[n + 1]):
+            x = outside[n] + edges[m].prob
+            if edges[m].left == UINT32_MAX:
+                continue
+            elif edges[m].right == UINT32_MAX:
+                outside[edges[m].left] = logaddexp(
+                    outside[edges[m].left], x)
+            else:
+                outside[edges[m].left] = logaddexp(
+                    outside[edges[m].left], x + inside[edges[m].right])
+                outside[edges[m].right] = logaddexp(
+                    outside[edges[m].right], x + inside[edges[m].left])
+
+
+cdef inline double edgeinside(IOEdge * edge, double * inside) nogil:
+    """Log probability of an edge given the inside probs of its children."""
+    if edge.left == UINT32_MAX:
+        return edge.prob
+    elif edge.right == UINT32_MAX:
+        return edge.prob + inside[edge.left]
+    return edge.prob + inside[edge.left] + inside[edge.right]
+
+
+cdef inline double logaddexp(double x, double y) nogil:
+    """Return ``log(exp(x) + exp(y))``."""
+    if x == -INFINITY:
+        return y
+    elif y == -INFINITY:
+        return x
+    elif x > y:
+        return x + log1p(exp(y - x))
+    return y + log1p(exp(x - y))
+
+
+def getinside(Chart chart):
+    """Compute inside probabilities for a chart given its parse forest.
+
+    Stores the probabilities (not log probabilities) in a dictionary
+    ``chart.inside``; cf. ``insideoutside()``."""
+    items, inside, _, _ = insideoutside(chart)
+    chart.inside = dict(zip(items, np.exp(inside).tolist()))
 
 
 def getoutside(Chart chart):
-    """Compute outside probabilities for a chart given its parse forest."""
-    cdef size_t n
-    cdef Edge * edge
-    cdef Edges edges
-    cdef MoreEdges * edgelist
-    cdef double outsideprob
-    # cdef double sentprob = chart.inside[chart.root()]
-    # traverse items in top-down order
-    # could use list with idx of item in itemsinorder
-    chart.outside = dict.fromkeys(chart.getitems(), 0.0)
-    chart.outside[chart.root()] = 1.0
-    for item in reversed(chart.itemsinorder):
-        # can we define outside[item] simply as sentprob - inside[item] ?
-        # chart.outside[item] = sentprob - chart.inside[item]
-        edges = chart.getedges(item)
-        edgelist = edges.head if edges is not None else NULL
-        while edgelist is not NULL:
-            for n in range(edges.len if edgelist is edges.head
-                           else EDGES_SIZE):
-                edge = &(edgelist.data[n])
-                if edge.rule is NULL:
-                    pass
-                elif edge.rule.rhs2 == 0:
-                    leftitem = chart._left(item, edge)
-                    chart.outside[leftitem] += (edge.rule.prob
-                                                * chart.outside[item])
-                else:
-                    leftitem = chart._left(item, edge)
-                    rightitem = chart._right(item, edge)
-                    outsideprob = chart.outside[item]
-                    chart.outside[leftitem] += (edge.rule.prob
-                                                * chart.inside[rightitem]
-                                                * outsideprob)
-                    chart.outside[rightitem] += (edge.rule.prob
-                                                 * chart.inside[leftitem]
-                                                 * outsideprob)
-            edgelist = edgelist.prev
+    """Compute outside probabilities for a chart given its parse forest.
+
+    Stores the probabilities (not log probabilities) in a dictionary
+    ``chart.outside``; cf. ``insideoutside()``."""
+    items, _, outside, _ = insideoutside(chart)
+    chart.outside = dict(zip(items, np.exp(outside).tolist()))
 
 
 def doctftest(coarse, fine, sent, tree, k, split, verbose=False):
@@ -411,4 +590,4 @@ def test():
 
 
 __all__ = ['prunechart', 'bitparkbestitems', 'posteriorthreshold',
-           'getinside', 'getoutside']
+           'insideoutside', 'getinside', 'getoutside']
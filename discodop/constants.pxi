@@ -11,6 +11,16 @@ ELSE:
 # reserve 8 bytes for linked list pointer; 16 bytes per edge.
 DEF EDGES_SIZE = (256 - 8) // 16
 
+# Edge blocks of a chart are allocated from slabs; the first slab holds this
+# number of blocks, each further slab twice as many as the previous one.
+DEF ARENA_SLAB = 64
+DEF MAX_SLABS = 40
+
+# The maximum size of a dense CFG chart, in terms of the number of cells times
+# the number of labels (i.e., lensent ** 2 * nonterminals). For larger charts
+# (e.g., long sentences), a sparse chart is used.
+DEF MAX_DENSE_CHART = 1 << 26
+
 # The arity of the heap. A typical heap is binary (2).
 # Higher values result in a heap with a smaller depth,
 # but increase the number of comparisons between siblings that need to be done.
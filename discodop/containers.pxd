@@ -2,13 +2,14 @@ from math import isinf, exp, log, fsum
 from libc.stdlib cimport malloc, calloc, realloc, free, abort, \
     qsort, atol, strtod
 from libc.string cimport memcmp, memset, memcpy
-from libc.stdint cimport uint8_t, uint32_t, uint64_t
+from libc.stdint cimport uint8_t, uint16_t, uint32_t, uint64_t, int64_t
 from cpython.array cimport array
 cimport cython
 include "constants.pxi"
 
-# NB: For PCFG parsing sentences longer than 256 words, change this to uint16_t
-ctypedef uint8_t Idx
+# Sentence positions in CFG charts; chart storage uses short / size_t indices,
+# so this type only needs to be wide enough for the longest sentence.
+ctypedef uint16_t Idx
 
 
 cdef extern from *:
@@ -37,16 +38,34 @@ cdef class Grammar:
     cdef uint8_t * fanout
     cdef uint64_t * chainvec
     cdef uint64_t * mask
+    # lexical rules: lhs & prob, clustered by word
+    cdef uint32_t * lexlhs
+    cdef double * lexprobs
+    cdef uint32_t * lexwordidx  # word n => lexical rules idx[n] ... idx[n+1]-1
+    # perfect hash table of words; see Grammar._buildwordhash()
+    cdef uint32_t * worddisp  # bucket => displacement (seed of hash function)
+    cdef uint32_t * wordslots  # slot => word number; NOWORD if empty
+    cdef uint32_t * wordoffsets  # word n => wordbuf[offsets[n]:offsets[n+1]]
+    cdef char * wordbuf  # utf8 encoded words
     cdef readonly int currentmodel
     cdef readonly size_t nonterminals, phrasalnonterminals
     cdef readonly size_t numrules, numunary, numbinary, maxfanout
+    cdef readonly size_t numlexical, numwords
+    cdef size_t numbuckets, numslots
     cdef readonly bint logprob, bitpar, binarized
     cdef readonly object models
     cdef readonly str origrules, origlexicon, start
-    cdef readonly list tolabel, lexical, modelnames, rulemapping
-    cdef readonly dict toid, lexicalbyword, lexicalbylhs, lexicalbynum, rulenos
+    cdef readonly list tolabel, lexicallhs, modelnames, rulemapping
+    cdef readonly dict toid, lexicalbynum, rulenos
+    cdef list _lexical
+    cdef dict _lexicalbyword, _lexicalbylhs
+    cdef object _state  # (mmap, filename) when loaded with fromfile()
+    cdef str _mappingoptions  # options of last getmapping(); see savemapping()
     cdef _convertrules(self, list rulelines, dict fanoutdict)
     cdef _indexrules(self, ProbRule ** dest, int idx, int filterlen)
+    cdef int wordid(self, str word) except -2
+    cdef int lexruleno(self, uint32_t lhs, str word) except -1
+    cdef double lexprob(self, uint32_t lhs, str word) except? -1
     cpdef rulestr(self, int n)
     cdef yfstr(self, ProbRule rule)
 
@@ -169,6 +188,13 @@ cdef struct MoreEdges:  # An unrolled linked list
     # the linked list
 
 
+cdef struct EdgeArena:  # Allocates MoreEdges blocks in bulk
+    MoreEdges * slabs[MAX_SLABS]  # slab n holds ARENA_SLAB << n blocks
+    size_t numslabs  # number of allocated slabs
+    size_t cur  # the slab from which blocks are handed out
+    size_t used  # number of blocks handed out from the current slab
+
+
 @cython.final
 cdef class RankedEdge:
     # NB: 'head' is unnecessary because the head will also be the dictionary
@@ -178,6 +204,22 @@ cdef class RankedEdge:
     cdef int left, right  # rank of left / right child
 
 
+@cython.final
+cdef class SpanSet:
+    cdef uint64_t * table  # open addressing hash table; 0 is an empty slot
+    cdef size_t size, capacity  # capacity is a power of 2
+    cdef set fat  # spans as FatChartItems with label 0, for long sentences
+    cdef int addvec(self, uint64_t vec) except -1
+
+
+@cython.final
+cdef class CFGWhitelist:
+    cdef uint64_t * bits  # labels of cell n: bits[n * slots:(n + 1) * slots]
+    cdef size_t numcells
+    cdef int slots
+    cdef readonly uint32_t nonterminals
+
+
 # start scratch
 #
 #
@@ -315,21 +357,96 @@ cdef inline RankedEdge new_RankedEdge(
 
 # defined here because circular import.
 cdef inline size_t cellidx(short start, short end, short lensent,
-                           uint32_t nonterminals):
+                           uint32_t nonterminals) nogil:
     """Return an index for a regular three dimensional array.
 
     ``chart[start][end][0] => chart[idx]`` """
-    return (start * lensent + (end - 1)) * nonterminals
+    return (<size_t>start * lensent + (end - 1)) * nonterminals
 
 
 cdef inline size_t compactcellidx(short start, short end, short lensent,
-                                  uint32_t nonterminals):
+                                  uint32_t nonterminals) nogil:
     """Return an index to a triangular array, given start < end.
     The result of this function is the index to chart[start][end][0]."""
-    return nonterminals * (lensent * start
+    return nonterminals * (<size_t>lensent * start
                            - ((start - 1) * start / 2) + end - start - 1)
 
 
+cdef inline MoreEdges * arenablock(EdgeArena * arena) nogil:
+    """Return an uninitialized block of edges from ``arena``.
+
+    Blocks are carved out of slabs that double in size, so that few
+    allocations are needed, and blocks allocated consecutively are adjacent
+    in memory."""
+    if arena.numslabs == 0 or arena.used == (<size_t>ARENA_SLAB) << arena.cur:
+        if arena.numslabs:  # current slab is full
+            arena.cur += 1
+        if arena.cur == arena.numslabs:
+            if arena.numslabs == MAX_SLABS:
+                abort()
+            arena.slabs[arena.cur] = <MoreEdges *>malloc(
+                ((<size_t>ARENA_SLAB) << arena.cur) * sizeof(MoreEdges))
+            if arena.slabs[arena.cur] is NULL:
+                abort()
+            arena.numslabs += 1
+        arena.used = 0
+    arena.used += 1
+    return &(arena.slabs[arena.cur][arena.used - 1])
+
+
+cdef inline void arenareset(EdgeArena * arena) nogil:
+    """Make all blocks of ``arena`` available again, without freeing them."""
+    arena.cur = arena.used = 0
+
+
+cdef inline size_t arenatrim(EdgeArena * arena) nogil:
+    """Free the slabs of ``arena`` beyond the one currently in use.
+
+    The current slab is the one from which blocks are handed out; return the
+    number of bytes of the remaining slabs."""
+    cdef size_t n, nbytes = 0
+    for n in range(arena.numslabs):
+        if n <= arena.cur:
+            nbytes += ((<size_t>ARENA_SLAB) << n) * sizeof(MoreEdges)
+        else:
+            free(arena.slabs[n])
+    if arena.numslabs > arena.cur + 1:
+        arena.numslabs = arena.cur + 1
+    return nbytes
+
+
+cdef inline void arenafree(EdgeArena * arena) nogil:
+    """Free all blocks allocated from ``arena``."""
+    cdef size_t n
+    for n in range(arena.numslabs):
+        free(arena.slabs[n])
+    arena.numslabs = arena.cur = arena.used = 0
+
+
+cdef inline uint64_t spanhash(uint64_t vec):
+    """Fibonacci hashing of a bit vector."""
+    return (vec * 0x9E3779B97F4A7C15UL) >> 20
+
+
+cdef inline bint spansetcontains(SpanSet spans, uint64_t vec):
+    """Test whether a span of at most 64 bits is in ``spans``."""
+    cdef size_t mask = spans.capacity - 1
+    cdef size_t n = spanhash(vec) & mask
+    while spans.table[n]:
+        if spans.table[n] == vec:
+            return True
+        n = (n + 1) & mask
+    return False
+
+
+cdef inline uint64_t * cfgcellbits(CFGWhitelist whitelist, size_t cell):
+    """Return the bit vector of labels allowed in a cell.
+
+    ``cell`` is a compact cell index, i.e.,
+    ``compactcellidx(start, end, lensent, 1)``."""
+    return &(whitelist.bits[cell * whitelist.slots])
+
+
 cdef object log1e200 = log(1e200)
 
 
@@ -235,6 +235,154 @@ cdef class RankedEdge:
             self.left, self.right)
 
 
+@cython.final
+cdef class SpanSet:
+    """A set of spans, used to whitelist chart items when pruning.
+
+    Only the bit vectors of items are considered, labels are ignored. Spans of
+    ``SmallChartItems`` are stored in a hash table of integers which can be
+    queried without involving Python objects; those of ``FatChartItems`` in a
+    Python set.
+
+    :param items: an optional iterable of chart items to add."""
+
+    def __cinit__(self):
+        self.capacity = 8
+        self.size = 0
+        self.table = <uint64_t *>calloc(self.capacity, sizeof(uint64_t))
+        if self.table is NULL:
+            raise MemoryError('allocation error')
+        self.fat = set()
+
+    def __init__(self, items=None):
+        if items is not None:
+            for item in items:
+                self.add(item)
+
+    def __dealloc__(self):
+        free(self.table)
+        self.table = NULL
+
+    cdef int addvec(self, uint64_t vec) except -1:
+        """Add a span of at most 64 bits; ``vec`` should be nonzero."""
+        cdef uint64_t * oldtable = self.table
+        cdef size_t n, mask, oldcapacity = self.capacity
+        if 2 * (self.size + 1) > self.capacity:
+            self.table = <uint64_t *>calloc(2 * self.capacity,
+                                            sizeof(uint64_t))
+            if self.table is NULL:
+                self.table = oldtable
+                raise MemoryError('allocation error')
+            self.capacity *= 2
+            self.size = 0
+            for n in range(oldcapacity):
+                if oldtable[n]:
+                    self.addvec(oldtable[n])
+            free(oldtable)
+        mask = self.capacity - 1
+        n = spanhash(vec) & mask
+        while self.table[n]:
+            if self.table[n] == vec:
+                return 0
+            n = (n + 1) & mask
+        self.table[n] = vec
+        self.size += 1
+        return 0
+
+    def add(self, ChartItem item):
+        """Add the span of a chart item."""
+        cdef FatChartItem fitem
+        if isinstance(item, SmallChartItem):
+            if (<SmallChartItem>item).vec:
+                self.addvec((<SmallChartItem>item).vec)
+        else:
+            fitem = (<FatChartItem>item).copy()
+            fitem.label = 0
+            self.fat.add(fitem)
+
+    def __contains__(self, ChartItem item):
+        cdef FatChartItem fitem
+        if isinstance(item, SmallChartItem):
+            return spansetcontains(self, (<SmallChartItem>item).vec)
+        fitem = (<FatChartItem>item).copy()
+        fitem.label = 0
+        return fitem in self.fat
+
+    def __len__(self):
+        return self.size + len(self.fat)
+
+    def __iter__(self):
+        """Yield the spans as chart items with label 0."""
+        cdef size_t n
+        for n in range(self.capacity):
+            if self.table[n]:
+                yield new_SmallChartItem(0, self.table[n])
+        for item in self.fat:
+            yield item
+
+    def __repr__(self):
+        return '<%s with %d spans>' % (self.__class__.__name__, len(self))
+
+
+@cython.final
+cdef class CFGWhitelist:
+    """Labels allowed in each cell of a CFG chart, used when pruning.
+
+    Stores a bit vector of labels for each cell, so that both membership tests
+    and iterating over the labels of a cell require no Python objects.
+
+    :param numcells: the number of cells; for a sentence of length ``n``:
+        ``n * (n + 1) // 2``. Cells are indexed with
+        ``compactcellidx(start, end, n, 1)``.
+    :param nonterminals: the number of labels in the grammar."""
+
+    def __cinit__(self, size_t numcells, uint32_t nonterminals):
+        self.numcells = numcells
+        self.nonterminals = nonterminals
+        self.slots = BITNSLOTS(nonterminals)
+        self.bits = <uint64_t *>calloc(numcells * self.slots,
+                                       sizeof(uint64_t))
+        if self.bits is NULL:
+            raise MemoryError('allocation error')
+
+    def __dealloc__(self):
+        free(self.bits)
+        self.bits = NULL
+
+    @classmethod
+    def fromsets(cls, list cells, uint32_t nonterminals):
+        """Create whitelist from a list with a set of labels for each cell."""
+        cdef CFGWhitelist result = cls(len(cells), nonterminals)
+        cdef size_t cell
+        for cell, labels in enumerate(cells):
+            for label in labels:
+                result.add(cell, label)
+        return result
+
+    def add(self, size_t cell, uint32_t label):
+        """Allow label in cell."""
+        if cell >= self.numcells or label >= self.nonterminals:
+            raise IndexError
+        SETBIT(cfgcellbits(self, cell), label)
+
+    def __getitem__(self, size_t cell):
+        """Return the set of labels allowed in a cell."""
+        cdef uint64_t * cellbits
+        cdef int label = 0
+        if cell >= self.numcells:
+            raise IndexError
+        cellbits = cfgcellbits(self, cell)
+        result = set()
+        label = anextset(cellbits, 0, self.slots)
+        while label != -1:
+            result.add(label)
+            label = anextset(cellbits, label + 1, self.slots)
+        return result
+
+    def __len__(self):
+        return self.numcells
+
+
 cdef class Chart:
     """Base class for charts. Provides methods available on all charts.
 
@@ -291,7 +439,7 @@ cdef class Chart:
         """Return lexical probability given a lexical edge."""
         label = self.label(item)
         word = self.sent[self.lexidx(edge)]
-        return ( < LexicalRule > self.grammar.lexicalbylhs[label][word]).prob
+        return self.grammar.lexprob(label, word)
 
     cdef ChartItem asChartItem(self, item):
         """Convert/copy item to ChartItem instance."""
@@ -396,12 +544,9 @@ cdef class Chart:
                 del self.parseforest[item]
         else:
             # FIXME: maybe better as method in DenseCFGChart
+            # NB: edges are allocated from an arena owned by the chart,
+            # and are freed together with the chart.
             for item in set(self.getitems()) - items:
-                edgelist = (< EdgesStruct * >self.parseforest)[item].head
-                while edgelist is not NULL:
-                    tmp = edgelist
-                    edgelist = edgelist.prev
-                    free(tmp)
                 (< EdgesStruct * >self.parseforest)[item].len = 0
                 (< EdgesStruct * >self.parseforest)[item].head = NULL
 
@@ -1060,5 +1205,5 @@ cdef inline void releasebuf(Py_buffer * buf):
         PyBuffer_Release(buf)
 
 __all__ = ['Grammar', 'Chart', 'Ctrees', 'LexicalRule', 'SmallChartItem',
-           'FatChartItem', 'Edges', 'RankedEdge', 'Vocabulary', 'FixedVocabulary',
-           'numedges']
+           'FatChartItem', 'Edges', 'RankedEdge', 'SpanSet', 'CFGWhitelist',
+           'Vocabulary', 'FixedVocabulary', 'numedges']
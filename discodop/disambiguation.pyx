@@ -8,27 +8,29 @@ Use as follows:
 
 from __future__ import print_function
 import re
+from string import Formatter
 from heapq import nlargest
 from math import exp, log, isinf, fsum
-from random import random
-from bisect import bisect_right
 from operator import itemgetter, attrgetter
 from itertools import count
 from functools import partial
 from collections import defaultdict
 from . import plcfrs, _fragments
 from .tree import Tree, writediscbrackettree
-from .kbest import lazykbest, getderiv
+from .kbest import lazykbest, iterkbest, getderiv
+from .coarsetofine import insideoutside
+import numpy as np
 from .grammar import lcfrsproductions
 from .treetransforms import addbitsets, unbinarize, canonicalize, \
     collapseunary, mergediscnodes, binarize
 from .bit import pyintnextset, pyintbitcount
-from libc.stdint cimport uint8_t, uint32_t, uint64_t, intptr_t
+from libc.stdint cimport uint8_t, uint32_t, uint64_t, UINT32_MAX
+from libc.stdlib cimport malloc, realloc, free
 from .bit cimport abitcount
 from .plcfrs cimport DoubleEntry, new_DoubleEntry
 from .containers cimport Grammar, ProbRule, LexicalRule, Chart, Edges, \
-    MoreEdges, SmallChartItem, FatChartItem, Edge, RankedEdge, \
-    new_RankedEdge, logprobadd, logprobsum, yieldranges
+    MoreEdges, ChartItem, SmallChartItem, FatChartItem, SpanSet, Edge, \
+    RankedEdge, new_RankedEdge, logprobadd, logprobsum, yieldranges
 cimport cython
 
 from libc.string cimport memset
@@ -42,17 +44,27 @@ include "constants.pxi"
 
 REMOVEIDS = re.compile('@[-0-9]+')
 REMOVEWORDTAGS = re.compile('@[^ )]+')
+FORMATTER = Formatter()
 cdef str NONCONSTLABEL = ''
 cdef str NEGATIVECONSTLABEL = '-#-'
+cdef double INFINITY = float('infinity')
 
 cpdef getderivations(Chart chart, int k, bint kbest=True, bint sample=False,
-                     derivstrings=True):
+                     derivstrings=True, bint earlystop=False,
+                     list backtransform=None):
     """Get *k*-best and/or sampled derivations from chart.
 
     :param k: number of derivations to extract from chart
     :param sample: whether to *k* derivations sample from chart
     :param kbest: whether to extract *k*-best derivations from chart
     :param derivstrings: whether to create derivations as strings
+    :param earlystop: stop extracting *k*-best derivations as soon as the most
+            probable parse can no longer change; i.e., when the probability
+            mass of the best parse tree exceeds that of the second best by
+            more than the mass of the derivations not yet extracted (computed
+            with the inside probability of the sentence). Cf. ``mppbound()``.
+    :param backtransform: with ``earlystop``, identifies parse trees of
+            derivations; see ``marginalize()``.
     :returns: tuple ``(derivations, entries)``; two lists of equal length:
 
             :derivations: list of tuples ``(deriv, logprob)`` where deriv is a
@@ -62,9 +74,14 @@ cpdef getderivations(Chart chart, int k, bint kbest=True, bint sample=False,
     cdef list derivations = [], entries = []
     if not (kbest or sample):
         raise ValueError('at least one of kbest or sample needs to be True.')
+    if earlystop and (sample or not kbest):
+        raise ValueError('earlystop requires kbest without sample.')
     chart.rankededges = {}
-    if kbest:
-        derivations, unused_explored = lazykbest(chart, k, derivs=derivstrings)
+    if earlystop:
+        derivations = mppbound(chart, k, backtransform, derivstrings)
+        entries = chart.rankededges[chart.root()]
+    elif kbest:
+        derivations, _ = lazykbest(chart, k, derivs=derivstrings)
         entries = chart.rankededges[chart.root()]
     if sample:
         derivations.extend(
@@ -77,10 +94,61 @@ cpdef getderivations(Chart chart, int k, bint kbest=True, bint sample=False,
     return derivations, entries
 
 
+cdef list mppbound(Chart chart, int k, list backtransform, bint derivstrings):
+    """Extract *k*-best derivations until the most probable parse is certain.
+
+    Derivations are pulled one at a time from ``iterkbest()``. The probability
+    mass of the derivations that have not been extracted is bounded by the
+    inside probability of the sentence minus the mass extracted so far; when
+    the best parse tree leads the second best by more than this, no further
+    derivation can change the most probable parse.
+
+    :returns: the derivations as with ``lazykbest()``; the corresponding
+        entries are in ``chart.rankededges[chart.root()]``."""
+    cdef DoubleEntry entry
+    cdef dict masses = {}, cache = {}, templates = {}
+    cdef list derivations = []
+    cdef bint dopreduction = backtransform is None
+    cdef double sentprob, mass, remaining = 1.0
+    cdef double bestmass = 0.0, secondmass = 0.0
+    cdef object tree, besttree = None
+    cdef int n = 0
+    # NB: masses are relative to the probability of the sentence
+    sentprob = insideoutside(chart)[3]
+    root = chart.root()
+    for deriv, prob in iterkbest(chart, k, derivs=derivstrings or dopreduction):
+        if derivstrings:
+            derivations.append((deriv, prob))
+        mass = exp(-prob - sentprob)
+        remaining -= mass
+        if dopreduction:
+            tree = REMOVEIDS.sub('', deriv)
+        else:
+            entry = chart.rankededges[root][n]
+            try:
+                tree = treehash(entry.key, chart, backtransform,
+                                cache, templates)
+            except:
+                tree = None  # marginalize() will skip this derivation
+        if tree is not None:
+            masses[tree] = masses.get(tree, 0.0) + mass
+            if tree == besttree:
+                bestmass = masses[tree]
+            elif masses[tree] > bestmass:
+                besttree, bestmass, secondmass = tree, masses[tree], bestmass
+            elif masses[tree] > secondmass:
+                secondmass = masses[tree]
+        # allow for rounding errors in the inside probability
+        if bestmass - secondmass > remaining + 1e-9:
+            break
+        n += 1
+    return derivations
+
+
 cpdef marginalize(method, list derivations, list entries, Chart chart,
                   list backtransform=None, list sent=None, list tags=None,
                   int k=1000, int sldop_n=7, double mcc_labda=1.0, set mcc_labels=None,
-                  bint bitpar=False):
+                  bint bitpar=False, int maxtrees=0, str model=None):
     """Take a list of derivations and optimize a given objective function.
 
     1. Rewrites derivations into the intended parse trees.
@@ -96,6 +164,11 @@ cpdef marginalize(method, list derivations, list entries, Chart chart,
             :'sl-dop': Simplicity-Likelihood DOP; select most likely parse from the
                     ``sldop_n`` parse trees with the shortest derivations.
             :'sl-dop-simple': Approximation of Simplicity-Likelihood DOP
+            :'mcc': Most Constituents Correct, estimated from derivations.
+            :'mrp': Max-Rule-Product; computed from the chart with
+                    inside-outside, ``derivations`` are ignored.
+            :'mcc-chart': Most Constituents Correct, computed from the chart
+                    with inside-outside; ``derivations`` are ignored.
     :param backtransform:
             Dependending on the value of this parameter, one of two ways is
             employed to turn derivations into parse trees:
@@ -109,6 +182,15 @@ cpdef marginalize(method, list derivations, list entries, Chart chart,
                     derivations.
     :param k: when ``method='sl-dop``, number of derivations to consider.
     :param bitpar: whether bitpar was used in nbest mode.
+    :param maxtrees: if > 0, only return the ``maxtrees`` most probable parse
+            trees (not supported with ``method='mcc'`` and sl-dop). With
+            Double-DOP, the parse trees of derivations are then identified by
+            integer hashes during marginalization, and strings are only
+            created for the parse trees that are returned.
+    :param model: when ``method='shortest'``, the name of the probabilistic
+            model of the grammar used to break ties between derivations with
+            the same number of fragments; defaults to the current model. The
+            grammar is not switched to this model.
     :returns:
             ``(parses, msg)``.
 
@@ -123,10 +205,14 @@ cpdef marginalize(method, list derivations, list entries, Chart chart,
     cdef bint shortest = method == 'shortest'
     cdef bint dopreduction = backtransform is None
     cdef DoubleEntry entry
-    cdef LexicalRule lexrule
     cdef dict parsetrees = {}, derivs = {}
+    cdef dict cache = {}  # expanded subderivations shared by derivations
+    cdef dict templates = {}  # rule number => template for hashing
+    cdef bint hashtrees = maxtrees > 0 and not dopreduction and not bitpar
     cdef str treestr, deriv
+    cdef object tree  # string, or integer hash of a tree
     cdef double prob, maxprob
+    cdef double[:] tiebreak = None
     cdef int m
 
     if method == 'sl-dop':
@@ -136,6 +222,9 @@ cpdef marginalize(method, list derivations, list entries, Chart chart,
         return sldop_simple(dict(derivations), entries, sldop_n, chart,
                             backtransform, bitpar)
     elif method == 'shortest':
+        tiebreak = chart.grammar.models[
+            chart.grammar.currentmodel if model is None
+            else chart.grammar.modelnames.index(model)]
         # filter out all derivations which are not shortest
         if not dopreduction and not bitpar:
             maxprob = min([entry.value for entry in entries])
@@ -147,28 +236,37 @@ cpdef marginalize(method, list derivations, list entries, Chart chart,
     elif method == 'mcc':
         return maxconstituentscorrect(derivations, chart,
                                       backtransform, mcc_labda, mcc_labels)
+    elif method in ('mrp', 'mcc-chart'):
+        if not dopreduction:
+            raise ValueError('%s not supported with Double-DOP.' % method)
+        return chartdecode(chart, method == 'mrp', mcc_labda, mcc_labels)
 
     if not dopreduction and not bitpar:  # Double-DOP
         for entry in entries:
             prob = entry.value
             try:
-                treestr = recoverfragments(entry.key, chart, backtransform)
+                if hashtrees:
+                    tree = treehash(entry.key, chart, backtransform,
+                                    cache, templates)
+                else:
+                    tree = recoverfragments(entry.key, chart, backtransform,
+                                            cache)
             except:
                 continue
             if shortest:
                 # for purposes of tie breaking, calculate the derivation
                 # probability in a different model.
-                newprob = exp(-getderivprob(entry.key, chart, sent))
+                newprob = exp(-getderivprob(entry.key, chart, sent, tiebreak))
                 score = (int(prob / log(0.5)), newprob)
-                if treestr not in parsetrees or score > parsetrees[treestr]:
-                    parsetrees[treestr] = score
-                    derivs[treestr] = entry.key
-            elif not mpd and treestr in parsetrees:
-                parsetrees[treestr].append(-prob)
-            elif not mpd or (treestr not in parsetrees
-                             or -prob > parsetrees[treestr][0]):
-                parsetrees[treestr] = [-prob]
-                derivs[treestr] = entry.key
+                if tree not in parsetrees or score > parsetrees[tree]:
+                    parsetrees[tree] = score
+                    derivs[tree] = entry.key
+            elif not mpd and tree in parsetrees:
+                parsetrees[tree].append(-prob)
+            elif not mpd or (tree not in parsetrees
+                             or -prob > parsetrees[tree][0]):
+                parsetrees[tree] = [-prob]
+                derivs[tree] = entry.key
     else:  # DOP reduction / bitpar
         for (deriv, prob), entry in zip(derivations, entries):
             if dopreduction:
@@ -189,19 +287,16 @@ cpdef marginalize(method, list derivations, list entries, Chart chart,
                             if not 1 <= len(t) <= 2:
                                 raise ValueError('expected binarized tree.')
                             m = chart.grammar.rulenos[nodeprod(t)]
-                            newprob += chart.grammar.bylhs[0][
-                                chart.grammar.revmap[m]].prob
+                            newprob += -log(tiebreak[m])
                         else:
                             m = chart.grammar.toid[t.label]
                             try:
-                                lexrule = chart.grammar.lexicalbylhs[
-                                    m][sent[t[0]]]
+                                newprob += -log(tiebreak[
+                                    chart.grammar.lexruleno(m, sent[t[0]])])
                             except KeyError:
                                 newprob += 30.0
-                            else:
-                                newprob += lexrule.prob
                 else:
-                    newprob = getderivprob(entry.key, chart, sent)
+                    newprob = getderivprob(entry.key, chart, sent, tiebreak)
                 score = (int(prob / log(0.5)), exp(-newprob))
                 if treestr not in parsetrees or (not dopreduction
                                                  and score > parsetrees[treestr]):
@@ -217,6 +312,20 @@ cpdef marginalize(method, list derivations, list entries, Chart chart,
             elif treestr in parsetrees and (dopreduction or not mpd):
                 parsetrees[treestr].append(-prob)
 
+    numtrees = len(parsetrees)
+    if maxtrees and numtrees > maxtrees:
+        if shortest:
+            scores = [((-a, b), tree) for tree, (a, b) in parsetrees.items()]
+        else:
+            scores = [(logprobsum(probs), tree)
+                      for tree, probs in parsetrees.items()]
+        parsetrees = {tree: parsetrees[tree] for _, tree
+                      in nlargest(maxtrees, scores, key=itemgetter(0))}
+    if hashtrees:  # create strings only for the selected parse trees
+        treestrs = {tree: recoverfragments(derivs[tree], chart, backtransform,
+                                           cache) for tree in parsetrees}
+        derivs = {treestrs[tree]: derivs[tree] for tree in treestrs}
+        parsetrees = {treestrs[tree]: parsetrees[tree] for tree in treestrs}
     if mpd and dopreduction:
         results = [(REMOVEIDS.sub('', treestr), logprobsum(probs),
                     fragmentsinderiv(derivs[treestr], chart, backtransform))
@@ -235,8 +344,7 @@ cpdef marginalize(method, list derivations, list entries, Chart chart,
                    for treestr, probs in parsetrees.items()]
 
     msg = '%d derivations, %d parsetrees' % (
-        len(derivations if dopreduction else entries),
-        len(parsetrees))
+        len(derivations if dopreduction else entries), numtrees)
     return results, msg
 
 
@@ -341,6 +449,139 @@ cdef maxconstituentscorrect(list derivations, Chart chart,
                  None)], 'sentprob: %g' % sentprob
 
 
+cdef tuple chartdecode(Chart chart, bint maxrule, double labda,
+                       set labels=None):
+    """Select a parse tree with posterior probabilities from the chart.
+
+    Posterior probabilities of labeled spans and edges are obtained with
+    inside-outside, after which the labels of a DOP reduction are projected
+    to the original treebank labels by stripping ``@n`` annotations. Unlike
+    the objectives based on *k*-best derivations, the result is exact and
+    takes time linear in the size of the chart.
+
+    :param maxrule: if True, select the parse tree with the maximal product
+        of the posterior probabilities of its (projected) edges
+        (Max-Rule-Product; Petrov & Klein 2007); otherwise select the parse
+        tree with the most constituents correct (Goodman 1996).
+    :param labda: for MCC, the weight of the mistake rate vs. recall rate.
+    :param labels: for MCC, the set of labels to optimize for."""
+    cdef ForestEdge * fedges = NULL
+    cdef ForestEdge * fedge
+    cdef size_t * offsets = NULL
+    cdef size_t n, m, numitems, numedges = 0
+    cdef double[:] inside, outside
+    cdef double sentprob, post, score
+    cdef dict index = {}, projids = {}, projlabels = {}, best = {}
+    cdef list items, pid, posts = [], projedges = [], projkeys = []
+    cdef ChartItem span
+    cdef int p
+    items, insidearr, outsidearr, sentprob = insideoutside(chart)
+    inside, outside = insidearr, outsidearr
+    if isinf(sentprob):
+        return [], 'no complete derivations in chart.'
+    numitems = len(items)
+    pid = [None] * numitems
+    # project items to (label, span) pairs and collect their posteriors
+    for n in range(numitems):
+        item = items[n]
+        index[item] = n
+        label = chart.label(item)
+        if label not in projlabels:
+            projlabels[label] = REMOVEIDS.sub('', chart.grammar.tolabel[label])
+        span = chart.asChartItem(item)
+        span.label = 0
+        key = projlabels[label], span
+        if key not in projids:
+            projids[key] = len(projkeys)
+            projkeys.append(key)
+            posts.append(0.0)
+            projedges.append({})
+        p = pid[n] = projids[key]
+        posts[p] += exp(inside[n] + outside[n] - sentprob)
+    root = pid[index[chart.root()]]
+    # project edges; an edge is identified by the projected items of its
+    # children, or (-1, idx) for a lexical edge.
+    offsets = <size_t *>malloc((numitems + 1) * sizeof(size_t))
+    if offsets is NULL:
+        raise MemoryError
+    try:
+        fedges = flattenforest(chart, items, index, offsets, &numedges)
+        for n in range(numitems):
+            if isinf(outside[n]):
+                continue
+            edges = projedges[pid[n]]
+            for m in range(offsets[n], offsets[n + 1]):
+                fedge = &(fedges[m])
+                post = exp(outside[n] + edgeinside(fedge, inside) - sentprob)
+                if post == 0.0:
+                    continue
+                if fedge.left == UINT32_MAX:
+                    key = (-1, chart.lexidx(fedge.edge))
+                elif fedge.right == UINT32_MAX:
+                    key = (pid[fedge.left], -1)
+                else:
+                    key = (pid[fedge.left], pid[fedge.right])
+                edges[key] = edges.get(key, 0.0) + post
+    finally:
+        free(fedges)
+        free(offsets)
+    # the score of a constituent for MCC
+    if not maxrule:
+        for p, (label, _) in enumerate(projkeys):
+            if '|<' in label or (labels is not None and label not in labels):
+                posts[p] = 0.0
+            else:
+                posts[p] = posts[p] - labda * (1 - posts[p])
+    score = projectedviterbi(root, projedges, posts, best, maxrule)
+    if isinf(score):
+        return [], 'no complete derivations in chart.'
+    return [(projectedtree(root, projkeys, best),
+             exp(score) if maxrule else score, None)], (
+            'sentprob: %g, %d labeled spans' % (exp(sentprob), len(projkeys)))
+
+
+cdef double projectedviterbi(int p, list projedges, list scores, dict best,
+                             bint maxrule) except? -1:
+    """Find the best subtree for projected item ``p``.
+
+    Backpointers are stored in ``best``. With ``maxrule``, the score is the sum
+    of the log posteriors of edges; otherwise, the sum of the scores of the
+    constituents."""
+    cdef double score, bestscore = -INFINITY
+    cdef int left, right
+    if p in best:
+        return best[p][0]
+    best[p] = (-INFINITY, None)  # guard against unary cycles
+    bestkey = None
+    for key, post in (<dict>projedges[p]).items():
+        left, right = key
+        score = log(post) if maxrule else 0.0
+        if left != -1:
+            score += projectedviterbi(left, projedges, scores, best, maxrule)
+            if right != -1:
+                score += projectedviterbi(
+                        right, projedges, scores, best, maxrule)
+        if score > bestscore:
+            bestscore, bestkey = score, key
+    if not maxrule:
+        bestscore += scores[p]
+    best[p] = (bestscore, bestkey)
+    return bestscore
+
+
+cdef str projectedtree(int p, list projkeys, dict best):
+    """Build the tree string for projected item ``p`` from backpointers."""
+    cdef int left, right
+    label = projkeys[p][0]
+    left, right = best[p][1]
+    if left == -1:
+        return '(%s %d)' % (label, right)
+    elif right == -1:
+        return '(%s %s)' % (label, projectedtree(left, projkeys, best))
+    return '(%s %s %s)' % (label, projectedtree(left, projkeys, best),
+                           projectedtree(right, projkeys, best))
+
+
 def gettree(cells, span):
     """Extract parse tree from most constituents correct table."""
     if span not in cells:
@@ -369,7 +610,7 @@ cdef sldop(dict derivations, Chart chart, list sent, list tags,
 
     NB: doesn't seem to work so well, so may contain a subtle bug.
             Does not support PCFG charts."""
-    cdef dict derivs = {}
+    cdef dict derivs = {}, cache = {}
     # collect derivations for each parse tree
     derivsfortree = defaultdict(set)
     if backtransform is None:
@@ -385,7 +626,7 @@ cdef sldop(dict derivations, Chart chart, list sent, list tags,
                              None)
             derivations[deriv] = (< DoubleEntry > entry).value
             derivsfortree[recoverfragments((< DoubleEntry > entry).key, chart,
-                                           backtransform)].add(deriv)
+                                           backtransform, cache)].add(deriv)
     # sum over probs of derivations to get probs of parse trees
     parsetreeprob = {tree: logprobsum([-derivations[d] for d in ds])
                      for tree, ds in derivsfortree.items()}
@@ -394,7 +635,7 @@ cdef sldop(dict derivations, Chart chart, list sent, list tags,
 
     model = chart.grammar.modelnames[chart.grammar.currentmodel]
     chart.grammar.switch(u'shortest', logprob=True)
-    shortestderivations, unused_explored, chart2 = treeparsing(
+    shortestderivations, _, chart2 = treeparsing(
         nmostlikelytrees, sent, chart.grammar, m, backtransform, tags)
     if not chart2.rankededges.get(chart2.root()):
         return [], 'SL-DOP couldn\'t find parse for tree'
@@ -433,7 +674,7 @@ cdef sldop_simple(dict derivations, list entries, int sldop_n,
     derivation among the list of available derivations, instead of finding the
     shortest among all possible derivations using Viterbi."""
     cdef DoubleEntry entry
-    cdef dict derivs = {}, keys = {}
+    cdef dict derivs = {}, keys = {}, cache = {}
     derivsfortree = defaultdict(set)
     # collect derivations for each parse tree
     if backtransform is None:
@@ -447,7 +688,7 @@ cdef sldop_simple(dict derivations, list entries, int sldop_n,
     else:
         for entry in entries:
             deriv = getderiv(chart.root(), entry.key, chart, '}<')
-            tree = recoverfragments(entry.key, chart, backtransform)
+            tree = recoverfragments(entry.key, chart, backtransform, cache)
             keys[deriv] = entry.key
             derivations[deriv] = entry.value
             derivsfortree[tree].add(deriv)
@@ -475,12 +716,17 @@ cdef sldop_simple(dict derivations, list entries, int sldop_n,
     return [(tree, result[tree], derivs[tree]) for tree in result], msg
 
 
-cpdef str recoverfragments(deriv, Chart chart, list backtransform):
+cpdef str recoverfragments(deriv, Chart chart, list backtransform,
+                           dict cache=None):
     """Reconstruct a DOP derivation from a derivation with flattened fragments.
 
     :param deriv: a RankedEdge or a string representing a derivation.
     :param backtransform: a list with fragments (as string templates)
             corresponding to grammar rules.
+    :param cache: optionally, a dictionary in which the expanded
+            subderivations of RankedEdges are stored; k-best derivations
+            share most of their subderivations, so when the same dictionary is
+            passed for each derivation of a chart, these are expanded once.
     :returns: expanded derivation as a string.
 
     The flattened fragments in the derivation should be left-binarized, expect
@@ -494,7 +740,7 @@ cpdef str recoverfragments(deriv, Chart chart, list backtransform):
     been called on `chart.grammar`, even when not doing coarse-to-fine
     parsing."""
     if isinstance(deriv, RankedEdge):
-        result = recoverfragments_(deriv, chart, backtransform)
+        result = recoverfragments_(deriv, chart, backtransform, cache)
     elif isinstance(deriv, str):
         deriv = Tree(deriv)
         result = recoverfragments_str(deriv, chart, backtransform)
@@ -504,12 +750,52 @@ cpdef str recoverfragments(deriv, Chart chart, list backtransform):
 
 
 cdef str recoverfragments_(RankedEdge deriv, Chart chart,
-                           list backtransform):
-    cdef RankedEdge child
-    cdef list children = []
-    cdef str frag = backtransform[deriv.edge.rule.no]  # template
-    # NB: this is the only code that uses the .head field of RankedEdge
+                           list backtransform, dict cache):
+    cdef RankedEdge child, key = deriv
+    cdef list children
+    cdef str frag, result
+    if cache is not None:
+        result = cache.get(key)
+        if result is not None:
+            return result
+    frag = backtransform[deriv.edge.rule.no]  # template
+    # recursively expand all substitution sites
+    # NB: this and treehash_() are the only code that uses the .head field of
+    # RankedEdge
+    children = ['(%s %d)' % (chart.grammar.tolabel[chart.label(child.head)],
+                             chart.lexidx(child.edge)) if child.edge.rule is NULL
+                else recoverfragments_(child, chart, backtransform, cache)
+                for child in fragmentchildren(deriv, chart)]
 
+    # substitute results in template
+    result = frag.format(*children)
+    if cache is not None:
+        cache[key] = result
+    return result
+
+    # even better: build result incrementally; use a list of strings
+    # extended in recursive calls w/strings from backtransform.
+    # step 1: collect RankedEdges in a list (children);
+    # 		i.e., exctract nodes from binarized constituent.
+    # step 2: iterate over parts of template, alternately adding string from it
+    # 		and making a recursive call to insert the relevant child RankedEdge
+    # new backtransform format:
+    # backtransform[prod] = (list_of_strs, list_of_idx)
+    # backtransform[34] = (['(NP (DT ', ') (NN ', '))'], [0, 1])
+    # alternatively: (better locality?)
+    # frag = backtransform[34] = ['(NP (DT ', 0, ') (NN ', 1, '))']
+    # result += frag[0]
+    # for n in range(1, len(result), 2):
+    # 	foo(result, children[frag[n]])
+    # 	result += frag[n + 1]
+
+
+cdef list fragmentchildren(RankedEdge deriv, Chart chart):
+    """Collect the RankedEdges for the substitution sites of a fragment.
+
+    Performs on-the-fly debinarization of the flattened fragment; the result
+    is in the order of the indices in the template of the fragment."""
+    cdef list children = []
     # collect all children w/on the fly left-factored debinarization
     if deriv.edge.rule.rhs2:  # is there a right child?
         # keep going while left child is part of same binarized constituent
@@ -532,31 +818,8 @@ cdef str recoverfragments_(RankedEdge deriv, Chart chart,
     # left-most child
     children.append((< DoubleEntry > chart.rankededges[
                     chart.left(deriv)][deriv.left]).key)
-
-    # recursively expand all substitution sites
-    children = ['(%s %d)' % (chart.grammar.tolabel[chart.label(child.head)],
-                             chart.lexidx(child.edge)) if child.edge.rule is NULL
-                else recoverfragments_(child, chart, backtransform)
-                for child in reversed(children)]
-
-    # substitute results in template
-    return frag.format(*children)
-
-    # even better: build result incrementally; use a list of strings
-    # extended in recursive calls w/strings from backtransform.
-    # step 1: collect RankedEdges in a list (children);
-    # 		i.e., exctract nodes from binarized constituent.
-    # step 2: iterate over parts of template, alternately adding string from it
-    # 		and making a recursive call to insert the relevant child RankedEdge
-    # new backtransform format:
-    # backtransform[prod] = (list_of_strs, list_of_idx)
-    # backtransform[34] = (['(NP (DT ', ') (NN ', '))'], [0, 1])
-    # alternatively: (better locality?)
-    # frag = backtransform[34] = ['(NP (DT ', 0, ') (NN ', 1, '))']
-    # result += frag[0]
-    # for n in range(1, len(result), 2):
-    # 	foo(result, children[frag[n]])
-    # 	result += frag[n + 1]
+    children.reverse()
+    return children
 
 
 cdef str recoverfragments_str(deriv, Chart chart, list backtransform):
@@ -590,6 +853,95 @@ cdef str recoverfragments_str(deriv, Chart chart, list backtransform):
     return frag.format(*children)
 
 
+cdef uint64_t TREEHASHBASE = 0x100000001b3UL
+
+
+cdef inline uint64_t strhash(str s):
+    """Polynomial hash of a string; cf. treehash()."""
+    cdef uint64_t result = 0
+    cdef Py_UCS4 ch
+    for ch in s:
+        result = result * TREEHASHBASE + <uint64_t>ch
+    return result
+
+
+cdef inline uint64_t hashpower(size_t n):
+    """Return ``TREEHASHBASE ** n`` (modulo 2 ** 64)."""
+    cdef uint64_t result = 1, base = TREEHASHBASE
+    while n:
+        if n & 1:
+            result *= base
+        base *= base
+        n >>= 1
+    return result
+
+
+cpdef treehash(RankedEdge deriv, Chart chart, list backtransform,
+               dict cache=None, dict templates=None):
+    """Compute an integer hash of the tree produced by a Double-DOP derivation.
+
+    Equivalent to hashing the result of :func:`recoverfragments`, but
+    without creating the string: the hash is a polynomial hash, so the hash
+    of a concatenation follows from the hashes and lengths of its parts.
+    Hence, different derivations of the same tree get the same hash.
+
+    :param cache: optionally, a dictionary in which the hashes of
+            subderivations are stored; cf. :func:`recoverfragments`.
+    :param templates: optionally, a dictionary in which the parsed templates
+            of ``backtransform`` are stored.
+    :returns: an integer."""
+    cdef uint64_t result
+    cdef size_t length
+    result, length = treehash_(deriv, chart, backtransform,
+                               {} if cache is None else cache,
+                               {} if templates is None else templates)
+    return result + length * 0x9E3779B97F4A7C15UL
+
+
+cdef tuple treehash_(RankedEdge deriv, Chart chart, list backtransform,
+                     dict cache, dict templates):
+    """Return hash and length of the string of the tree for a derivation."""
+    cdef RankedEdge child, key = deriv
+    cdef list children
+    cdef tuple template, part, cached
+    cdef uint64_t result = 0, childhash
+    cdef size_t length = 0, childlength
+    cdef str label
+    # use a different key than recoverfragments_(), to share the cache.
+    cached = cache.get((key, ))
+    if cached is not None:
+        return cached
+    template = templates.get(deriv.edge.rule.no)
+    if template is None:
+        # literal parts of template, and indices of the children following
+        # them; word tags are stripped as in recoverfragments().
+        template = templates[deriv.edge.rule.no] = tuple([
+            (strhash(REMOVEWORDTAGS.sub('', literal)), len(
+                REMOVEWORDTAGS.sub('', literal)),
+             -1 if field is None else int(field))
+            for literal, field, _, _ in FORMATTER.parse(
+                backtransform[deriv.edge.rule.no])])
+    children = fragmentchildren(deriv, chart)
+    for part in template:
+        result = result * hashpower(part[1]) + <uint64_t>part[0]
+        length += <size_t>part[1]
+        if part[2] == -1:
+            continue
+        child = children[part[2]]
+        if child.edge.rule is NULL:
+            label = REMOVEWORDTAGS.sub('', '(%s %d)' % (
+                chart.grammar.tolabel[chart.label(child.head)],
+                chart.lexidx(child.edge)))
+            childhash, childlength = strhash(label), len(label)
+        else:
+            childhash, childlength = treehash_(
+                child, chart, backtransform, cache, templates)
+        result = result * hashpower(childlength) + childhash
+        length += childlength
+    cache[(key, )] = result, length
+    return result, length
+
+
 def fragmentsinderiv(deriv, chart, list backtransform):
     """Extract the list of fragments that were used in a given derivation.
 
@@ -726,6 +1078,8 @@ def treeparsing(trees, sent, Grammar grammar, int m, backtransform, tags=None,
             Exploits rulemapping of grammar which should be mapped to itself;
             e.g., 'NP@2 => DT@3 NN' should be mapped to 'NP => DT NN' in the
             same grammar. To remove the mask, issue ``grammar.setmask(None)``
+    :returns: a tuple ``(derivations, numcandidates, chart)`` as with
+        ``lazykbest()``; on failure, ``([], msg, None)``.
     """
     # Parsing & pruning inside the disambiguation module is rather kludgy,
     # but the problem is that we need to get probabilities of trees,
@@ -734,7 +1088,7 @@ def treeparsing(trees, sent, Grammar grammar, int m, backtransform, tags=None,
     cdef FatChartItem fitem
     cdef int n, lensent = len(sent)
     # cdef int selected = 0
-    whitelist = [set() for _ in grammar.toid]
+    whitelist = [SpanSet() for _ in grammar.toid]
     if maskrules:
         grammar.setmask([])  # block all rules
     for treestr in trees:
@@ -784,24 +1138,26 @@ def treeparsing(trees, sent, Grammar grammar, int m, backtransform, tags=None,
     return lazykbest(chart, m) + (chart, )
 
 
-cdef double getderivprob(RankedEdge deriv, Chart chart, list sent):
+cdef double getderivprob(RankedEdge deriv, Chart chart, list sent,
+                         double[:] probs):
     """Recursively calculate probability of a derivation.
 
     Useful to obtain probability of derivation under different probability
-    model of the same grammar."""
+    model of the same grammar; ``probs`` is a row of ``grammar.models``.
+    Returns a negative log probability."""
     cdef double result
     if deriv.edge.rule is NULL:  # is terminal
         label = chart.label(deriv.head)
         word = sent[chart.lexidx(deriv.edge)]
-        return (< LexicalRule > chart.grammar.lexicalbylhs[label][word]).prob
-    result = deriv.edge.rule.prob
+        return -log(probs[chart.grammar.lexruleno(label, word)])
+    result = -log(probs[deriv.edge.rule.no])
     result += getderivprob((< DoubleEntry > chart.rankededges[
         chart.left(deriv)][deriv.left]).key,
-        chart, sent)
+        chart, sent, probs)
     if deriv.edge.rule.rhs2:
         result += getderivprob((< DoubleEntry > chart.rankededges[
             chart.right(deriv)][deriv.right]).key,
-            chart, sent)
+            chart, sent, probs)
     return result
 
 cpdef viterbiderivation(Chart chart):
@@ -811,88 +1167,251 @@ cpdef viterbiderivation(Chart chart):
     return derivations[0]
 
 
-def getsamples(Chart chart, k, debin=None):
-    """Samples *k* derivations from a chart."""
-    cdef dict tables = {}
+cdef struct ForestEdge:  # an edge of a parse forest, for sampling & decoding
+    Edge * edge
+    double prob  # log probability of rule or lexical edge (negative log)
+    double score  # sampling: cumulative probability of this & preceding edges
+    uint32_t left, right  # index of child items, or UINT32_MAX if absent
+
+
+cdef ForestEdge * flattenforest(Chart chart, list items, dict index,
+                                size_t * offsets, size_t * numedges
+                                ) except NULL:
+    """Copy the parse forest of a chart to an array of edges.
+
+    Edges refer to items by their index in ``items``; edges with children
+    that are not in ``index`` are skipped. The edges of item ``n`` are
+    ``result[offsets[n]:offsets[n + 1]]``. The caller should free the result.
+    """
+    cdef ForestEdge * fedges
+    cdef ForestEdge * fedge
+    cdef ForestEdge * tmp
     cdef Edge * edge
     cdef Edges edges
     cdef MoreEdges * edgelist
-    cdef double prob, prev
-    cdef size_t n
-    chartidx = {}
-    for item in chart.getitems():
-        chartidx[item] = []
-        edges = chart.getedges(item)
-        edgelist = edges.head if edges is not None else NULL
-        while edgelist is not NULL:
-            for n in range(edges.len if edgelist is edges.head
-                           else EDGES_SIZE):
-                edge = &(edgelist.data[n])
-                # HACK: store pointer to edge as Python int
-                if edge.rule is NULL:
-                    chartidx[item].append(
-                        (chart.subtreeprob(item), < intptr_t > edge))
-                else:
-                    prob = edge.rule.prob
-                    # FIXME: work w/inside prob?
-                    # prob += chart.subtreeprob(chart._left(item, edge))
-                    # if edge.rule.rhs2:
-                    # 	prob += chart.subtreeprob(chart._right(item, edge))
-                    chartidx[item].append((prob, < intptr_t > edge))
-            edgelist = edgelist.prev
-        # sort edges so that highest prob (=lowest neglogprob) comes first
-        chartidx[item].sort()
-    for item in chartidx:
-        tables[item] = []
-        prev = 0.0
-        for prob, _ in chartidx[item]:
-            prev += exp(-prob)
-            tables[item].append(prev)
-    result = []
-    for _ in range(k):
-        result.append(samplechart(
-            chart.root(), chart, chartidx, tables, debin))
+    cdef size_t n, m, numitems = len(items), cap = 1024
+    fedges = <ForestEdge *>malloc(cap * sizeof(ForestEdge))
+    if fedges is NULL:
+        raise MemoryError
+    numedges[0] = 0
+    try:
+        for n in range(numitems):
+            item = items[n]
+            offsets[n] = numedges[0]
+            edges = chart.getedges(item)
+            edgelist = edges.head if edges is not None else NULL
+            while edgelist is not NULL:
+                for m in range(edges.len if edgelist is edges.head
+                               else EDGES_SIZE):
+                    edge = &(edgelist.data[m])
+                    if numedges[0] == cap:
+                        cap *= 2
+                        tmp = <ForestEdge *>realloc(
+                            fedges, cap * sizeof(ForestEdge))
+                        if tmp is NULL:
+                            raise MemoryError
+                        fedges = tmp
+                    fedge = &(fedges[numedges[0]])
+                    fedge.edge = edge
+                    fedge.score = 0.0
+                    fedge.left = fedge.right = UINT32_MAX
+                    if edge.rule is NULL:
+                        fedge.prob = chart.lexprob(item, edge)
+                    else:
+                        fedge.prob = edge.rule.prob
+                        leftitem = chart._left(item, edge)
+                        if leftitem not in index:
+                            continue
+                        fedge.left = index[leftitem]
+                        if edge.rule.rhs2:
+                            rightitem = chart._right(item, edge)
+                            if rightitem not in index:
+                                continue
+                            fedge.right = index[rightitem]
+                    numedges[0] += 1
+                edgelist = edgelist.prev
+        offsets[numitems] = numedges[0]
+    except:
+        free(fedges)
+        raise
+    return fedges
+
+
+cdef inline double edgeinside(ForestEdge * fedge, double[:] inside):
+    """Log probability of an edge and the inside probs of its children."""
+    cdef double x = -fedge.prob
+    if fedge.left != UINT32_MAX:
+        x += inside[fedge.left]
+        if fedge.right != UINT32_MAX:
+            x += inside[fedge.right]
+    return x
+
+
+def getsamples(Chart chart, k, debin=None):
+    """Samples *k* derivations from a chart.
+
+    An edge is chosen with probability proportional to the product of its
+    rule probability and the inside probabilities of its children, such that
+    derivations are sampled according to their probability. The parse forest
+    is first copied to an array of edges with cumulative distributions for
+    each item, after which the samples are drawn in a single C loop. Each
+    distinct derivation is converted to a string and ``RankedEdge`` objects
+    only once.
+
+    :returns: a list of *k* tuples ``(deriv, logprob)``; the corresponding
+        entries are appended to ``chart.rankededges[chart.root()]``."""
+    cdef ForestEdge * fedges = NULL
+    cdef size_t * offsets = NULL
+    cdef uint32_t * seqs = NULL
+    cdef uint32_t * stack = NULL
+    cdef uint32_t * tmpseq
+    cdef size_t * starts = NULL
+    cdef double[:] inside, rnds
+    cdef double total, x
+    cdef size_t n, m, lo, hi, numitems, numedges = 0
+    cdef size_t seqlen = 0, seqcap = 1024, top, start, nextrnd, s
+    cdef size_t numsamples = k
+    cdef uint32_t root
+    cdef dict index = {}, derivs = {}
+    cdef list result = [], lists, items
+    cdef DoubleEntry entry
+    if chart.rankededges is None:
+        chart.rankededges = {}
+    items, insidearr, _, _ = insideoutside(chart)
+    inside = insidearr
+    numitems = len(items)
+    for n, item in enumerate(items):
+        index[item] = n
+    root = index[chart.root()]
+    offsets = <size_t *>malloc((numitems + 1) * sizeof(size_t))
+    seqs = <uint32_t *>malloc(seqcap * sizeof(uint32_t))
+    stack = <uint32_t *>malloc((numitems + 2) * sizeof(uint32_t))
+    starts = <size_t *>malloc((numsamples + 1) * sizeof(size_t))
+    try:
+        if (offsets is NULL or seqs is NULL or stack is NULL
+                or starts is NULL):
+            raise MemoryError
+        fedges = flattenforest(chart, items, index, offsets, &numedges)
+        # cumulative probabilities of edges; edges that are not part of a
+        # complete derivation get probability zero.
+        for n in range(numitems):
+            total = 0.0
+            for m in range(offsets[n], offsets[n + 1]):
+                x = edgeinside(&(fedges[m]), inside)
+                if not isinf(x):
+                    total += exp(x - inside[n])
+                fedges[m].score = total
+        if (offsets[root] == offsets[root + 1]
+                or fedges[offsets[root + 1] - 1].score == 0.0):
+            raise ValueError('no complete derivations in chart.')
+        # sample derivations; a derivation is stored as the sequence of its
+        # edges in pre-order.
+        rnds = np.random.random(max(64, 2 * numitems))
+        nextrnd = 0
+        for s in range(numsamples):
+            starts[s] = seqlen
+            stack[0], top = root, 1
+            while top:
+                top -= 1
+                n = stack[top]
+                if seqlen - starts[s] > numitems:
+                    # a (unary) cycle; reject this sample and start over
+                    seqlen, stack[0], top = starts[s], root, 1
+                    continue
+                if nextrnd == len(rnds):
+                    rnds = np.random.random(len(rnds))
+                    nextrnd = 0
+                # find first edge with cumulative probability > x
+                lo, hi = offsets[n], offsets[n + 1] - 1
+                x = rnds[nextrnd] * fedges[hi].score
+                nextrnd += 1
+                while lo < hi:
+                    m = (lo + hi) // 2
+                    if fedges[m].score > x:
+                        hi = m
+                    else:
+                        lo = m + 1
+                if seqlen == seqcap:
+                    seqcap *= 2
+                    tmpseq = <uint32_t *>realloc(
+                        seqs, seqcap * sizeof(uint32_t))
+                    if tmpseq is NULL:
+                        raise MemoryError
+                    seqs = tmpseq
+                seqs[seqlen] = lo
+                seqlen += 1
+                # push right child first, such that left child is expanded
+                # first
+                if fedges[lo].right != UINT32_MAX:
+                    stack[top] = fedges[lo].right
+                    top += 1
+                if fedges[lo].left != UINT32_MAX:
+                    stack[top] = fedges[lo].left
+                    top += 1
+        starts[numsamples] = seqlen
+        # convert each distinct derivation to a string and RankedEdges
+        lists = [None] * numitems
+        for s in range(numsamples):
+            key = (<char *>&(seqs[starts[s]]))[
+                :(starts[s + 1] - starts[s]) * sizeof(uint32_t)]
+            if key in derivs:
+                entry, deriv = derivs[key]
+                chart.rankededges[items[root]].append(entry)
+            else:
+                start = starts[s]
+                deriv, _ = expandsample(root, seqs, &start, fedges, items,
+                                        lists, chart, debin)
+                entry = lists[root][len(lists[root]) - 1]
+                derivs[key] = entry, deriv
+            result.append((deriv, entry.value))
+    finally:
+        free(fedges)
+        free(offsets)
+        free(seqs)
+        free(stack)
+        free(starts)
     return result
 
 
-cdef samplechart(item, Chart chart,
-                 dict chartidx, dict tables, str debin):
-    """Samples a derivation from a chart."""
-    cdef Edge * edge
-    cdef RankedEdge rankededge
+cdef tuple expandsample(uint32_t n, uint32_t * seq, size_t * pos,
+                        ForestEdge * fedges, list items, list lists,
+                        Chart chart, str debin):
+    """Convert a sampled derivation to a string and RankedEdges.
+
+    :param pos: the position in ``seq`` of the edge for item ``n``; is
+        advanced past the edges of this subtree.
+    :returns: tuple ``(deriv, logprob)`` for the subtree."""
+    cdef ForestEdge * fedge = &(fedges[seq[pos[0]]])
+    cdef int left = -1, right = -1
     cdef double prob
-    cdef list lst = tables[item]
-    rnd = random() * lst[len(lst) - 1]
-    idx = bisect_right(lst, rnd)
-    _, ptr = chartidx[item][idx]
-    edge = <Edge * > < intptr_t > ptr  # hack: convert Python int into pointer
-    label = chart.label(item)
-    if edge.rule is NULL:  # terminal
-        idx = chart.lexidx(edge)
-        rankededge = new_RankedEdge(item, edge, -1, -1)
-        chart.rankededges.setdefault(item, []).append(
-            new_DoubleEntry(rankededge, chart.subtreeprob(item), 0))
-        deriv = '(%s %d)' % (chart.grammar.tolabel[label], idx)
-        return deriv, chart.subtreeprob(item)
-    tree, p1 = samplechart(chart.copy(chart._left(item, edge)),
-                           chart, chartidx, tables, debin)
-    prob = edge.rule.prob + p1
-    if edge.rule.rhs2:
-        tree2, p2 = samplechart(chart.copy(chart._right(item, edge)),
-                                chart, chartidx, tables, debin)
-        tree += ' ' + tree2
-        prob += p2
-    if debin is None or debin not in chart.grammar.tolabel[label]:
-        tree = '(%s %s)' % (chart.grammar.tolabel[label], tree)
+    cdef str tree, tree2, label
+    pos[0] += 1
+    item = items[n]
+    label = chart.grammar.tolabel[chart.label(item)]
+    if fedge.edge.rule is NULL:  # terminal
+        tree = '(%s %d)' % (label, chart.lexidx(fedge.edge))
+        prob = chart.subtreeprob(item)
+    else:
+        prob = fedge.prob
+        tree, p1 = expandsample(fedge.left, seq, pos, fedges, items, lists,
+                                chart, debin)
+        prob += p1
+        left = len(lists[fedge.left]) - 1
+        if fedge.right != UINT32_MAX:
+            tree2, p2 = expandsample(fedge.right, seq, pos, fedges, items,
+                                     lists, chart, debin)
+            tree += ' ' + tree2
+            prob += p2
+            right = len(lists[fedge.right]) - 1
+        if debin is None or debin not in label:
+            tree = '(%s %s)' % (label, tree)
+    if lists[n] is None:
+        lists[n] = chart.rankededges.setdefault(item, [])
     # create an edge that has as children the edges that were just created
     # by our recursive calls
-    rankededge = new_RankedEdge(item, edge,
-                                len(chart.rankededges[chart._left(item, edge)]) - 1,
-                                (len(chart.rankededges[chart._right(item, edge)]) - 1)
-                                if edge.rule.rhs2 else -1)
     # NB: this is actually 'samplededges', not 'rankededges'
-    chart.rankededges.setdefault(item, []).append(
-        new_DoubleEntry(rankededge, prob, 0))
+    (<list>lists[n]).append(new_DoubleEntry(
+        new_RankedEdge(item, fedge.edge, left, right), prob, 0))
     return tree, prob
 
 
@@ -936,9 +1455,10 @@ def dopparseprob(tree, sent, Grammar coarse, Grammar fine):
     cdef dict chart = {}  # chart[bitset][label] = prob
     cdef dict cell  # chart[bitset] = cell; cell[label] = prob
     cdef ProbRule * rule
-    cdef LexicalRule lexrule
     cdef object n  # pyint
     cdef str pos
+    cdef int wordid
+    cdef uint32_t m, lhs
     if not fine.logprob:
         raise ValueError('Grammar should have log probabilities.')
     # Log probabilities are not ideal here because we do lots of additions,
@@ -949,13 +1469,15 @@ def dopparseprob(tree, sent, Grammar coarse, Grammar fine):
     for n, pos in tree.pos():
         word = sent[n]
         chart[1 << n] = cell = {}
-        if word not in fine.lexicalbyword:
+        wordid = fine.wordid(word)
+        if wordid == -1:
             cell[fine.toid[pos]] = -0.0
             continue
-        for lexrule in fine.lexicalbyword[word]:
-            if (fine.tolabel[lexrule.lhs] == pos
-                    or fine.tolabel[lexrule.lhs].startswith(pos + '@')):
-                cell[lexrule.lhs] = -lexrule.prob
+        for m in range(fine.lexwordidx[wordid], fine.lexwordidx[wordid + 1]):
+            lhs = fine.lexlhs[m]
+            if (fine.tolabel[lhs] == pos
+                    or fine.tolabel[lhs].startswith(pos + '@')):
+                cell[lhs] = -fine.lexprobs[m]
 
     # do post-order traversal (bottom-up)
     for node, (r, yf) in list(zip(tree.subtrees(),
@@ -1096,5 +1618,6 @@ def test():
 
 
 __all__ = ['getderivations', 'marginalize', 'gettree', 'recoverfragments',
+           'treehash',
            'fragmentsinderiv', 'treeparsing', 'viterbiderivation', 'getsamples',
            'doprerank', 'dopparseprob', 'frontiernt', 'splitfrag']
@@ -9,8 +9,14 @@ The latter ported almost directly from rparse
 (except for sign reversal of log probs)."""
 
 from __future__ import print_function
+import io
+import os
+import logging
+import zipfile
+from collections import OrderedDict
 from math import exp
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
 from libc.math cimport isnan, isfinite
 from libc.stdint cimport uint8_t, uint32_t, uint64_t
@@ -228,8 +234,12 @@ cdef inline uint64_t insideconcat(uint64_t a, uint64_t b, ProbRule rule,
 
 
 def outsidelr(Grammar grammar, double[:, :] insidescores,
-              uint32_t maxlen, uint32_t goal, double[:, :, :, :] outside):
-    """Compute the outside SX simple LR estimate in top down fashion."""
+              uint32_t maxlen, uint32_t goal, double[:, :, :, :] outside,
+              lengths=None):
+    """Compute the outside SX simple LR estimate in top down fashion.
+
+    :param lengths: if given, only compute estimates for sentences with these
+        lengths; otherwise, for all lengths up to ``maxlen``."""
     cdef DoubleAgenda agenda = DoubleAgenda()
     cdef DoubleEntry entry
     cdef Item I
@@ -240,19 +250,19 @@ def outsidelr(Grammar grammar, double[:, :] insidescores,
     cdef size_t i
     cdef bint stopaddleft, stopaddright
 
-    for n in range(1, maxlen + 1):
+    for n in (range(1, maxlen + 1) if lengths is None else lengths):
         agenda[new_Item(goal, n, 0, 0)] = 0.0
         outside[goal, n, 0, 0] = 0.0
-    print("initialized")
+    logging.debug('initialized')
 
     while agenda.length:
         entry = agenda.popentry()
         I = entry.key
         x = entry.value
         if agenda.length % 10000 == 0:
-            print('agenda size: %dk top: %r, %g %s' % (
-                agenda.length / 1000, I, exp(-x),
-                grammar.tolabel[I.state]))
+            logging.debug('agenda size: %dk top: %r, %g %s',
+                          agenda.length / 1000, I, exp(-x),
+                          grammar.tolabel[I.state])
         totlen = I.length + I.lr + I.gaps
         i = 0
         rule = grammar.bylhs[I.state][i]
@@ -286,7 +296,9 @@ def outsidelr(Grammar grammar, double[:, :] insidescores,
             for lenA in range(leftfanout, I.length - rightfanout + 1):
                 lenB = I.length - lenA
                 insidescore = insidescores[rule.rhs2, lenB]
-                for lr in range(I.lr, I.lr + lenB + 2):  # FIXME: why 2?
+                # the context of A consists of the context of X, and the
+                # material of B and the gaps of X that are not gaps of A.
+                for lr in range(I.lr, totlen - lenA + 1):
                     if addright == 0 and lr != I.lr:
                         continue
                     for ga in range(leftfanout - 1, totlen + 1):
@@ -321,7 +333,7 @@ def outsidelr(Grammar grammar, double[:, :] insidescores,
             for lenA in range(rightfanout, I.length - leftfanout + 1):
                 lenB = I.length - lenA
                 insidescore = insidescores[rule.rhs1, lenB]
-                for lr in range(I.lr, I.lr + lenB + 2):  # FIXME: why 2?
+                for lr in range(I.lr, totlen - lenA + 1):
                     for ga in range(rightfanout - 1, totlen + 1):
                         if (lenA + lr + ga == I.length + I.lr + I.gaps
                                 and ga >= addgaps):
@@ -337,6 +349,151 @@ def outsidelr(Grammar grammar, double[:, :] insidescores,
     # end while agenda.length:
 
 
+class OutsideEstimates(object):
+    """Outside SX estimates with left, right and gaps context for a PLCFRS.
+
+    The estimates are computed on demand for each sentence length. For a
+    sentence of length ``n``, the parser only queries estimates for items
+    ``(label, length, lr, gaps)`` with ``length + lr + gaps == n``, because the
+    estimates for different sentence lengths are independent. Therefore a table
+    of shape ``(nonterminals, n + 1, n + 1)`` is stored for each sentence
+    length that is encountered, instead of a single table of shape
+    ``(nonterminals, maxlen + 1, maxlen + 1, maxlen + 1)``.
+
+    Can be passed to ``plcfrs.parse()`` as
+    ``estimates=('SXlrgaps', outside)``; the table for the length of the
+    sentence is then selected (and computed if necessary) automatically.
+
+    :param grammar: the grammar for which estimates are computed.
+    :param goal: label id of the root node.
+    :param maxbytes: if nonzero, the maximum number of bytes of tables to keep
+        in memory; when exceeded, the least recently used tables are evicted.
+        Evicted tables are loaded again from the file they were read from, or
+        recomputed."""
+
+    def __init__(self, Grammar grammar, uint32_t goal, maxbytes=0):
+        self.grammar = grammar
+        self.goal = goal
+        self.maxbytes = maxbytes
+        self.inside = None
+        self.tables = OrderedDict()  # in order of least recent use
+        self.filename = None  # an .npz file from which tables are loaded
+        self.stored = None  # the opened file, if opened by process self.pid
+        self.pid = None
+
+    def getinside(self, uint32_t maxlen):
+        """Return inside estimates for lengths up to at least ``maxlen``."""
+        if self.inside is None or self.inside.shape[1] <= maxlen:
+            if self.inside is not None:
+                maxlen = max(maxlen, 2 * (self.inside.shape[1] - 1))
+            self.inside = np.empty((self.grammar.nonterminals, maxlen + 1),
+                                   dtype='d')
+            self.inside[...] = np.NAN
+            simpleinside(self.grammar, maxlen, self.inside)
+        return self.inside
+
+    def table(self, uint32_t n):
+        """Return the table of estimates for sentences of length ``n``.
+
+        :returns: an array indexed as ``[label, length, lr]``, where
+            ``gaps = n - length - lr``."""
+        stored = self.storedfile()
+        if n in self.tables:
+            table = self.tables.pop(n)
+        elif stored is not None and 'len%d' % n in stored.files:
+            table = stored['len%d' % n]
+        else:
+            table = np.empty((self.grammar.nonterminals, n + 1, n + 1),
+                             dtype='d')
+            table[...] = np.inf
+            outsidelr(self.grammar, self.getinside(n), n, self.goal,
+                      self.expand(table), lengths=(n, ))
+        self.tables[n] = table
+        if self.maxbytes:
+            nbytes = sum(a.nbytes for a in self.tables.values())
+            while nbytes > self.maxbytes and len(self.tables) > 1:
+                nbytes -= self.tables.popitem(last=False)[1].nbytes
+        return table
+
+    def forlength(self, uint32_t n):
+        """Return the estimates for sentences of length ``n``.
+
+        The result is indexed as ``[label, length, lr, gaps]``, as expected by
+        ``plcfrs.parse()``."""
+        return self.expand(self.table(n))
+
+    def lengths(self):
+        """Return the sentence lengths for which a table is available.
+
+        This includes tables stored in a file, but not those that would have to
+        be computed."""
+        stored = self.storedfile()
+        result = set(self.tables)
+        if stored is not None:
+            result.update(int(name[3:]) for name in stored.files
+                          if name.startswith('len'))
+        return sorted(result)
+
+    def storedfile(self):
+        """Return the opened file from which tables are loaded, or None.
+
+        The file is opened separately in each process; worker processes
+        created with fork would otherwise share the file descriptor and
+        offset of the parent, and corrupt each other's reads."""
+        if self.filename is None:
+            return None
+        if self.stored is None or self.pid != os.getpid():
+            self.stored = np.load(self.filename)
+            self.pid = os.getpid()
+        return self.stored
+
+    @staticmethod
+    def expand(table):
+        """Return a view of a table with a dimension for gaps added.
+
+        The value of the gaps index is ignored (it is implied by the length of
+        the sentence)."""
+        return as_strided(table, shape=table.shape + (table.shape[2], ),
+                          strides=table.strides + (0, ))
+
+    def tofile(self, filename, lengths=None):
+        """Store inside estimates and tables in a compressed ``.npz`` file.
+
+        :param lengths: the sentence lengths for which to store tables;
+            tables not yet available are computed. By default, the tables
+            returned by ``lengths()``. Tables are written one at a time, so
+            the memory bound is respected."""
+        if lengths is None:
+            lengths = self.lengths()
+        tmp = filename + '.tmp'
+        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as zf:
+            for name, value in [('goal', np.array(self.goal)),
+                                ('inside', self.getinside(max(lengths or [1])))
+                                ] + [('len%d' % n, None) for n in lengths]:
+                if value is None:
+                    value = self.table(int(name[3:]))
+                buf = io.BytesIO()
+                np.lib.format.write_array(buf, np.asanyarray(value))
+                zf.writestr(name + '.npy', buf.getvalue())
+        os.rename(tmp, filename)
+
+    @classmethod
+    def fromfile(cls, filename, Grammar grammar, maxbytes=0):
+        """Load estimates stored with ``tofile()``.
+
+        Tables are read from the file when they are first needed, so the file
+        should not be removed while the estimates are in use."""
+        data = np.load(filename)
+        try:
+            result = cls(grammar, int(data['goal']), maxbytes)
+            result.inside = data['inside']
+        finally:
+            data.close()
+        result.filename = filename
+        return result
+
+
 def getestimates(Grammar grammar, uint32_t maxlen, uint32_t goal):
     """Compute table of outside SX simple LR estimates for a PLCFRS."""
     print("allocating outside matrix:",
@@ -812,5 +969,5 @@ def test():
         print(item)
 
 
-__all__ = ['Item', 'getestimates', 'getpcfgestimates', 'inside', 'outsidelr',
-           'simpleinside']
+__all__ = ['Item', 'OutsideEstimates', 'getestimates', 'getpcfgestimates',
+           'inside', 'outsidelr', 'simpleinside']
@@ -5,6 +5,7 @@ import io
 import re
 import gzip
 import codecs
+import multiprocessing
 from operator import mul, itemgetter
 from collections import defaultdict, Counter
 from itertools import count, islice, repeat
@@ -14,7 +15,7 @@ except ImportError:
     from collections import OrderedDict
 from .tree import Tree, ImmutableTree, DiscTree, escape, unescape
 from .treebank import LEAVESRE
-from .util import openread
+from .util import openread, workerfunc, sharedpool
 from functools import reduce  # pylint: disable=redefined-builtin
 
 RULERE = re.compile(
@@ -22,6 +23,7 @@ RULERE = re.compile(
     r'(?P<WEIGHT1>(?P<FREQ1>[-.e0-9]+)(?:\/[0-9]+)?)$'
     r'|(?P<FREQ2>[-.e0-9]+)\t(?P<RULE2>(?P<LHS2>[^ \t]+).*)$')
 FRONTIERORTERM = re.compile(r"\(([^ ]+) (([0-9]+)=([^ ()]*)(?: [0-9]+=)*)\)")
+BINARIZATIONID = re.compile(r'}<([0-9]+)>')
 
 
 def lcfrsproductions(tree, sent, frontiers=False):
@@ -202,7 +204,8 @@ def doubledop(trees, sents, debug=False, binarized=True, maxdepth=1,
             `1 < depth < maxdepth`.
     :param maxfrontier: limit number of frontier non-terminals; not yet
             implemented.
-    :param iterate, complement, numproc: cf. fragments.recurringfragments()
+    :param iterate, complement, numproc: cf. fragments.recurringfragments();
+            ``numproc`` is also used to flatten fragments into rules.
     :returns: a tuple (grammar, altweights, backtransform, fragments)
             :grammar: a sequence of productions.
             :altweights: a dictionary containing alternate weights.
@@ -214,16 +217,17 @@ def doubledop(trees, sents, debug=False, binarized=True, maxdepth=1,
                                    indices=True, maxdepth=maxdepth, maxfrontier=maxfrontier,
                                    iterate=iterate, complement=complement)
     return dopgrammar(trees, fragments, debug=debug, binarized=binarized,
-                      extrarules=extrarules)
+                      extrarules=extrarules, numproc=numproc)
 
 
 def dop1(trees, sents, maxdepth=4, maxfrontier=999, binarized=True,
-         extrarules=None):
+         extrarules=None, numproc=1):
     """Return an all-fragments DOP1 model with relative frequencies.
 
     :param maxdepth: restrict fragments to `1 < depth < maxdepth`.
     :param maxfrontier: limit number of frontier non-terminals; not yet
             implemented.
+    :param numproc: number of processes to use for flattening fragments.
     :returns: a tuple (grammar, altweights, backtransform, fragments)
             :grammar: a sequence of productions.
             :altweights: a dictionary containing alternate weights.
@@ -233,10 +237,11 @@ def dop1(trees, sents, maxdepth=4, maxfrontier=999, binarized=True,
     from .fragments import allfragments
     fragments = allfragments(trees, sents, maxdepth, maxfrontier)
     return dopgrammar(trees, fragments, binarized=binarized,
-                      extrarules=extrarules)
+                      extrarules=extrarules, numproc=numproc)
 
 
-def dopgrammar(trees, fragments, binarized=True, extrarules=None, debug=False):
+def dopgrammar(trees, fragments, binarized=True, extrarules=None, debug=False,
+               numproc=1):
     """Create a DOP grammar from a set of fragments and occurrences.
 
     A second level of binarization (a normal form) is needed when fragments are
@@ -252,6 +257,8 @@ def dopgrammar(trees, fragments, binarized=True, extrarules=None, debug=False):
             this may be False when bitpar is used which applies its own
             binarization.
     :param extrarules: Additional rules to add to the grammar.
+    :param numproc: number of processes to use for flattening fragments;
+            cf. ``flattenfragments()``.
     :returns: a tuple (grammar, altweights, backtransform, fragments)
             altweights is a dictionary containing alternate weights."""
     def getweight(frag):
@@ -283,8 +290,8 @@ def dopgrammar(trees, fragments, binarized=True, extrarules=None, debug=False):
     # binarize, turn into LCFRS productions
     # use artificial markers of binarization as disambiguation,
     # construct a mapping of productions to fragments
-    for frag in fragments:
-        prods, newfrag = flatten(frag, ids, backtransform, binarized)
+    for (prods, newfrag), frag in zip(flattenfragments(
+            fragments, ids, backtransform, binarized, numproc), fragments):
         prod = prods[0]
         if prod[0][1] == 'Epsilon':  # lexical production
             grammar[prod] = getweight(frag)
@@ -339,7 +346,7 @@ def dopgrammar(trees, fragments, binarized=True, extrarules=None, debug=False):
         ewe=eweweights, bon=bonweights, shortest=shortest), fragments
 
 
-def compiletsg(fragments, binarized=True):
+def compiletsg(fragments, binarized=True, numproc=1):
     """Compile a set of weighted fragments (i.e., a TSG) into a grammar.
 
     Similar to dopgrammar(), only the values are weights instead of counts.
@@ -347,13 +354,16 @@ def compiletsg(fragments, binarized=True):
     :param fragments: a dictionary of fragments mapped to weights. The
             fragments must consist of strings in discbracket format.
     :param binarized: Whether the resulting grammar should be binarized.
+    :param numproc: number of processes to use for flattening fragments;
+            cf. ``flattenfragments()``.
     :returns: a ``(grammar, backtransform, altweights)`` tuple similar to what
             ``doubledop()`` returns; altweights will be empty."""
     grammar = {}
     backtransform = {}
     ids = UniqueIDs()
-    for frag, weight in fragments.items():
-        prods, newfrag = flatten(frag, ids, backtransform, binarized)
+    for (prods, newfrag), weight in zip(flattenfragments(
+            fragments, ids, backtransform, binarized, numproc),
+            fragments.values()):
         if prods[0][0][1] == 'Epsilon':  # lexical production
             grammar[prods[0]] = weight
             continue
@@ -389,6 +399,61 @@ def sortgrammar(grammar, altweights=None):
     return grammar, altweights
 
 
+def flattenfragments(fragments, ids, backtransform, binarized, numproc=1):
+    """Apply ``flatten()`` to a sequence of fragments, optionally in parallel.
+
+    Yields a tuple ``(prods, template)`` for each fragment, in order. The
+    caller is expected to add the first production of each non-lexical
+    fragment to ``backtransform`` before requesting the next result, as
+    ``flatten()`` consults it to keep these productions unique.
+
+    With multiple processes, each worker flattens fragments with its own IDs
+    and records the requests for IDs that were made; these requests are
+    replayed on ``ids`` in the order of the fragments, such that the result
+    is identical to flattening the fragments in a single process.
+
+    :param numproc: number of processes to use; pass 0 or None to use
+            detected # CPUs."""
+    if numproc == 1 or len(fragments) < 2:
+        for frag in fragments:
+            yield flatten(frag, ids, backtransform, binarized)
+        return
+    numproc = numproc or multiprocessing.cpu_count()
+    pool = sharedpool(numproc)
+    try:
+        results = pool.imap(flattenworker,
+                            ((frag, binarized) for frag in fragments),
+                            len(fragments) // (4 * numproc) + 1)
+        for frag, (prods, newfrag, keys) in zip(fragments, results):
+            if keys:  # assign IDs in the same order as flatten() would
+                newids = [next(ids) if key is None else ids[key]
+                          for key in keys]
+                prods = [(tuple(BINARIZATIONID.sub(
+                    lambda x: '}<%s>' % newids[int(x.group(1))], label)
+                    for label in rule), yf) for rule, yf in prods]
+            if frag.count(' ') != 1:  # not a lexical fragment
+                disambiguatefirstprod(prods, ids, backtransform)
+            yield prods, newfrag
+        pool.close()
+    except BaseException:  # also when the caller stops iterating early
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+@workerfunc
+def flattenworker(args):
+    """Flatten a fragment in a worker process; cf. ``flattenfragments()``.
+
+    :returns: a tuple ``(prods, template, keys)`` where ``keys`` is the
+            sequence of IDs that were requested from ``RecordingIDs``."""
+    frag, binarized = args
+    ids = RecordingIDs()
+    prods, newfrag = flatten(frag, ids, {}, binarized)
+    return prods, newfrag, ids.keys
+
+
 def flatten(frag, ids, backtransform, binarized):
     r"""Auxiliary function for Double-DOP.
 
@@ -472,6 +537,15 @@ def flatten(frag, ids, backtransform, binarized):
              for n, x in enumerate(FRONTIERORTERM.finditer(prod))}
     # mark substitution sites and ensure string.
     newtree = FRONTIERORTERM.sub(lambda x: order[x.group(2)], frag)
+    disambiguatefirstprod(prods, ids, backtransform)
+    return prods, newtree
+
+
+def disambiguatefirstprod(prods, ids, backtransform):
+    """Ensure that the first production of a flattened fragment is unique.
+
+    That is, it is not already used for another fragment in
+    ``backtransform``; modifies ``prods`` in-place."""
     prod = prods[0]
     if prod in backtransform:
         # normally, rules of fragments are disambiguated by binarization IDs.
@@ -486,7 +560,6 @@ def flatten(frag, ids, backtransform, binarized):
                  tuple((0,) for component in prod[1]
                        for a in component if a == 0))
         prods[:1] = [prod1, prod2]
-    return prods, newtree
 
 
 def nodefreq(tree, dectree, subtreefd, nonterminalfd):
@@ -621,6 +694,34 @@ class UniqueIDs(object):
     next = __next__
 
 
+class RecordingIDs(UniqueIDs):
+    """UniqueIDs which records for which keys IDs are produced.
+
+    ``keys`` contains for each ID the key it was produced for, or None when
+    it was produced as a fresh ID.
+
+    >>> ids = RecordingIDs()
+    >>> print(next(ids), ids['foo'], ids['foo'], next(ids))
+    0 1 1 2
+    >>> print(len(ids.keys), ids.keys[1])
+    3 foo"""
+
+    def __init__(self):
+        UniqueIDs.__init__(self)
+        self.keys = []  # key for each ID produced
+
+    def __getitem__(self, key):
+        if key not in self.ids:
+            self.keys.append(key)
+        return UniqueIDs.__getitem__(self, key)
+
+    def __next__(self):
+        self.keys.append(None)
+        return UniqueIDs.__next__(self)
+
+    next = __next__
+
+
 def rangeheads(s):
     """Return first element of each range in a sorted sequence of numbers.
 
@@ -4,183 +4,301 @@ Implementation of Huang & Chiang (2005): Better k-best parsing.
 http://www.cis.upenn.edu/~lhuang3/huang-iwpt-correct.pdf"""
 from __future__ import print_function
 from operator import itemgetter
-from .plcfrs import DoubleAgenda
 from .containers import ChartItem, RankedEdge, Grammar
 
 cimport cython
-from libc.stdint cimport uint32_t
+from libc.stdint cimport uint32_t, uint64_t
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memset
 from .containers cimport ChartItem, SmallChartItem, FatChartItem, \
     Grammar, ProbRule, Chart, Edge, Edges, MoreEdges, RankedEdge, \
     new_RankedEdge, CFGtoSmallChartItem, CFGtoFatChartItem
 from .pcfg cimport CFGChart, DenseCFGChart, SparseCFGChart
-from .plcfrs cimport DoubleEntry, DoubleAgenda, nsmallest, \
+from .plcfrs cimport DoubleEntry, \
     LCFRSChart, SmallLCFRSChart, FatLCFRSChart, new_DoubleEntry
 include "constants.pxi"
 
-cdef DoubleAgenda getcandidates(Chart chart, v, int k):
-    """:returns: a heap with up to k candidate arcs starting from vertex v."""
-    # NB: the priority queue should either do a stable sort, or should
-    # sort on rank vector as well to have ties resolved in FIFO order;
-    # otherwise the sequence (0, 0) -> (1, 0) -> (1, 1) -> (0, 1) -> (1, 1)
-    # can occur (given that the first two have probability x and the latter
-    # three probability y), in which case insertion order should count.
-    # Otherwise (1, 1) ends up in chart.rankededges[v] after which (0, 1)
-    # generates it as a neighbor and puts it in cand[v] for a second time.
-    cdef Edge * e
-    cdef Edges edges
-    cdef MoreEdges * edgelist
-    cdef double prob
-    cdef DoubleAgenda agenda = DoubleAgenda()
-    cdef size_t n
-    entries = []
-    # loop over blocks of edges
-    # compute viterbi prob from rule.prob + viterbi probs of children
-    edges = chart.getedges(v)
-    edgelist = edges.head if edges is not None else NULL
-    while edgelist is not NULL:
-        for n in range(edges.len if edgelist is edges.head
-                       else EDGES_SIZE):
-            e = &(edgelist.data[n])
-            if e.rule is NULL:
-                # there can only be one lexical edge for this combination of
-                # POS tag and terminal, use viterbi probability directly
-                prob = chart.subtreeprob(v)
-                left = right = -1
-            else:
-                left = right = 0
-                prob = e.rule.prob
-                prob += chart.subtreeprob(chart._left(v, e))
-                if e.rule.rhs2:  # unary rule?
-                    prob += chart.subtreeprob(chart._right(v, e))
-                else:
-                    right = -1
-            re = new_RankedEdge(v, e, left, right)
-            entries.append(new_DoubleEntry(re, prob, n))
-        edgelist = edgelist.prev
-    agenda.update_entries(nsmallest(k, entries))
-    return agenda
 
+cdef struct Candidate:  # a derivation: an edge with the ranks of its children
+    double prob  # log probability of the derivation
+    uint64_t order  # insertion order; ties are resolved in FIFO order
+    Edge * edge
+    uint32_t leftid, rightid  # vertex IDs of the children
+    int left, right  # rank of left / right child, or -1 if absent
 
-cdef lazykthbest(v, int k, int k1, dict cand, Chart chart, set explored,
-                 int depthlimit):
-    """"Explore up to *k*-best derivations headed by vertex *v*.
 
-    :param k1: the global k, with ``k <= k1``
-    :param cand: contains a queue of edges to consider for each vertex
-    :param explored: a set of all edges already visited."""
-    cdef DoubleEntry entry
-    cdef RankedEdge ej, ej1
-    cdef int ji
-    cdef bint inrankededges = v in chart.rankededges
-    # first visit of vertex v?
-    if v not in cand:
-        # initialize the heap
-        cand[v] = getcandidates(chart, v, k1)
-    while not inrankededges or len(chart.rankededges[v]) < k:
-        inrankededges = inrankededges or v in chart.rankededges
-        if inrankededges:
-            with cython.wraparound(True):
-                # last derivation
-                entry = chart.rankededges[v][-1]
-            ej = entry.key
-            # update the heap, adding the successors of last derivation
-            # start of inlined lazynext(v, ej, k1, cand, chart, explored)
-            for i in range(2):  # add the |e| neighbors
-                if i == 0 and ej.left >= 0:
-                    ei = chart.left(ej)
-                    ej1 = new_RankedEdge(v, ej.edge, ej.left + 1, ej.right)
-                elif i == 1 and ej.right >= 0:
-                    ei = chart.right(ej)
-                    ej1 = new_RankedEdge(v, ej.edge, ej.left, ej.right + 1)
+cdef struct Vertex:  # the k-best state of a chart item
+    Candidate * heap  # candidate derivations, a heap ordered by probability
+    Candidate * ranked  # the derivations extracted so far, best first
+    size_t heaplen, heapcap, rankedlen, rankedcap
+    uint64_t counter  # the number of candidates pushed so far
+    double viterbi  # probability of the 1-best derivation
+    bint visited  # whether the candidates have been initialized
+
+
+cdef inline bint candlessthan(Candidate * a, Candidate * b):
+    return a.prob < b.prob or (a.prob == b.prob and a.order < b.order)
+
+
+@cython.final
+cdef class KBestState(object):
+    """The candidate heaps and ranked derivations for the items of a chart.
+
+    Items are identified by integer vertex IDs, assigned in the order in which
+    they are encountered. Candidates are C structs; only the derivations that
+    are extracted become ``RankedEdge`` objects in ``chart.rankededges``."""
+    cdef Vertex * vertices
+    cdef size_t numvertices, cap
+    cdef size_t numroot  # number of derivations of the root considered
+    cdef readonly size_t numcandidates  # total number of candidates pushed
+    cdef dict vertexids  # item => vertex ID
+    cdef list items  # vertex ID => item
+    cdef list rootentries
+    cdef Chart chart
+    cdef int root
+
+    def __cinit__(self):
+        self.vertices = NULL
+
+    def __init__(self, Chart chart):
+        self.chart = chart
+        self.vertexids = {}
+        self.items = []
+        self.rootentries = []
+        self.cap = 256
+        self.vertices = <Vertex *>malloc(self.cap * sizeof(Vertex))
+        if self.vertices is NULL:
+            raise MemoryError
+        self.root = self.getid(chart.root())
+        chart.rankededges = {self.items[self.root]: self.rootentries}
+
+    def __dealloc__(self):
+        cdef size_t n
+        if self.vertices is NULL:
+            return
+        for n in range(self.numvertices):
+            free(self.vertices[n].heap)
+            free(self.vertices[n].ranked)
+        free(self.vertices)
+
+    cdef int getid(self, item) except -1:
+        """Return the vertex ID of item; add it if it has not been seen."""
+        cdef Vertex * tmp
+        cdef int n = self.vertexids.get(item, -1)
+        if n != -1:
+            return n
+        if self.numvertices == self.cap:
+            tmp = <Vertex *>realloc(self.vertices,
+                                    2 * self.cap * sizeof(Vertex))
+            if tmp is NULL:
+                raise MemoryError
+            self.vertices = tmp
+            self.cap *= 2
+        n = self.numvertices
+        memset(&(self.vertices[n]), 0, sizeof(Vertex))
+        self.vertices[n].viterbi = self.chart.subtreeprob(item)
+        self.vertexids[item] = n
+        self.items.append(item)
+        self.numvertices += 1
+        return n
+
+    cdef int initcandidates(self, int v) except -1:
+        """Add the 1-best derivation of each edge of vertex v to its heap."""
+        cdef Edge * e
+        cdef Edges edges
+        cdef MoreEdges * edgelist
+        cdef Candidate cand
+        cdef size_t n
+        item = self.items[v]
+        self.vertices[v].visited = True
+        # compute viterbi prob from rule.prob + viterbi probs of children
+        edges = self.chart.getedges(item)
+        edgelist = edges.head if edges is not None else NULL
+        while edgelist is not NULL:
+            for n in range(edges.len if edgelist is edges.head
+                           else EDGES_SIZE):
+                e = &(edgelist.data[n])
+                cand.edge = e
+                cand.leftid = cand.rightid = 0
+                cand.left = cand.right = -1
+                if e.rule is NULL:
+                    # there can only be one lexical edge for this combination
+                    # of POS tag and terminal, use viterbi probability directly
+                    cand.prob = self.vertices[v].viterbi
                 else:
-                    break
-                ji = ej1.left if i == 0 else ej1.right
-                if depthlimit > 0:
-                    # recursively solve a subproblem
-                    # NB: increment j[i] again, j is zero-based and k is not
-                    lazykthbest(ei, ji + 1, k1, cand, chart, explored,
-                                depthlimit - 1)
-                    # if it exists and is not in heap yet
-                    if (ei in chart.rankededges
-                        and ji < len(chart.rankededges[ei])
-                            and ej1 not in explored):
-                        # 	and cand[ej1.head]): gives duplicates
-                        # add it to the heap
-                        cand[v][ej1] = getprob(chart, v, ej1)
-                        explored.add(ej1)
-            # end of lazynext
-        if not cand[v]:
-            break
-        # get the next best derivation and delete it from the heap
-        entry = ( < DoubleAgenda > cand[v]).popentry()
-        if inrankededges:
-            chart.rankededges[v].append(entry)
-        else:
-            chart.rankededges[v] = [entry]
-
-
-cdef inline double getprob(Chart chart, v, RankedEdge ej) except -1.0:
-    """Get subtree probability of ``ej``.
-
-    Try looking in ``chart.rankededges``, or else use viterbi probability."""
-    cdef double prob = ej.edge.rule.prob
-    ei = chart.left(ej)
-    if ej.left == 0:
-        prob += chart.subtreeprob(ei)
-    elif ei in chart.rankededges:
-        prob += ( < DoubleEntry > ( < list > chart.rankededges[ei])[ej.left]).value
-    else:
-        raise ValueError('non-zero rank vector %d not in explored '
-                         'derivations for %s' % (ej.right, chart.itemstr(v)))
-    if ej.right == -1:
-        return prob
-    ei = chart.right(ej)
-    if ej.right == 0:
-        prob += chart.subtreeprob(ei)
-    elif ei in chart.rankededges:
-        prob += ( < DoubleEntry > ( < list > chart.rankededges[ei])[ej.right]).value
-    else:
-        raise ValueError('non-zero rank vector %d not in explored '
-                         'derivations for %s' % (ej.right, chart.itemstr(v)))
-    return prob
+                    cand.left = 0
+                    cand.leftid = self.getid(self.chart._left(item, e))
+                    cand.prob = (e.rule.prob
+                                 + self.vertices[cand.leftid].viterbi)
+                    if e.rule.rhs2:  # not a unary rule
+                        cand.right = 0
+                        cand.rightid = self.getid(self.chart._right(item, e))
+                        cand.prob += self.vertices[cand.rightid].viterbi
+                self.push(v, cand)
+            edgelist = edgelist.prev
+        return 0
 
+    cdef int push(self, int v, Candidate cand) except -1:
+        """Add a candidate derivation to the heap of vertex v."""
+        cdef Vertex * vertex = &(self.vertices[v])
+        cdef Candidate * tmp
+        cdef size_t n, parent
+        if vertex.heaplen == vertex.heapcap:
+            n = 2 * vertex.heapcap if vertex.heapcap else 8
+            tmp = <Candidate *>realloc(vertex.heap, n * sizeof(Candidate))
+            if tmp is NULL:
+                raise MemoryError
+            vertex.heap, vertex.heapcap = tmp, n
+        cand.order = vertex.counter
+        vertex.counter += 1
+        n = vertex.heaplen
+        vertex.heaplen += 1
+        while n > 0:
+            parent = (n - 1) // HEAP_ARITY
+            if not candlessthan(&cand, &(vertex.heap[parent])):
+                break
+            vertex.heap[n] = vertex.heap[parent]
+            n = parent
+        vertex.heap[n] = cand
+        self.numcandidates += 1
+        return 0
 
-cdef int explorederivation(v, RankedEdge ej, Chart chart, set explored,
-                           int depthlimit):
-    """Traverse derivation to ensure all 1-best RankedEdges are present.
+    cdef int popranked(self, int v) except -1:
+        """Move the best candidate of vertex v to its ranked derivations."""
+        cdef Vertex * vertex = &(self.vertices[v])
+        cdef Candidate * tmp
+        cdef Candidate last
+        cdef size_t n = 0, m, child, best
+        if vertex.rankedlen == vertex.rankedcap:
+            m = 2 * vertex.rankedcap if vertex.rankedcap else 4
+            tmp = <Candidate *>realloc(vertex.ranked, m * sizeof(Candidate))
+            if tmp is NULL:
+                raise MemoryError
+            vertex.ranked, vertex.rankedcap = tmp, m
+        vertex.ranked[vertex.rankedlen] = vertex.heap[0]
+        vertex.rankedlen += 1
+        vertex.heaplen -= 1
+        last = vertex.heap[vertex.heaplen]
+        while True:
+            child = n * HEAP_ARITY + 1
+            if child >= vertex.heaplen:
+                break
+            best = child
+            for m in range(child + 1, min(child + HEAP_ARITY,
+                                          vertex.heaplen)):
+                if candlessthan(&(vertex.heap[m]), &(vertex.heap[best])):
+                    best = m
+            if not candlessthan(&(vertex.heap[best]), &last):
+                break
+            vertex.heap[n] = vertex.heap[best]
+            n = best
+        vertex.heap[n] = last
+        if v != self.root:
+            # the root only gets entries for valid derivations; cf. nextbest()
+            entry = self.getentry(v, vertex.rankedlen - 1)
+            if vertex.rankedlen == 1:
+                self.chart.rankededges[self.items[v]] = [entry]
+            else:
+                self.chart.rankededges[self.items[v]].append(entry)
+        return 0
 
-    :returns: True when ``ej`` is a valid, complete derivation."""
-    cdef DoubleEntry entry
-    if depthlimit <= 0:  # to prevent cycles
-        return False
-    if ej.edge.rule is NULL:
-        return True
-    if ej.left != -1:
-        leftitem = chart.left(ej)
-        if leftitem not in chart.rankededges:
-            assert ej.left == 0, '%d-best edge for %s of left item missing' % (
-                ej.left, chart.itemstr(v))
-            entry = getcandidates(chart, leftitem, 1).popentry()
-            chart.rankededges[leftitem] = [entry]
-            explored.add(entry.key)
-        if not explorederivation(leftitem,
-                            < RankedEdge > (< DoubleEntry > chart.rankededges[
-                                leftitem][ej.left]).key,
-                chart, explored, depthlimit - 1):
+    cdef DoubleEntry getentry(self, int v, size_t n):
+        """Return the n-th best derivation of vertex v as a RankedEdge."""
+        cdef Candidate * cand = &(self.vertices[v].ranked[n])
+        return new_DoubleEntry(
+            new_RankedEdge(self.items[v], cand.edge, cand.left, cand.right),
+            cand.prob, cand.order)
+
+    cdef inline double rankprob(self, int v, int n):
+        """Probability of the n-th best derivation of vertex v."""
+        if n == 0:
+            return self.vertices[v].viterbi
+        return self.vertices[v].ranked[n].prob
+
+    cdef int kthbest(self, int v, size_t k, int depthlimit) except -1:
+        """Explore up to *k*-best derivations headed by vertex *v*."""
+        cdef Candidate last, cand
+        cdef int i, child, rank
+        # first visit of vertex v?
+        if not self.vertices[v].visited:
+            self.initcandidates(v)
+        while self.vertices[v].rankedlen < k:
+            if self.vertices[v].rankedlen:
+                # update the heap, adding the successors of last derivation.
+                # To avoid duplicates, the rank of the left child is only
+                # incremented when the right child has rank 0; this way every
+                # rank vector has a single predecessor.
+                last = self.vertices[v].ranked[self.vertices[v].rankedlen - 1]
+                for i in range(2):
+                    cand = last
+                    if i == 0 and last.right >= 0:
+                        cand.right += 1
+                        child, rank = cand.rightid, cand.right
+                    elif i == 1 and last.left >= 0 and last.right <= 0:
+                        cand.left += 1
+                        child, rank = cand.leftid, cand.left
+                    else:
+                        continue
+                    if depthlimit > 0:
+                        # recursively solve a subproblem
+                        # NB: increment rank again, it is zero-based and k is not
+                        self.kthbest(child, rank + 1, depthlimit - 1)
+                    # if it exists, add it to the heap
+                    if <size_t>rank < self.vertices[child].rankedlen:
+                        cand.prob = (cand.edge.rule.prob
+                                     + self.rankprob(cand.leftid, cand.left))
+                        if cand.right >= 0:
+                            cand.prob += self.rankprob(
+                                cand.rightid, cand.right)
+                        self.push(v, cand)
+            if self.vertices[v].heaplen == 0:
+                break
+            # get the next best derivation and delete it from the heap
+            self.popranked(v)
+        return 0
+
+    cdef int explore(self, int v, size_t n, int depthlimit) except -1:
+        """Traverse derivation to ensure all 1-best derivations are present.
+
+        :returns: True when the n-th derivation of v is a valid, complete
+            derivation."""
+        cdef Candidate cand = self.vertices[v].ranked[n]
+        if depthlimit <= 0:  # to prevent cycles
+            return False
+        if cand.edge.rule is NULL:
+            return True
+        if <size_t>cand.left >= self.vertices[cand.leftid].rankedlen:
+            assert cand.left == 0, '%d-best edge for %s of left item missing' % (
+                cand.left, self.chart.itemstr(self.items[v]))
+            self.kthbest(cand.leftid, 1, 0)
+        if not self.explore(cand.leftid, cand.left, depthlimit - 1):
             return False
-    if ej.right != -1:
-        rightitem = chart.right(ej)
-        if rightitem not in chart.rankededges:
-            assert ej.right == 0, (('%d-best edge for right child '
-                                    'of %s missing') % (ej.right, chart.itemstr(v)))
-            entry = getcandidates(chart, rightitem, 1).popentry()
-            chart.rankededges[rightitem] = [entry]
-            explored.add(entry.key)
-        return explorederivation(rightitem,
-                        < RankedEdge > (< DoubleEntry > chart.rankededges[
-                            rightitem][ej.right]).key,
-            chart, explored, depthlimit - 1)
-    return True
+        if cand.right == -1:
+            return True
+        if <size_t>cand.right >= self.vertices[cand.rightid].rankedlen:
+            assert cand.right == 0, (('%d-best edge for right child '
+                                      'of %s missing') % (
+                cand.right, self.chart.itemstr(self.items[v])))
+            self.kthbest(cand.rightid, 1, 0)
+        return self.explore(cand.rightid, cand.right, depthlimit - 1)
+
+    cdef DoubleEntry nextbest(self):
+        """Extract the next best derivation of the root.
+
+        :returns: the entry that is appended to ``chart.rankededges`` for the
+            root, or None when there are no more derivations."""
+        cdef DoubleEntry entry
+        cdef size_t n
+        while True:
+            n = self.numroot
+            self.kthbest(self.root, n + 1, MAX_DEPTH)
+            if self.vertices[self.root].rankedlen <= n:
+                return None
+            self.numroot += 1
+            if self.explore(self.root, n, MAX_DEPTH):
+                entry = self.getentry(self.root, n)
+                self.rootentries.append(entry)
+                return entry
 
 
 cdef inline _getderiv(list result, v, RankedEdge ej, Chart chart, str debin):
@@ -224,7 +342,7 @@ def getderiv(v, RankedEdge ej, Chart chart, str debin):
 
 
 def lazykbest(Chart chart, int k, str debin=None, bint derivs=True):
-    """Wrapper function to run ``lazykthbest``.
+    """Extract the *k*-best derivations from a chart.
 
     Produces the ranked chart, as well as derivations as strings (when
     ``derivs`` is True). chart is a monotone hypergraph; should be acyclic
@@ -232,23 +350,43 @@ def lazykbest(Chart chart, int k, str debin=None, bint derivs=True):
     productions are sufficient?).
 
     :param k: the number of derivations to enumerate.
-    :param debin: debinarize derivations."""
+    :param debin: debinarize derivations.
+    :returns: a tuple ``(derivations, numcandidates)``, where
+        ``derivations`` is a list of tuples ``(deriv, logprob)`` (empty when
+        ``derivs`` is False), and ``numcandidates`` is the number of candidate
+        derivations that were explored."""
+    cdef KBestState state = KBestState(chart)
     cdef DoubleEntry entry
-    cdef set explored = set()
-    # assert not chart.rankededges, 'kbest derivations already extracted?'
-    chart.rankededges = {}
-    derivations = []
-    cand = {}
+    cdef list derivations = []
     root = chart.root()
-    lazykthbest(root, k, k, cand, chart, explored, MAX_DEPTH)
-    chart.rankededges[root] = [entry for entry
-                               in chart.rankededges[root][:k]
-                               if explorederivation(root, entry.key, chart, explored, MAX_DEPTH)]
-    if derivs:
-        root = chart.root()
-        derivations = [(getderiv(root, entry.key, chart, debin), entry.value)
-                       for entry in chart.rankededges[root]]
-    return derivations, explored
+    while len(state.rootentries) < k:
+        entry = state.nextbest()
+        if entry is None:
+            break
+        if derivs:
+            derivations.append(
+                (getderiv(root, entry.key, chart, debin), entry.value))
+    return derivations, state.numcandidates
+
+
+def iterkbest(Chart chart, int k, str debin=None, bint derivs=True):
+    """Generator version of ``lazykbest()``; yield *k*-best derivations.
+
+    Derivations are only extracted when they are requested, so a caller that
+    stops after the first few derivations only pays for those. The entries
+    for the root in ``chart.rankededges`` are the derivations yielded so far.
+
+    :yields: tuples ``(deriv, logprob)``; ``deriv`` is None when ``derivs``
+        is False."""
+    cdef KBestState state = KBestState(chart)
+    cdef DoubleEntry entry
+    root = chart.root()
+    while len(state.rootentries) < k:
+        entry = state.nextbest()
+        if entry is None:
+            break
+        yield (getderiv(root, entry.key, chart, debin) if derivs else None,
+               entry.value)
 
 
 def test():
@@ -422,4 +560,4 @@ def test():
     assert len(derivations) == len(set(derivations))
 
 
-__all__ = ['getderiv', 'lazykbest']
+__all__ = ['getderiv', 'lazykbest', 'iterkbest']
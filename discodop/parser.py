@@ -13,9 +13,9 @@ import time
 import codecs
 import logging
 import tempfile
+import threading
 import traceback
 import string  # pylint: disable=W0402
-import multiprocessing
 from math import exp, log
 from heapq import nlargest
 from getopt import gnu_getopt, GetoptError
@@ -23,13 +23,16 @@ from operator import itemgetter
 if sys.version_info[0] == 2:
     from itertools import imap as map  # pylint: disable=E0611,W0622
     import cPickle as pickle  # pylint: disable=import-error
+    import SocketServer as socketserver  # pylint: disable=import-error
 else:
     import pickle
+    import socketserver
 import numpy as np
 from . import plcfrs, pcfg, disambiguation
 from . import grammar, treetransforms, treebanktransforms
 from .containers import Grammar, BITPARRE
 from .coarsetofine import prunechart
+from .estimates import OutsideEstimates
 from .tree import ParentedTree, escape, ptbescape
 from .eval import alignsent
 from .lexicon import replaceraretestwords, UNKNOWNWORDFUNC, UNK
@@ -37,12 +40,13 @@ from .treebank import writetree, handlefunctions
 from .heads import saveheads, readheadrules
 from .punctuation import punctprune, applypunct
 from .functiontags import applyfunctionclassifier
-from .util import workerfunc, openread
+from .util import workerfunc, sharedpool, openread
 from .treetransforms import binarizetree
 
 SHORTUSAGE = '''
 usage: discodop parser [options] <grammar/> [input [output]]
-or:    discodop parser --simple [options] <rules> <lexicon> [input [output]]'''
+or:    discodop parser --simple [options] <rules> <lexicon> [input [output]]
+or:    discodop parser --server=<socket|[host:]port> [options] <grammar/>'''
 
 DEFAULTS = dict(
     # two-level keys:
@@ -107,10 +111,15 @@ DEFAULTSTAGE = dict(
     sample=False, kbest=True,
     m=10,  # number of derivations to sample/enumerate
     estimator='rfe',  # choices: rfe, ewe
-    objective='mpp',  # choices: mpp, mpd, shortest, sl-dop[-simple]
+    objective='mpp',  # choices: mpp, mpd, shortest, sl-dop[-simple], mcc,
+    # mrp, mcc-chart
     # NB: w/shortest derivation, estimator only affects tie breaking.
     sldop_n=7,  # number of trees to consider when using sl-dop[-simple]
+    maxtrees=0,  # only keep n most probable parse trees; 0: keep all
+    earlystop=False,  # with mpp, stop enumerating derivations when the
+    # most probable parse can no longer change
     mcc_labda=1.0,  # weight to assign to recall vs. mistake rate with mcc
+    # and mcc-chart
     mcc_labels=None,  # optionally, set of labels to optimize for with mcc
     packedgraph=False,  # use packed graph encoding for DOP reduction
     iterate=False,  # for double dop, whether to add fragments of fragments
@@ -118,9 +127,18 @@ DEFAULTSTAGE = dict(
     # form the complement of the maximal recurring fragments extracted
     neverblockre=None,  # do not prune nodes with label that match regex
     estimates=None,  # compute, store & use outside estimates
+    estimatesmem=0,  # max. MB of SXlrgaps tables in memory; 0 to disable.
     beam_beta=1.0,  # beam pruning factor, between 0 and 1; 1 to disable.
     beam_delta=40,  # maximum span length to which beam_beta is applied
+    maxtime=0,  # give up on stage when parsing takes more than n seconds
+    maxitems=0,  # give up on stage when chart contains more than n items
+    maxagenda=0,  # give up on stage when agenda contains more than n items
+    # (limits are disabled when 0; maxagenda applies to plcfrs only)
+    numthreads=1,  # for pcfg: parse cells of a span length in parallel
+    packedchart=False,  # for plcfrs: store chart items in arrays
+    indexedagenda=False,  # for plcfrs w/packedchart: agenda of C structs
     collapse=None,  # optionally, collapse phrase labels for multilevel CTF
+    ctflevels=0,  # precede stage by n PCFG stages w/derived label clusters
 )
 
 
@@ -146,6 +164,8 @@ class DictObj(object):
 
 
 PARAMS = DictObj()  # used for multiprocessing when using CLI of this module
+# minimum number of tokens in a batch of sentences given to a worker process
+BATCHTOKENS = 50
 
 
 class Parser(object):
@@ -166,6 +186,9 @@ class Parser(object):
         self.relationalrealizational = prm.relationalrealizational
         self.verbosity = prm.verbosity
         self.funcclassifier = funcclassifier
+        # reuse the buffers of dense PCFG charts across sentences
+        self.chartpool = pcfg.ChartPool(max(1, sum(
+            1 for stage in prm.stages if stage.mode == 'pcfg')))
         for stage in prm.stages:
             model = 'default'
             if stage.dop:
@@ -229,18 +252,10 @@ class Parser(object):
             parsetrees = fragments = None
             golditems = 0
             msg = '%s:\t' % stage.name.upper()
-            model = 'default'
-            if stage.dop:
-                if stage.objective == 'shortest':
-                    model = 'shortest'
-                elif stage.estimator != 'rfe':
-                    model = stage.estimator
-            if stage.mode != 'mc-rerank':
-                x = stage.grammar.currentmodel
-                stage.grammar.switch(model, logprob=True)
+            # the model of each grammar was selected in __init__(); switching
+            # here would write to the rule arrays shared by worker processes.
             if stage.mode.startswith('pcfg-bitpar'):
-                if (not hasattr(stage, 'rulesfile')
-                        or x != stage.grammar.currentmodel):
+                if not hasattr(stage, 'rulesfile'):
                     exportbitpargrammar(stage)
             elif hasattr(stage, 'rulesfile'):
                 del stage.rulesfile, stage.lexiconfile
@@ -290,7 +305,9 @@ class Parser(object):
                         whitelist=whitelist if stage.prune else None,
                         symbolic=False,
                         beam_beta=-log(stage.beam_beta),
-                        beam_delta=stage.beam_delta)
+                        beam_delta=stage.beam_delta,
+                        maxtime=stage.maxtime, maxitems=stage.maxitems,
+                        numthreads=stage.numthreads, pool=self.chartpool)
                 elif stage.mode.startswith('pcfg-bitpar'):
                     if stage.mode == 'pcfg-bitpar-forest':
                         numderivs = 0
@@ -319,7 +336,11 @@ class Parser(object):
                         else None,
                         symbolic=False,
                         beam_beta=-log(stage.beam_beta),
-                        beam_delta=stage.beam_delta)
+                        beam_delta=stage.beam_delta,
+                        maxtime=stage.maxtime, maxitems=stage.maxitems,
+                        maxagenda=stage.maxagenda,
+                        packedchart=stage.packedchart,
+                        indexedagenda=stage.indexedagenda)
                 elif stage.mode == 'dop-rerank':
                     if prevparsetrees[stage.prune]:
                         parsetrees, msg1 = disambiguation.doprerank(
@@ -334,7 +355,8 @@ class Parser(object):
                     raise ValueError('unknown mode specified.')
                 msg += '%s\n\t' % msg1
                 if (n > 0 and stage.prune and not chart and not noparse
-                        and stage.split == self.stages[prevn].split):
+                        and stage.split == self.stages[prevn].split
+                        and 'limit exceeded' not in msg1):
                     logging.error('ERROR: expected successful parse. '
                                   'sent: %s\nstage %d: %s.',
                                   ' '.join(sent), n, stage.name)
@@ -353,13 +375,18 @@ class Parser(object):
                                          'in nbest mode.')
                     derivations = chart.rankededges[chart.root()]
                     entries = [None] * len(derivations)
+                elif stage.dop and stage.objective in ('mrp', 'mcc-chart'):
+                    # decoded from the chart; no derivations needed
+                    derivations, entries = [], []
                 else:
                     derivations, entries = disambiguation.getderivations(
                         chart, stage.m, kbest=stage.kbest,
                         sample=stage.sample,
                         derivstrings=stage.dop not in ('doubledop', 'dop1')
                         or self.verbosity >= 3
-                        or stage.objective == 'mcc')
+                        or stage.objective == 'mcc',
+                        earlystop=stage.earlystop,
+                        backtransform=stage.backtransform)
                 if self.verbosity >= 3:
                     print('sent: %s\nstage: %s' % (' '.join(sent), stage.name))
                     print('%d-best derivations:\n%s' % (
@@ -371,9 +398,6 @@ class Parser(object):
                                   for n, (deriv, prob) in enumerate(derivations[:100]))))
                     print('sum of probabitilies: %g\n' %
                           sum(exp(-prob) for _, prob in derivations[:100]))
-                if stage.objective == 'shortest':
-                    stage.grammar.switch('default' if stage.estimator == 'rfe'
-                                         else stage.estimator, True)
                 parsetrees, msg1 = disambiguation.marginalize(
                     stage.objective if stage.dop else 'mpd',
                     derivations, entries, chart,
@@ -381,7 +405,10 @@ class Parser(object):
                     backtransform=stage.backtransform,
                     k=stage.m, sldop_n=stage.sldop_n,
                     mcc_labda=stage.mcc_labda, mcc_labels=stage.mcc_labels,
-                    bitpar=stage.mode == 'pcfg-bitpar-nbest')
+                    bitpar=stage.mode == 'pcfg-bitpar-nbest',
+                    maxtrees=stage.maxtrees,
+                    model='default' if stage.estimator == 'rfe'
+                    else stage.estimator)
                 msg += 'disambiguation: %s, %gs\n\t' % (
                     msg1, time.clock() - begindisamb)
                 if self.verbosity >= 3:
@@ -393,7 +420,7 @@ class Parser(object):
                           sum((prob[1] if isinstance(prob, tuple) else prob)
                               for _, prob, _ in besttrees))
                 if not stage.prune and tree is not None:
-                    item = next(iter(chart.rankededges))
+                    item = chart.root()
                     totalgolditems = sum(1 for node in tree.subtrees())
                     golditems = sum(
                         1 for node in tree.subtrees()
@@ -438,6 +465,46 @@ class Parser(object):
                           totalgolditems=totalgolditems, msg=msg)
         del charts, prevparsetrees
 
+    def parsebatch(self, sents, tags=None, goldtrees=None, numproc=1):
+        """Parse a sequence of sentences, possibly in parallel.
+
+        Yields for each sentence, in the original order, a list with the
+        results of each stage as yielded by :py:meth:`Parser.parse`.
+
+        :param sents: a sequence of sentences, each a sequence of tokens.
+        :param tags: optionally, a sequence with a list of POS tags for each
+                sentence.
+        :param goldtrees: optionally, a sequence with a gold tree for each
+                sentence.
+        :param numproc: the number of processes to use; ``None`` to use all
+                available CPUs.
+
+        With multiple processes, sentences are grouped into batches of
+        similar length and the longest sentences are parsed first, so that
+        parsing a long sentence does not hold up the rest of the batch; results
+        are kept until the results for all preceding sentences are
+        available."""
+        jobs = [(sent, tags[n] if tags else None,
+                 goldtrees[n] if goldtrees else None)
+                for n, sent in enumerate(sents)]
+        if numproc == 1:
+            for sent, senttags, goldtree in jobs:
+                yield list(self.parse(sent, tags=senttags, goldtree=goldtree))
+            return
+        pool = sharedpool(numproc, initializer=initworker,
+                          initargs=(self, False, False, 1, 'export', None))
+        try:
+            for result in inorder(pool.imap_unordered(
+                    mpbatchparseworker,
+                    lengthbatches(jobs, [len(sent) for sent in sents]))):
+                yield result
+            pool.close()
+        except BaseException:  # also when the caller stops iterating early
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
     def postprocess(self, treestr, sent, stage):
         """Take parse tree and apply postprocessing."""
         parsetree = ParentedTree(treestr)
@@ -474,6 +541,47 @@ class Parser(object):
         return parsetree, prob, noparse
 
 
+def mappingargs(stage, prevstage=None):
+    """Return the keyword arguments for ``Grammar.getmapping()`` of a stage.
+
+    :param prevstage: the stage by which ``stage`` is pruned, if any.
+    :returns: a dict, or None if the grammar of this stage needs no mapping.
+        Used both when creating the mapping in ``runexp`` and when restoring
+        it in :py:func:`readgrammars`, so that a stored mapping matches."""
+    if stage.mode == 'mc-rerank':
+        return None
+    elif stage.dop in ('doubledop', 'dop1'):
+        if prevstage is None:
+            # recoverfragments() relies on this mapping to identify
+            # binarization nodes
+            return dict(striplabelre=None, neverblockre=re.compile('.+}<'),
+                        splitprune=False, markorigin=False,
+                        mapping=stage.mapping)
+        return dict(striplabelre=None if prevstage.dop
+                    else re.compile('@.+$'),
+                    neverblockre=re.compile('.+}<'),
+                    splitprune=stage.splitprune and prevstage.split,
+                    markorigin=prevstage.markorigin,
+                    mapping=stage.mapping)
+    elif prevstage is None:
+        return None
+    elif stage.dop:  # dop reduction
+        return dict(striplabelre=None if prevstage.dop
+                    and prevstage.dop not in ('doubledop', 'dop1')
+                    else re.compile('@[-0-9]+$'),
+                    neverblockre=re.compile(stage.neverblockre)
+                    if stage.neverblockre else None,
+                    splitprune=stage.splitprune and prevstage.split,
+                    markorigin=prevstage.markorigin,
+                    mapping=stage.mapping)
+    return dict(striplabelre=None,
+                neverblockre=re.compile(stage.neverblockre)
+                if stage.neverblockre else None,
+                splitprune=stage.splitprune and prevstage.split,
+                markorigin=prevstage.markorigin,
+                mapping=stage.mapping)
+
+
 def readgrammars(resultdir, stages, postagging=None, top='ROOT'):
     """Read the grammars from a previous experiment.
 
@@ -488,7 +596,25 @@ def readgrammars(resultdir, stages, postagging=None, top='ROOT'):
             stage.mapping = None
     for n, stage in enumerate(stages):
         logging.info('reading: %s', stage.name)
-        if stage.mode != 'mc-rerank':
+        grammarfile = '%s/%s.grammar.bin' % (resultdir, stage.name)
+        # only use the compiled grammar if it is newer than the files
+        # from which runexp made it
+        stale = os.path.exists(grammarfile) and any(
+            os.path.getmtime(grammarfile) < os.path.getmtime(a)
+            for a in ('%s/%s.%s' % (resultdir, stage.name, ext)
+                      for ext in ('rules.gz', 'lex.gz', 'probs.npz'))
+            if os.path.exists(a))
+        if stale:
+            logging.warning('%s is older than the grammar files; '
+                            'ignoring it.', grammarfile)
+        xgrammar = None
+        if (stage.mode != 'mc-rerank' and os.path.exists(grammarfile)
+                and not stale):
+            try:
+                xgrammar = Grammar.fromfile(grammarfile)
+            except ValueError as err:
+                logging.warning('%s; ignoring it.', err)
+        if stage.mode != 'mc-rerank' and xgrammar is None:
             rules = openread('%s/%s.rules.gz' % (resultdir, stage.name)).read()
             lexicon = openread('%s/%s.lex.gz' % (resultdir, stage.name))
             xgrammar = Grammar(rules, lexicon.read(),
@@ -497,6 +623,22 @@ def readgrammars(resultdir, stages, postagging=None, top='ROOT'):
         prevn = 0
         if n and stage.prune:
             prevn = [a.name for a in stages].index(stage.prune)
+        mapargs = mappingargs(stage, stages[prevn] if n and stage.prune
+                              else None)
+        if mapargs is not None:
+            # use mapping for coarse-to-fine pruning stored by runexp, if it
+            # was made with the same grammars and options.
+            coarse = stages[prevn].grammar if n and stage.prune else None
+            mappingfile = '%s/%s.mapping.npz' % (resultdir, stage.name)
+            havemapping = False
+            if os.path.exists(mappingfile):
+                try:
+                    xgrammar.loadmapping(mappingfile, coarse, **mapargs)
+                    havemapping = True
+                except ValueError as err:
+                    logging.warning('%s; recomputing mapping.', err)
+            if not havemapping:
+                _ = xgrammar.getmapping(coarse, **mapargs)
         if stage.mode == 'mc-rerank':
             xgrammar = pickle.loads(gzip.open('%s/%s.train.pickle.gz' % (
                 resultdir, stage.name), 'rb').read())
@@ -506,26 +648,7 @@ def readgrammars(resultdir, stages, postagging=None, top='ROOT'):
             if stage.dop in ('doubledop', 'dop1'):
                 backtransform = openread('%s/%s.backtransform.gz' % (
                     resultdir, stage.name)).read().splitlines()
-                if n and stage.prune:
-                    _ = xgrammar.getmapping(stages[prevn].grammar,
-                                            striplabelre=re.compile('@.+$'),
-                                            neverblockre=re.compile('^#[0-9]+|.+}<'),
-                                            splitprune=stage.splitprune and stages[prevn].split,
-                                            markorigin=stages[prevn].markorigin,
-                                            mapping=stage.mapping)
-                else:
-                    # recoverfragments() relies on this mapping to identify
-                    # binarization nodes
-                    _ = xgrammar.getmapping(None,
-                                            neverblockre=re.compile('.+}<'))
             elif n and stage.prune:  # dop reduction
-                _ = xgrammar.getmapping(stages[prevn].grammar,
-                                        striplabelre=re.compile('@[-0-9]+$'),
-                                        neverblockre=re.compile(stage.neverblockre)
-                                        if stage.neverblockre else None,
-                                        splitprune=stage.splitprune and stages[prevn].split,
-                                        markorigin=stages[prevn].markorigin,
-                                        mapping=stage.mapping)
                 if stage.mode == 'dop-rerank':
                     xgrammar.getrulemapping(
                         stages[prevn].grammar, re.compile(r'@[-0-9]+\b'))
@@ -533,23 +656,21 @@ def readgrammars(resultdir, stages, postagging=None, top='ROOT'):
             if os.path.exists(probsfile):
                 probmodels = np.load(probsfile)
                 for name in probmodels.files:
-                    if name != 'default':
+                    if name not in xgrammar.modelnames:
                         xgrammar.register(name, probmodels[name])
         else:  # not stage.dop
-            if n and stage.prune:
-                _ = xgrammar.getmapping(stages[prevn].grammar,
-                                        neverblockre=re.compile(stage.neverblockre)
-                                        if stage.neverblockre else None,
-                                        splitprune=stage.splitprune and stages[prevn].split,
-                                        markorigin=stages[prevn].markorigin,
-                                        mapping=stage.mapping)
             if stage.estimates in ('SX', 'SXlrgaps'):
                 if stage.estimates == 'SX' and xgrammar.maxfanout != 1:
                     raise ValueError('SX estimate requires PCFG.')
                 if stage.mode != 'plcfrs':
                     raise ValueError('estimates require parser w/agenda.')
-                outside = np.load('%s/%s.outside.npz' % (
-                    resultdir, stage.name))['outside']
+                if stage.estimates == 'SX':
+                    outside = np.load('%s/%s.outside.npz' % (
+                        resultdir, stage.name))['outside']
+                else:
+                    outside = OutsideEstimates.fromfile(
+                        '%s/%s.outside.npz' % (resultdir, stage.name),
+                        xgrammar, maxbytes=stage.estimatesmem * 1024 ** 2)
                 logging.info('loaded %s estimates', stage.estimates)
             elif stage.estimates:
                 raise ValueError('unrecognized value; specify SX or SXlrgaps.')
@@ -638,6 +759,7 @@ def readparam(filename):
         for key in stage:
             if key not in DEFAULTSTAGE:
                 raise ValueError('unrecognized option: %r' % key)
+    params['stages'] = expandctflevels(params['stages'])
     params['stages'] = [DictObj({k: stage.get(k, v)
                                  for k, v in DEFAULTSTAGE.items()})
                         for stage in params['stages']]
@@ -662,7 +784,16 @@ def readparam(filename):
         if stage.dop:
             assert stage.estimator in ('rfe', 'ewe', 'bon')
             assert stage.objective in ('mpp', 'mpd', 'mcc', 'shortest',
-                                       'sl-dop', 'sl-dop-simple')
+                                       'sl-dop', 'sl-dop-simple',
+                                       'mrp', 'mcc-chart')
+            if stage.objective in ('mrp', 'mcc-chart'):
+                assert stage.dop not in ('doubledop', 'dop1'), (
+                    'objective %r requires DOP reduction.' % stage.objective)
+                assert stage.mode not in ('pcfg-bitpar-nbest', 'dop-rerank')
+        if stage.earlystop:
+            assert stage.objective == 'mpp' and stage.kbest and not stage.sample, (
+                'earlystop requires objective "mpp" and k-best derivations.')
+            assert stage.mode not in ('pcfg-bitpar-nbest', 'dop-rerank')
         assert stage.binarized or stage.mode == 'pcfg-bitpar-nbest', (
             'non-binarized grammar requires mode "pcfg-bitpar-nbest"')
     assert params['binarization'].method in (
@@ -685,6 +816,42 @@ def readparam(filename):
     return DictObj(params)
 
 
+def expandctflevels(stages):
+    """Insert coarse stages for stages with the ``ctflevels`` option.
+
+    A stage ``dict(name='pcfg', ctflevels=2, ...)`` is preceded by PCFG stages
+    ``pcfg-level0`` and ``pcfg-level1``, which use the phrase label clusters
+    of the respective levels of ``treebanktransforms.derivemappings()``
+    (i.e., ``collapse=('auto', level)``). Each of these stages prunes the
+    next; the first inherits the pruning options of the original stage.
+
+    :param stages: a list of dictionaries with stage parameters.
+    :returns: a new list of dictionaries."""
+    result = []
+    for stage in stages:
+        levels = stage.get('ctflevels', 0)
+        if not levels:
+            result.append(stage)
+            continue
+        # the coarse stages are split PCFGs, unless the stage is a PCFG
+        pcfg = stage.get('mode', DEFAULTSTAGE['mode']).startswith('pcfg')
+        split = stage.get('split', False) if pcfg else True
+        markorigin = stage.get('markorigin', False) if pcfg else True
+        prune = stage.get('prune', False)
+        splitprune = stage.get('splitprune', False)
+        for level in range(levels):
+            name = '%s-level%d' % (stage['name'], level)
+            result.append(dict(
+                name=name, mode='pcfg', split=split, markorigin=markorigin,
+                collapse=('auto', level), prune=prune, splitprune=splitprune,
+                k=stage.get('k', DEFAULTSTAGE['k']),
+                numthreads=stage.get('numthreads', 1)))
+            prune, splitprune = name, False
+        result.append(dict(stage, ctflevels=0, prune=prune,
+                           splitprune=split and not pcfg))
+    return result
+
+
 def readinputbitparstyle(infile):
     """Yields lists of tokens, where '\\n\\n' identifies a sentence break.
 
@@ -711,12 +878,6 @@ def initworker(parser, printprob, usetags, numparses,
                   morphology=morphology, headrules=headrules)
 
 
-@workerfunc
-def mpworker(args):
-    """Parse a single sentence (multiprocessing wrapper)."""
-    return worker(args)
-
-
 def worker(args):
     """Parse a single sentence."""
     key, line = args
@@ -730,9 +891,67 @@ def worker(args):
         sent, tags = zip(*(a.rsplit('/', 1) for a in sent))
     msg = 'parsing %s: %s' % (key, ' '.join(sent))
     result = list(PARAMS.parser.parse(sent, tags=tags))[-1]
-    output = ''
     if result.noparse:
         msg += '\nNo parse for "%s"' % ' '.join(sent)
+    output = writeparses(result, sent, key)
+    sec = time.clock() - begin
+    msg += '\n%g s' % sec
+    return output, result.noparse, sec, msg
+
+
+@workerfunc
+def mpbatchworker(batch):
+    """Parse a batch of sentences (multiprocessing wrapper)."""
+    return [(n, worker(args)) for n, args in batch]
+
+
+@workerfunc
+def mpbatchparseworker(batch):
+    """Parse a batch of sentences and return the results of all stages."""
+    return [(n, list(PARAMS.parser.parse(sent, tags=tags, goldtree=goldtree)))
+            for n, (sent, tags, goldtree) in batch]
+
+
+def lengthbatches(jobs, lengths, mintokens=BATCHTOKENS):
+    """Group sentences into batches of similar length, longest first.
+
+    :param jobs: a sequence with an item for each sentence.
+    :param lengths: the length of each sentence.
+    :param mintokens: sentences are added to a batch until it contains at
+            least this many tokens; i.e., long sentences form a batch on their
+            own, while short sentences are grouped to reduce overhead.
+    :returns: a list of batches; each batch is a list of ``(n, job)`` tuples,
+            where ``n`` is the index of ``job`` in ``jobs``."""
+    batches, batch, numtokens = [], [], 0
+    for n in sorted(range(len(jobs)), key=lengths.__getitem__, reverse=True):
+        batch.append((n, jobs[n]))
+        numtokens += lengths[n]
+        if numtokens >= mintokens:
+            batches.append(batch)
+            batch, numtokens = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def inorder(batches):
+    """Yield the results of batches in order.
+
+    Given an iterable of batches with ``(n, result)`` tuples in arbitrary
+    order, yield the results in order of ``n``, starting from 0."""
+    pending = {}
+    nextidx = 0
+    for batch in batches:
+        pending.update(batch)
+        while nextidx in pending:
+            yield pending.pop(nextidx)
+            nextidx += 1
+
+
+def writeparses(result, sent, key):
+    """Format the n-best parse trees of the last stage of a parse result."""
+    output = ''
+    if result.noparse:
         if PARAMS.printprob:
             output += 'prob=%.16g\n' % result.prob
         output += writetree(
@@ -755,9 +974,7 @@ def worker(args):
                 comment=('prob=%.16g' % prob)
                 if PARAMS.printprob else None))
         output += ''.join(tmp)
-    sec = time.clock() - begin
-    msg += '\n%g s' % sec
-    return output, result.noparse, sec, msg
+    return output
 
 
 def doparsing(parser, infile, out, printprob, oneline, usetags, numparses,
@@ -773,14 +990,16 @@ def doparsing(parser, infile, out, printprob, oneline, usetags, numparses,
         infile = enumerate((line for line in infile if line.strip()), 1)
     if numproc == 1:
         initworker(parser, printprob, usetags, numparses, fmt, morphology)
-        mymap, myworker = map, worker
+        dowork = map(worker, infile)
     else:
-        pool = multiprocessing.Pool(
-            processes=numproc, initializer=initworker,
+        pool = sharedpool(
+            numproc, initializer=initworker,
             initargs=(parser, printprob, usetags, numparses, fmt,
                       morphology))
-        mymap, myworker = pool.map, mpworker
-    for output, noparse, sec, msg in mymap(myworker, infile):
+        infile = list(infile)
+        dowork = inorder(pool.imap_unordered(mpbatchworker, lengthbatches(
+            infile, [line.count(' ') + 1 for _, line in infile])))
+    for output, noparse, sec, msg in dowork:
         if output:
             print(msg, file=sys.stderr)
             out.write(output)
@@ -796,10 +1015,123 @@ def doparsing(parser, infile, out, printprob, oneline, usetags, numparses,
     out.close()
 
 
+def serverworker(request):
+    """Parse a single sentence from a parse server request.
+
+    :param request: a dictionary with the key ``sent`` (a string with
+        space-separated tokens, or a list of tokens), and optionally ``tags``
+        (a list with a POS tag for each token) and ``id``.
+    :returns: a JSON serializable dictionary with the formatted parse trees of
+        the last stage, and the probability, time and number of items of each
+        stage."""
+    begin = time.clock()
+    sent = request['sent']
+    if not isinstance(sent, list):
+        sent = sent.split()
+    if not sent:
+        raise ValueError('empty sentence.')
+    tags = request.get('tags')
+    if tags is not None and len(tags) != len(sent):
+        raise ValueError('expected one tag for each token.')
+    key = request.get('id', 1)
+    results = list(PARAMS.parser.parse(sent, tags=tags))
+    result = results[-1]
+    return dict(
+        id=key,
+        output=writeparses(result, sent, key),
+        prob=result.prob,
+        noparse=result.noparse,
+        elapsedtime=time.clock() - begin,
+        stages=[dict(name=a.name, prob=a.prob, noparse=a.noparse,
+                     numitems=a.numitems, elapsedtime=a.elapsedtime)
+                for a in results])
+
+
+@workerfunc
+def mpserverworker(request):
+    """Parse a single server request (multiprocessing wrapper)."""
+    return serverworker(request)
+
+
+class ParseRequestHandler(socketserver.StreamRequestHandler):
+    """Handle a connection to the parse server.
+
+    Each line sent by the client is a JSON request (cf.
+    :py:func:`serverworker`); the response to each request is written back as
+    a single line of JSON. Errors are reported with the key ``error``."""
+
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            line = line.decode('utf8').strip()
+            if not line:
+                continue
+            key = None
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    request = dict(sent=request)
+                key = request.get('id')
+                result = self.server.parsefunc(request)
+            except Exception as err:  # pylint: disable=W0703
+                logging.error('request failed: %s\n%s', line, err)
+                result = dict(id=key, error='%s: %s' % (
+                    err.__class__.__name__, err))
+            self.wfile.write((json.dumps(result) + '\n').encode('utf8'))
+            self.wfile.flush()
+
+
+class TCPParseServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Parse server listening on a TCP port."""
+    daemon_threads = allow_reuse_address = True
+
+
+class UnixParseServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    """Parse server listening on a UNIX domain socket."""
+    daemon_threads = True
+
+
+def makeserver(parser, address, printprob, numparses, numproc, fmt,
+               morphology):
+    """Create a server which keeps ``parser`` loaded and parses requests.
+
+    :param address: ``[host:]port`` to listen on a TCP port (host defaults to
+        ``localhost``); any other string is taken as the path of a UNIX
+        domain socket.
+    :returns: a server object; call its ``serve_forever()`` method to start
+        handling requests. With ``numproc > 1``, requests are handed to a
+        pool of worker processes, otherwise they are parsed one at a time."""
+    match = re.match(r'^(?:(.*):)?([0-9]+)$', address)
+    if match:
+        server = TCPParseServer((match.group(1) or 'localhost',
+                                 int(match.group(2))), ParseRequestHandler)
+    else:
+        server = UnixParseServer(address, ParseRequestHandler)
+    if numproc == 1:
+        initworker(parser, printprob, False, numparses, fmt, morphology)
+        lock = threading.Lock()
+
+        def parsefunc(request):
+            """Parse request in this process, one at a time."""
+            with lock:
+                return serverworker(request)
+    else:
+        pool = sharedpool(
+            numproc, initializer=initworker,
+            initargs=(parser, printprob, False, numparses, fmt,
+                      morphology))
+
+        def parsefunc(request):
+            """Parse request with the next available worker process."""
+            return pool.apply(mpserverworker, (request, ))
+    server.parsefunc = parsefunc
+    return server
+
+
 def main():
     """Handle command line arguments."""
     flags = 'help prob tags bitpar sentid simple'.split()
-    options = flags + 'obj= bt= numproc= fmt= verbosity='.split()
+    options = flags + 'obj= bt= numproc= fmt= verbosity= server='.split()
     try:
         opts, args = gnu_getopt(sys.argv[2:], 'hb:s:m:x', options)
     except GetoptError as err:
@@ -874,6 +1206,25 @@ def main():
         parser = Parser(params)
         morph = params.morphology
         del args[:1]
+    if '--server' in opts:
+        if args:
+            print('error: input and output files not used with --server',
+                  file=sys.stderr)
+            print(SHORTUSAGE)
+            sys.exit(2)
+        server = makeserver(parser, opts['--server'], prob, numparses,
+                            int(opts.get('--numproc', 1)),
+                            opts.get('--fmt', 'discbracket'), morph)
+        print('listening on %s' % opts['--server'], file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if isinstance(server, UnixParseServer):
+                os.remove(server.server_address)
+        return
     infile = openread(args[0] if len(args) >= 1 else '-')
     out = (io.open(args[1], 'w', encoding='utf8')
            if len(args) == 2 else sys.stdout)
@@ -883,5 +1234,8 @@ def main():
 
 
 __all__ = ['DictObj', 'Parser', 'doparsing', 'exportbitpargrammar',
-           'initworker', 'probstr', 'readgrammars', 'readinputbitparstyle',
-           'readparam']
+           'initworker', 'probstr', 'mappingargs', 'readgrammars',
+           'readinputbitparstyle', 'readparam', 'expandctflevels',
+           'writeparses', 'lengthbatches', 'inorder', 'serverworker',
+           'makeserver', 'ParseRequestHandler', 'TCPParseServer',
+           'UnixParseServer']
@@ -1,15 +1,18 @@
 cimport cython
-from libc.stdlib cimport malloc, calloc, free, abort
+from libc.stdlib cimport malloc, calloc, realloc, free, abort
+from libc.string cimport memset
 from libc.math cimport isinf, isfinite
 from libc.stdint cimport uint8_t, uint32_t, uint64_t
 from cpython.dict cimport PyDict_Contains, PyDict_GetItem
 from cpython.float cimport PyFloat_AS_DOUBLE
 from .plcfrs cimport DoubleAgenda, new_DoubleEntry
 from .containers cimport Chart, Grammar, ProbRule, LexicalRule, \
-    Edge, Edges, EdgesStruct, MoreEdges, RankedEdge, Idx, \
-    cellidx, compactcellidx, PY2
+    Edge, Edges, EdgesStruct, MoreEdges, EdgeArena, RankedEdge, Idx, \
+    CFGWhitelist, cellidx, compactcellidx, cfgcellbits, arenablock, \
+    arenareset, arenatrim, arenafree, PY2
+from .bit cimport anextset
 
-cdef extern from "macros.h":
+cdef extern from "macros.h" nogil:
     uint64_t TESTBIT(uint64_t a[], int b)
 
 ctypedef fused CFGChart_fused:
@@ -17,6 +20,22 @@ ctypedef fused CFGChart_fused:
     SparseCFGChart
 
 
+cdef struct ChartBuffers:  # the buffers of a DenseCFGChart
+    double * probs
+    EdgesStruct * parseforest
+    EdgeArena * arenas
+    size_t probssize, forestsize  # allocated number of entries
+    int numarenas
+
+
+@cython.final
+cdef class ChartPool:
+    cdef ChartBuffers * buffers
+    cdef readonly int maxsize
+    cdef readonly size_t maxbytes
+    cdef int len
+
+
 cdef class CFGChart(Chart):
     pass
 
@@ -25,6 +44,10 @@ cdef class CFGChart(Chart):
 cdef class DenseCFGChart(CFGChart):
     cdef EdgesStruct * parseforest  # chartitem => EdgesStruct(...)
     cdef double * probs
+    cdef EdgeArena * arenas  # edge blocks of parseforest; one per thread
+    cdef int numarenas
+    cdef size_t probssize, forestsize  # allocated number of entries
+    cdef ChartPool pool  # if not None, return buffers here when deallocated
     cdef void addedge(self, uint32_t lhs, Idx start, Idx end, Idx mid,
                       ProbRule * rule)
     cdef bint updateprob(self, uint32_t lhs, Idx start, Idx end, double prob,
@@ -3,6 +3,7 @@ from __future__ import print_function
 from os import unlink
 import re
 import sys
+import time
 import subprocess
 from math import exp, log as pylog
 from array import array
@@ -14,11 +15,105 @@ from .plcfrs import DoubleAgenda
 from .treebank import TERMINALSRE
 
 cimport cython
+from cython.parallel cimport prange, threadid
 include "constants.pxi"
 
 cdef double INFINITY = float('infinity')
 
 
+cdef inline bint addedgestruct(EdgesStruct * edges, Idx mid,
+                               ProbRule * rule, EdgeArena * arena) nogil:
+    """Add edge to an unrolled linked list of edges.
+
+    :param arena: allocate blocks of the linked list from this arena.
+    :returns: ``True`` if this is the first edge, i.e., a new item."""
+    cdef Edge * edge
+    cdef MoreEdges * edgelist
+    cdef bint new = edges.head is NULL
+    if new or edges.len == EDGES_SIZE:
+        edgelist = arenablock(arena)
+        edgelist.prev = edges.head
+        edges.head = edgelist
+        edges.len = 0
+    else:
+        edgelist = edges.head
+    edge = &(edgelist.data[edges.len])
+    edge.rule = rule
+    edge.pos.mid = mid
+    edges.len += 1
+    return new
+
+
+cdef inline bint updateprobdense(double * probs, size_t compactcell,
+                                 uint32_t lhs, double prob, double beam) nogil:
+    """Update probability in dense array if better than current one.
+
+    :param compactcell: offset of the cell in ``probs``; the item with label 0
+        for a cell holds the best score in a cell (used if ``beam`` is
+        non-zero)."""
+    cdef size_t idx = compactcell + lhs
+    if beam:
+        if prob > probs[compactcell] + beam:
+            return False
+        elif prob < probs[compactcell]:
+            probs[compactcell] = probs[idx] = prob
+        elif prob < probs[idx]:
+            probs[idx] = prob
+    elif prob < probs[idx]:
+        probs[idx] = prob
+    return True
+
+
+@cython.final
+cdef class ChartPool:
+    """Keeps the buffers of discarded dense CFG charts for reuse.
+
+    When parsing many sentences, passing a pool to ``parse()`` avoids
+    allocating and initializing fresh multi-megabyte arrays for each
+    sentence. The buffers grow to fit the largest sentence seen so far, up
+    to ``maxbytes``; of the edge arenas, only the part used by the last
+    chart is kept. Call ``clear()`` to release all buffers.
+
+    :param maxsize: the maximum number of charts of which the buffers are
+        kept; should be at least the number of charts that are alive at the
+        same time (e.g., the number of PCFG stages in coarse-to-fine parsing).
+    :param maxbytes: the buffers of a chart that take up more memory than
+        this are freed instead of kept, so that an exceptionally long
+        sentence does not permanently increase memory usage."""
+
+    def __cinit__(self, int maxsize=1, size_t maxbytes=256 * 1024 ** 2):
+        self.buffers = <ChartBuffers * >calloc(maxsize, sizeof(ChartBuffers))
+        if self.buffers is NULL:
+            raise MemoryError('allocation error')
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.len = 0
+
+    def __dealloc__(self):
+        self.clear()
+        free(self.buffers)
+
+    def __len__(self):
+        return self.len
+
+    def __reduce__(self):
+        # buffers are not pickled
+        return (ChartPool, (self.maxsize, self.maxbytes))
+
+    def clear(self):
+        """Free the buffers in this pool."""
+        cdef ChartBuffers * buf
+        cdef int n
+        while self.len:
+            self.len -= 1
+            buf = &(self.buffers[self.len])
+            for n in range(buf.numarenas):
+                arenafree(&(buf.arenas[n]))
+            free(buf.arenas)
+            free(buf.probs)
+            free(buf.parseforest)
+
+
 cdef class CFGChart(Chart):
     """A Chart for context-free grammars (CFG).
 
@@ -34,7 +129,7 @@ cdef class CFGChart(Chart):
         if edge.rule is NULL:
             return None
         start = <size_t > item / (
-            self.grammar.nonterminals * self.lensent)
+            <size_t > self.grammar.nonterminals * self.lensent)
         return cellidx(start, edge.pos.mid, self.lensent,
                        self.grammar.nonterminals) + edge.rule.rhs1
 
@@ -76,46 +171,92 @@ cdef class DenseCFGChart(CFGChart):
     array; i.e., array is contiguous and all valid combinations of indices
     ``0 <= start <= mid <= end`` and ``label`` can be addressed. Whether it is
     feasible to use this chart depends on the grammar constant, specifically
-    the number of non-terminal labels."""
+    the number of non-terminal labels, and the sentence length; ``parse()``
+    falls back to a ``SparseCFGChart`` for large charts."""
 
     def __init__(self, Grammar grammar, list sent,
-                 start=None, logprob=True, viterbi=True):
+                 start=None, logprob=True, viterbi=True, ChartPool pool=None):
+        cdef ChartBuffers * buf
+        cdef size_t n, probsentries, forestentries
         self.grammar = grammar
         self.sent = sent
         self.lensent = len(sent)
         self.start = grammar.toid[grammar.start if start is None else start]
         self.logprob = logprob
         self.viterbi = viterbi
-        entries = compactcellidx(self.lensent - 1, self.lensent, self.lensent,
-                                 grammar.nonterminals) + grammar.nonterminals
-        self.probs = <double * >malloc(entries * sizeof(double))
-        if self.probs is NULL:
-            raise MemoryError('allocation error')
-        for n in range(entries):
-            self.probs[n] = INFINITY
+        self.pool = pool
+        probsentries = compactcellidx(
+            self.lensent - 1, self.lensent, self.lensent,
+            grammar.nonterminals) + grammar.nonterminals
         # store parse forest in array instead of dict
         # FIXME: use compactcellidx?
-        entries = cellidx(self.lensent - 1, self.lensent, self.lensent,
-                          grammar.nonterminals) + grammar.nonterminals
-        self.parseforest = <EdgesStruct * >calloc(entries, sizeof(EdgesStruct))
-        if self.parseforest is NULL:
-            raise MemoryError('allocation error')
-        self.itemsinorder = array(b'L' if PY2 else 'L')
+        forestentries = cellidx(self.lensent - 1, self.lensent, self.lensent,
+                                grammar.nonterminals) + grammar.nonterminals
+        if pool is not None and pool.len:
+            # reuse buffers of a previous chart; grow them if necessary
+            pool.len -= 1
+            buf = &(pool.buffers[pool.len])
+            self.probs, self.probssize = buf.probs, buf.probssize
+            self.parseforest, self.forestsize = (
+                buf.parseforest, buf.forestsize)
+            self.arenas, self.numarenas = buf.arenas, buf.numarenas
+            for n in range(self.numarenas):
+                arenareset(&(self.arenas[n]))
+            if self.forestsize >= forestentries:
+                memset(self.parseforest, 0,
+                       forestentries * sizeof(EdgesStruct))
+        if self.probssize < probsentries:
+            free(self.probs)
+            self.probs = <double * >malloc(probsentries * sizeof(double))
+            if self.probs is NULL:
+                raise MemoryError('allocation error')
+            self.probssize = probsentries
+        for n in range(probsentries):
+            self.probs[n] = INFINITY
+        if self.forestsize < forestentries:
+            free(self.parseforest)
+            self.parseforest = <EdgesStruct * >calloc(
+                forestentries, sizeof(EdgesStruct))
+            if self.parseforest is NULL:
+                raise MemoryError('allocation error')
+            self.forestsize = forestentries
+        if self.arenas is NULL:
+            # the edges themselves are allocated in bulk from an arena
+            self.arenas = <EdgeArena * >calloc(1, sizeof(EdgeArena))
+            if self.arenas is NULL:
+                raise MemoryError('allocation error')
+            self.numarenas = 1
+        self.itemsinorder = array(b'L' if PY2 else 'Q')
 
     def __dealloc__(self):
-        cdef size_t n, entries = cellidx(
-            self.lensent - 1, self.lensent, self.lensent,
-            self.grammar.nonterminals) + self.grammar.nonterminals
-        cdef MoreEdges * cur
-        cdef MoreEdges * tmp
-        if self.probs is not NULL:
-            free(self.probs)
-        for n in range(entries):
-            cur = self.parseforest[n].head
-            while cur is not NULL:
-                tmp = cur
-                cur = cur.prev
-                free(tmp)
+        cdef ChartBuffers * buf
+        cdef size_t nbytes
+        cdef int n
+        cdef bint keep = (
+            self.pool is not None and self.pool.len < self.pool.maxsize
+            and self.probs is not NULL and self.parseforest is not NULL
+            and self.arenas is not NULL)
+        if keep:
+            # keep buffers for reuse by another chart, unless they are too
+            # large; arena slabs left over from larger charts are freed.
+            nbytes = (self.probssize * sizeof(double)
+                      + self.forestsize * sizeof(EdgesStruct))
+            for n in range(self.numarenas):
+                nbytes += arenatrim(&(self.arenas[n]))
+            keep = nbytes <= self.pool.maxbytes
+        if keep:
+            buf = &(self.pool.buffers[self.pool.len])
+            self.pool.len += 1
+            buf.probs, buf.probssize = self.probs, self.probssize
+            buf.parseforest, buf.forestsize = (
+                self.parseforest, self.forestsize)
+            buf.arenas, buf.numarenas = self.arenas, self.numarenas
+            return
+        if self.arenas is not NULL:
+            for n in range(self.numarenas):
+                arenafree(&(self.arenas[n]))
+            free(self.arenas)
+        free(self.probs)
         free(self.parseforest)
 
     cdef void addedge(self, uint32_t lhs, Idx start, Idx end, Idx mid,
@@ -123,49 +264,16 @@ cdef class DenseCFGChart(CFGChart):
         """Add new edge to parse forest."""
         cdef size_t item = cellidx(
             start, end, self.lensent, self.grammar.nonterminals) + lhs
-        cdef Edge * edge
-        cdef EdgesStruct * edges = &(self.parseforest[item])
-        cdef MoreEdges * edgelist
-        if edges.head is NULL:
-            edgelist = <MoreEdges * >calloc(1, sizeof(MoreEdges))
-            if edgelist is NULL:
-                abort()
-            edgelist.prev = NULL
-            edges.head = edgelist
+        if addedgestruct(&(self.parseforest[item]), mid, rule,
+                         self.arenas):
             self.itemsinorder.append(item)
-        else:
-            edgelist = edges.head
-            if edges.len == EDGES_SIZE:
-                edgelist = <MoreEdges * >calloc(1, sizeof(MoreEdges))
-                if edgelist is NULL:
-                    abort()
-                edgelist.prev = edges.head
-                edges.head = edgelist
-                edges.len = 0
-        edge = &(edgelist.data[edges.len])
-        edge.rule = rule
-        edge.pos.mid = mid
-        edges.len += 1
 
     cdef bint updateprob(self, uint32_t lhs, Idx start, Idx end, double prob,
                          double beam):
         """Update probability for item if better than current one."""
-        cdef size_t idx = compactcellidx(
-            start, end, self.lensent, self.grammar.nonterminals) + lhs
-        cdef size_t beamitem
-        if beam:
-            # the item with label 0 for a cell holds the best score in a cell
-            beamitem = compactcellidx(
-                start, end, self.lensent, self.grammar.nonterminals)
-            if prob > self.probs[beamitem] + beam:
-                return False
-            elif prob < self.probs[beamitem]:
-                self.probs[beamitem] = self.probs[idx] = prob
-            elif prob < self.probs[idx]:
-                self.probs[idx] = prob
-        elif prob < self.probs[idx]:
-            self.probs[idx] = prob
-        return True
+        return updateprobdense(self.probs, compactcellidx(
+            start, end, self.lensent, self.grammar.nonterminals),
+            lhs, prob, beam)
 
     cdef double _subtreeprob(self, size_t item):
         """Get viterbi / inside probability of a subtree headed by `item`."""
@@ -237,7 +345,7 @@ cdef class SparseCFGChart(CFGChart):
         self.viterbi = viterbi
         self.probs = {}
         self.parseforest = {}
-        self.itemsinorder = array(b'L' if PY2 else 'L')
+        self.itemsinorder = array(b'L' if PY2 else 'Q')
 
     def __dealloc__(self):
         cdef MoreEdges * cur
@@ -317,8 +425,10 @@ cdef class SparseCFGChart(CFGChart):
         self.probs[item] = prob
 
 
-def parse(sent, Grammar grammar, tags=None, start=None, list whitelist=None,
-          bint symbolic=False, double beam_beta=0.0, int beam_delta=50):
+def parse(sent, Grammar grammar, tags=None, start=None, whitelist=None,
+          bint symbolic=False, double beam_beta=0.0, int beam_delta=50,
+          double maxtime=0.0, size_t maxitems=0, int numthreads=1,
+          ChartPool pool=None):
     """A CKY parser modeled after Bodenstab's 'fast grammar loop'.
 
     :param sent: A sequence of tokens that will be parsed.
@@ -329,9 +439,9 @@ def parse(sent, Grammar grammar, tags=None, start=None, list whitelist=None,
     :param start: integer corresponding to the start symbol that complete
             derivations should be headed by; e.g., ``grammar.toid['ROOT']``.
             If not given, the default specified by ``grammar`` is used.
-    :param whitelist: a list of items that may enter the chart.
-            The whitelist is a list of cells consisting of sets of labels:
-            ``whitelist = [{label1, label2, ...}, ...]``;
+    :param whitelist: a ``CFGWhitelist`` with the labels that may enter
+            each cell of the chart, or a list of cells consisting of sets of
+            labels: ``whitelist = [{label1, label2, ...}, ...]``;
             The cells are indexed as compact spans; label is an integer for a
             non-terminal label. The presence of a label means the span with that
             label will not be pruned.
@@ -341,39 +451,66 @@ def parse(sent, Grammar grammar, tags=None, start=None, list whitelist=None,
             items which are within a multiple of ``beam_beta`` of the best score.
             Should be a negative log probability. Pass ``0.0`` to disable.
     :param beam_delta: the maximum span length to which beam search is applied.
+    :param numthreads: if > 1, parse the cells of each span length in
+            parallel with this many threads, without holding the GIL. Only
+            applies to the dense chart without a whitelist; gives the same
+            chart as sequential parsing.
+    :param pool: a ``ChartPool`` from which to reuse the buffers of
+            previously discarded charts (applies to the dense chart).
+    :param maxtime: abort parsing after this many seconds of wall time;
+            pass ``0.0`` to disable.
+    :param maxitems: abort parsing when the chart contains more than this
+            number of items; pass ``0`` to disable.
+
+    When one of these limits is exceeded, an empty chart is returned (i.e.,
+    no parse), and the message reports which limit was exceeded. The limits
+    are checked after each cell (in parallel mode: after each span length),
+    and are not applied in symbolic mode.
     """
     if grammar.maxfanout != 1:
         raise ValueError('Not a PCFG! fanout: %d' % grammar.maxfanout)
     if not grammar.logprob:
         raise ValueError('Expected grammar with log probabilities.')
-    if grammar.nonterminals < 20000:
-        chart = DenseCFGChart(grammar, sent, start)
+    if whitelist is not None and not isinstance(whitelist, CFGWhitelist):
+        whitelist = CFGWhitelist.fromsets(whitelist, grammar.nonterminals)
+    if (grammar.nonterminals < 20000 and len(sent) * len(sent)
+            * grammar.nonterminals <= MAX_DENSE_CHART):
+        chart = DenseCFGChart(grammar, sent, start, pool=pool)
         if symbolic:
             return parse_symbolic(sent, < DenseCFGChart > chart, grammar,
-                                  tags=tags, whitelist=whitelist)
+                                  tags=tags, whitelist=<CFGWhitelist>whitelist)
+        elif numthreads > 1 and whitelist is None:
+            return parse_parallel(sent, < DenseCFGChart > chart, grammar,
+                                  tags, beam_beta, beam_delta,
+                                  maxtime, maxitems, numthreads)
         return parse_main(sent, < DenseCFGChart > chart, grammar, tags,
-                          whitelist, beam_beta, beam_delta)
+                          <CFGWhitelist>whitelist, beam_beta, beam_delta,
+                          maxtime, maxitems)
     chart = SparseCFGChart(grammar, sent, start)
     if symbolic:
         return parse_symbolic(sent, < SparseCFGChart > chart, grammar,
-                              tags=tags, whitelist=whitelist)
+                              tags=tags, whitelist=<CFGWhitelist>whitelist)
     return parse_main(sent, < SparseCFGChart > chart, grammar, tags,
-                      whitelist, beam_beta, beam_delta)
+                      <CFGWhitelist>whitelist, beam_beta, beam_delta,
+                      maxtime, maxitems)
 
 
 cdef parse_main(sent, CFGChart_fused chart, Grammar grammar, tags,
-                list whitelist, double beam_beta, int beam_delta):
+                CFGWhitelist whitelist, double beam_beta, int beam_delta,
+                double maxtime, size_t maxitems):
     cdef:
         short[:, :] minleft, maxleft, minright, maxright
         DoubleAgenda unaryagenda = DoubleAgenda()
-        set cellwhitelist = None
+        uint64_t * cellwhitelist = NULL
+        int label
         ProbRule * rule
         short left, right, mid, span, lensent = len(sent)
         short narrowl, narrowr, widel, wider, minmid, maxmid
-        double oldscore, prob
+        double oldscore, prob, deadline = time.time() + maxtime
         uint32_t n, lhs = 0, rhs1
         size_t cell, lastidx
-        object it = None
+        size_t * cells = NULL
+        double * scores = NULL
     minleft, maxleft, minright, maxright = minmaxmatrices(
         grammar.nonterminals, lensent)
     # assign POS tags
@@ -381,119 +518,476 @@ cdef parse_main(sent, CFGChart_fused chart, Grammar grammar, tags,
                                minleft, maxleft, minright, maxright)
     if not covered:
         return chart, msg
-
-    for span in range(2, lensent + 1):
-        # constituents from left to right
-        for left in range(lensent - span + 1):
-            right = left + span
-            cell = cellidx(left, right, lensent, grammar.nonterminals)
-            lastidx = len(chart.itemsinorder)
-            if whitelist is not None:
-                cellwhitelist = <set > whitelist[
-                    compactcellidx(left, right, lensent, 1)]
-            # apply binary rules; if whitelist is given, loop only over
-            # whitelisted labels for cell; equivalent to:
-            # for lhs in cellwhitelist or range(1, grammar.phrasalnonterminals):
-            if whitelist is None:
+    try:
+        if CFGChart_fused is DenseCFGChart:
+            # for each split point mid of the current cell: offsets of the left
+            # and right cells in chart.probs at cells[2 * mid] and
+            # cells[2 * mid + 1], and the score of the current rule.
+            cells = <size_t * >malloc(2 * (lensent + 1) * sizeof(size_t))
+            scores = <double * >malloc((lensent + 1) * sizeof(double))
+            if cells is NULL or scores is NULL:
+                raise MemoryError('allocation error')
+
+        for span in range(2, lensent + 1):
+            # constituents from left to right
+            for left in range(lensent - span + 1):
+                right = left + span
+                cell = cellidx(left, right, lensent, grammar.nonterminals)
+                lastidx = len(chart.itemsinorder)
+                if CFGChart_fused is DenseCFGChart:
+                    for mid in range(left + 1, right):
+                        cells[2 * mid] = compactcellidx(
+                            left, mid, lensent, grammar.nonterminals)
+                        cells[2 * mid + 1] = compactcellidx(
+                            mid, right, lensent, grammar.nonterminals)
+                if whitelist is not None:
+                    cellwhitelist = cfgcellbits(
+                        whitelist, compactcellidx(left, right, lensent, 1))
+                # apply binary rules; if whitelist is given, loop only over
+                # whitelisted labels for cell; equivalent to:
+                # for lhs in (cellwhitelist
+                #         or range(1, grammar.phrasalnonterminals)):
                 lhs = 0
-            else:
-                it = iter(cellwhitelist)
-            while True:
-                if whitelist is None:
-                    lhs += 1
-                    if lhs >= grammar.phrasalnonterminals:
-                        break
-                else:
-                    try:
-                        lhs = next(it)
-                    except StopIteration:
-                        break
-                n = 0
-                rule = &(grammar.bylhs[lhs][n])
-                oldscore = chart._subtreeprob(cell + lhs)
-                while rule.lhs == lhs:
-                    narrowr = minright[rule.rhs1, left]
-                    narrowl = minleft[rule.rhs2, right]
-                    if (rule.rhs2 == 0 or narrowr >= right or narrowl < narrowr
-                            or TESTBIT(grammar.mask, rule.no)):
+                while True:
+                    if whitelist is None:
+                        lhs += 1
+                        if lhs >= grammar.phrasalnonterminals:
+                            break
+                    else:
+                        label = anextset(cellwhitelist, lhs + 1,
+                                         whitelist.slots)
+                        if label == -1:
+                            break
+                        lhs = label
+                    n = 0
+                    rule = &(grammar.bylhs[lhs][n])
+                    oldscore = chart._subtreeprob(cell + lhs)
+                    while rule.lhs == lhs:
+                        narrowr = minright[rule.rhs1, left]
+                        narrowl = minleft[rule.rhs2, right]
+                        if (rule.rhs2 == 0 or narrowr >= right
+                                or narrowl < narrowr
+                                or TESTBIT(grammar.mask, rule.no)):
+                            n += 1
+                            rule = &(grammar.bylhs[lhs][n])
+                            continue
+                        widel = maxleft[rule.rhs2, right]
+                        minmid = narrowr if narrowr > widel else widel
+                        wider = maxright[rule.rhs1, left]
+                        maxmid = wider if wider < narrowl else narrowl
+                        if CFGChart_fused is DenseCFGChart:
+                            # first compute the scores for all split points
+                            # in a tight loop over the probs array; absent
+                            # items have an infinite score. Then add edges
+                            # for valid scores.
+                            for mid in range(minmid, maxmid + 1):
+                                scores[mid] = (
+                                    chart.probs[cells[2 * mid] + rule.rhs1]
+                                    + chart.probs[cells[2 * mid + 1]
+                                                  + rule.rhs2])
+                            for mid in range(minmid, maxmid + 1):
+                                if isfinite(scores[mid]) and chart.updateprob(
+                                        lhs, left, right,
+                                        rule.prob + scores[mid],
+                                        beam_beta if span <= beam_delta
+                                        else 0.0):
+                                    chart.addedge(lhs, left, right, mid, rule)
+                        else:
+                            for mid in range(minmid, maxmid + 1):
+                                leftitem = cellidx(
+                                    left, mid, lensent,
+                                    grammar.nonterminals) + rule.rhs1
+                                rightitem = cellidx(
+                                    mid, right, lensent,
+                                    grammar.nonterminals) + rule.rhs2
+                                if (chart.hasitem(leftitem)
+                                        and chart.hasitem(rightitem)):
+                                    prob = (rule.prob
+                                            + chart._subtreeprob(leftitem)
+                                            + chart._subtreeprob(rightitem))
+                                    if chart.updateprob(
+                                            lhs, left, right, prob,
+                                            beam_beta if span <= beam_delta
+                                            else 0.0):
+                                        chart.addedge(
+                                            lhs, left, right, mid, rule)
                         n += 1
                         rule = &(grammar.bylhs[lhs][n])
-                        continue
-                    widel = maxleft[rule.rhs2, right]
-                    minmid = narrowr if narrowr > widel else widel
-                    wider = maxright[rule.rhs1, left]
-                    maxmid = wider if wider < narrowl else narrowl
-                    for mid in range(minmid, maxmid + 1):
-                        leftitem = cellidx(left, mid,
-                                           lensent, grammar.nonterminals) + rule.rhs1
-                        rightitem = cellidx(mid, right,
-                                            lensent, grammar.nonterminals) + rule.rhs2
-                        if (chart.hasitem(leftitem)
-                                and chart.hasitem(rightitem)):
-                            prob = (rule.prob + chart._subtreeprob(leftitem)
-                                    + chart._subtreeprob(rightitem))
-                            if chart.updateprob(lhs, left, right, prob,
-                                                beam_beta if span <= beam_delta else 0.0):
-                                chart.addedge(lhs, left, right, mid, rule)
-                    n += 1
-                    rule = &(grammar.bylhs[lhs][n])
 
-                # update filter
-                if isinf(oldscore):
-                    if not chart.hasitem(cell + lhs):
-                        continue
-                    if left > minleft[lhs, right]:
-                        minleft[lhs, right] = left
-                    if left < maxleft[lhs, right]:
-                        maxleft[lhs, right] = left
-                    if right < minright[lhs, left]:
-                        minright[lhs, left] = right
-                    if right > maxright[lhs, left]:
-                        maxright[lhs, left] = right
-
-            # unary rules
-            unaryagenda.update_entries([new_DoubleEntry(
-                chart.label(item), chart._subtreeprob(item), 0)
-                for item in chart.itemsinorder[lastidx:]])
-            while unaryagenda.length:
-                rhs1 = unaryagenda.popentry().key
-                for n in range(grammar.numunary):
-                    rule = &(grammar.unary[rhs1][n])
-                    if rule.rhs1 != rhs1:
-                        break
-                    elif TESTBIT(grammar.mask, rule.no) or (
-                            whitelist is not None
-                            and rule.lhs not in cellwhitelist):
-                        continue
-                    lhs = rule.lhs
-                    prob = rule.prob + chart._subtreeprob(cell + rhs1)
-                    chart.addedge(lhs, left, right, right, rule)
-                    if (not chart.hasitem(cell + lhs)
-                            or prob < chart._subtreeprob(cell + lhs)):
-                        chart.updateprob(lhs, left, right, prob, 0.0)
-                        unaryagenda.setifbetter(lhs, prob)
                     # update filter
-                    if left > minleft[lhs, right]:
-                        minleft[lhs, right] = left
-                    if left < maxleft[lhs, right]:
-                        maxleft[lhs, right] = left
-                    if right < minright[lhs, left]:
-                        minright[lhs, left] = right
-                    if right > maxright[lhs, left]:
-                        maxright[lhs, left] = right
-            unaryagenda.clear()
+                    if isinf(oldscore):
+                        if not chart.hasitem(cell + lhs):
+                            continue
+                        if left > minleft[lhs, right]:
+                            minleft[lhs, right] = left
+                        if left < maxleft[lhs, right]:
+                            maxleft[lhs, right] = left
+                        if right < minright[lhs, left]:
+                            minright[lhs, left] = right
+                        if right > maxright[lhs, left]:
+                            maxright[lhs, left] = right
+
+                # unary rules
+                unaryagenda.update_entries([new_DoubleEntry(
+                    chart.label(item), chart._subtreeprob(item), 0)
+                    for item in chart.itemsinorder[lastidx:]])
+                while unaryagenda.length:
+                    rhs1 = unaryagenda.popentry().key
+                    for n in range(grammar.numunary):
+                        rule = &(grammar.unary[rhs1][n])
+                        if rule.rhs1 != rhs1:
+                            break
+                        elif TESTBIT(grammar.mask, rule.no) or (
+                                whitelist is not None
+                                and not TESTBIT(cellwhitelist, rule.lhs)):
+                            continue
+                        lhs = rule.lhs
+                        prob = rule.prob + chart._subtreeprob(cell + rhs1)
+                        chart.addedge(lhs, left, right, right, rule)
+                        if (not chart.hasitem(cell + lhs)
+                                or prob < chart._subtreeprob(cell + lhs)):
+                            chart.updateprob(lhs, left, right, prob, 0.0)
+                            unaryagenda.setifbetter(lhs, prob)
+                        # update filter
+                        if left > minleft[lhs, right]:
+                            minleft[lhs, right] = left
+                        if left < maxleft[lhs, right]:
+                            maxleft[lhs, right] = left
+                        if right < minright[lhs, left]:
+                            minright[lhs, left] = right
+                        if right > maxright[lhs, left]:
+                            maxright[lhs, left] = right
+                unaryagenda.clear()
+                # check whether this sentence is taking too many resources
+                if ((maxitems and len(chart.itemsinorder) > maxitems)
+                        or (maxtime and time.time() > deadline)):
+                    # discard incomplete chart
+                    msg = 'no parse: %s limit exceeded; %s' % (
+                        'chart size' if maxitems
+                        and len(chart.itemsinorder) > maxitems else 'time',
+                        chart.stats())
+                    return chart.__class__(grammar, list(sent),
+                                           grammar.tolabel[chart.start]), msg
+    finally:
+        free(cells)
+        free(scores)
+    if not chart:
+        return chart, 'no parse ' + chart.stats()
+    return chart, chart.stats()
+
+
+cdef struct UnaryEntry:
+    double prob
+    uint64_t count  # insertion order; breaks ties
+    uint32_t label
+
+
+cdef struct CellWorkspace:
+    # scratch space of a thread in parse_parallel()
+    # for each split point mid: offsets of the left and right cells in
+    # chart.probs at cells[2 * mid] and cells[2 * mid + 1]; cf. parse_main()
+    size_t * cells
+    double * scores  # score of current rule for each split point
+    UnaryEntry * heap  # unary agenda as binary heap on (prob, count)
+    size_t heaplen, heapcap
+    uint64_t counter
+    double * agendaprob  # label => prob of valid entry on agenda
+    uint64_t * agendacount  # label => count of valid entry on agenda
+    uint8_t * onagenda  # label => whether label has a valid entry
+
+
+cdef parse_parallel(sent, DenseCFGChart chart, Grammar grammar, tags,
+                    double beam_beta, int beam_delta,
+                    double maxtime, size_t maxitems, int numthreads):
+    """Like parse_main(), but parse the cells of a span length in parallel.
+
+    The cells with the same span length only depend on cells with shorter
+    spans, and each cell only updates the filter matrices at its own left and
+    right index; therefore the cells of a span length are parsed
+    independently without the GIL. Afterwards, the new items are added to
+    ``chart.itemsinorder`` in the same order as sequential parsing."""
+    cdef:
+        short[:, :] minleft, maxleft, minright, maxright
+        CellWorkspace * workspaces = NULL
+        CellWorkspace * ws
+        EdgeArena * arenas
+        uint32_t * newitems = NULL
+        size_t * numnew = NULL
+        short left, span, lensent = len(sent)
+        size_t n, cell, nonterminals = grammar.nonterminals
+        double beam, deadline = time.time() + maxtime
+        int tid
+    minleft, maxleft, minright, maxright = minmaxmatrices(
+        grammar.nonterminals, lensent)
+    # assign POS tags
+    covered, msg = populatepos(grammar, chart, sent, tags,
+                               <CFGWhitelist>None, False,
+                               minleft, maxleft, minright, maxright)
+    if not covered:
+        return chart, msg
+    try:
+        # for each cell of the current span length: the labels of new items
+        newitems = <uint32_t * >malloc(
+            lensent * nonterminals * sizeof(uint32_t))
+        numnew = <size_t * >malloc(lensent * sizeof(size_t))
+        workspaces = <CellWorkspace * >calloc(
+            numthreads, sizeof(CellWorkspace))
+        if newitems is NULL or numnew is NULL or workspaces is NULL:
+            raise MemoryError('allocation error')
+        for tid in range(numthreads):
+            ws = &(workspaces[tid])
+            ws.cells = <size_t * >malloc(
+                2 * (lensent + 1) * sizeof(size_t))
+            ws.scores = <double * >malloc((lensent + 1) * sizeof(double))
+            ws.heapcap = nonterminals
+            ws.heap = <UnaryEntry * >malloc(ws.heapcap * sizeof(UnaryEntry))
+            ws.agendaprob = <double * >malloc(nonterminals * sizeof(double))
+            ws.agendacount = <uint64_t * >malloc(
+                nonterminals * sizeof(uint64_t))
+            ws.onagenda = <uint8_t * >calloc(nonterminals, sizeof(uint8_t))
+            if (ws.cells is NULL or ws.scores is NULL or ws.heap is NULL
+                    or ws.agendaprob is NULL or ws.agendacount is NULL
+                    or ws.onagenda is NULL):
+                raise MemoryError('allocation error')
+        # each thread allocates edges from its own arena
+        if chart.numarenas < numthreads:
+            arenas = <EdgeArena * >realloc(
+                chart.arenas, numthreads * sizeof(EdgeArena))
+            if arenas is NULL:
+                raise MemoryError('allocation error')
+            chart.arenas = arenas
+            for tid in range(chart.numarenas, numthreads):
+                arenas[tid].numslabs = arenas[tid].cur = arenas[tid].used = 0
+            chart.numarenas = numthreads
+
+        for span in range(2, lensent + 1):
+            beam = beam_beta if span <= beam_delta else 0.0
+            with nogil:
+                for left in prange(lensent - span + 1, schedule='dynamic',
+                                   num_threads=numthreads):
+                    numnew[left] = parsecell(
+                        chart, grammar, left, left + span, beam,
+                        minleft, maxleft, minright, maxright,
+                        &(workspaces[threadid()]),
+                        &(chart.arenas[threadid()]),
+                        &(newitems[left * nonterminals]))
+            for left in range(lensent - span + 1):
+                cell = cellidx(left, left + span, lensent, nonterminals)
+                for n in range(numnew[left]):
+                    chart.itemsinorder.append(
+                        cell + newitems[left * nonterminals + n])
+            # check whether this sentence is taking too many resources
+            if ((maxitems and len(chart.itemsinorder) > maxitems)
+                    or (maxtime and time.time() > deadline)):
+                # discard incomplete chart
+                msg = 'no parse: %s limit exceeded; %s' % (
+                    'chart size' if maxitems
+                    and len(chart.itemsinorder) > maxitems else 'time',
+                    chart.stats())
+                return chart.__class__(grammar, list(sent),
+                                       grammar.tolabel[chart.start]), msg
+    finally:
+        if workspaces is not NULL:
+            for tid in range(numthreads):
+                ws = &(workspaces[tid])
+                free(ws.cells)
+                free(ws.scores)
+                free(ws.heap)
+                free(ws.agendaprob)
+                free(ws.agendacount)
+                free(ws.onagenda)
+        free(workspaces)
+        free(newitems)
+        free(numnew)
     if not chart:
         return chart, 'no parse ' + chart.stats()
     return chart, chart.stats()
 
 
+cdef size_t parsecell(DenseCFGChart chart, Grammar grammar,
+                      short left, short right, double beam,
+                      short[:, :] minleft, short[:, :] maxleft,
+                      short[:, :] minright, short[:, :] maxright,
+                      CellWorkspace * ws, EdgeArena * arena,
+                      uint32_t * newitems) nogil:
+    """Apply binary and unary rules to a single cell of a dense chart.
+
+    :returns: the number of new items in the cell; their labels are stored
+        in ``newitems``, in the order they were added."""
+    cdef:
+        ProbRule * rule
+        short mid, narrowl, narrowr, widel, wider, minmid, maxmid
+        short lensent = chart.lensent
+        uint32_t lhs, rhs1
+        size_t n, numnew = 0
+        size_t cell = cellidx(left, right, lensent, grammar.nonterminals)
+        size_t compactcell = compactcellidx(
+            left, right, lensent, grammar.nonterminals)
+        double oldscore, prob
+    for mid in range(left + 1, right):
+        ws.cells[2 * mid] = compactcellidx(
+            left, mid, lensent, grammar.nonterminals)
+        ws.cells[2 * mid + 1] = compactcellidx(
+            mid, right, lensent, grammar.nonterminals)
+    # binary rules
+    for lhs in range(1, grammar.phrasalnonterminals):
+        n = 0
+        rule = &(grammar.bylhs[lhs][n])
+        oldscore = chart.probs[compactcell + lhs]
+        while rule.lhs == lhs:
+            narrowr = minright[rule.rhs1, left]
+            narrowl = minleft[rule.rhs2, right]
+            if (rule.rhs2 == 0 or narrowr >= right or narrowl < narrowr
+                    or TESTBIT(grammar.mask, rule.no)):
+                n += 1
+                rule = &(grammar.bylhs[lhs][n])
+                continue
+            widel = maxleft[rule.rhs2, right]
+            minmid = narrowr if narrowr > widel else widel
+            wider = maxright[rule.rhs1, left]
+            maxmid = wider if wider < narrowl else narrowl
+            for mid in range(minmid, maxmid + 1):
+                ws.scores[mid] = (
+                    chart.probs[ws.cells[2 * mid] + rule.rhs1]
+                    + chart.probs[ws.cells[2 * mid + 1] + rule.rhs2])
+            for mid in range(minmid, maxmid + 1):
+                if isfinite(ws.scores[mid]) and updateprobdense(
+                        chart.probs, compactcell, lhs,
+                        rule.prob + ws.scores[mid], beam):
+                    if addedgestruct(&(chart.parseforest[cell + lhs]),
+                                     mid, rule, arena):
+                        newitems[numnew] = lhs
+                        numnew += 1
+            n += 1
+            rule = &(grammar.bylhs[lhs][n])
+
+        # update filter
+        if isinf(oldscore):
+            if chart.parseforest[cell + lhs].head is NULL:
+                continue
+            if left > minleft[lhs, right]:
+                minleft[lhs, right] = left
+            if left < maxleft[lhs, right]:
+                maxleft[lhs, right] = left
+            if right < minright[lhs, left]:
+                minright[lhs, left] = right
+            if right > maxright[lhs, left]:
+                maxright[lhs, left] = right
+
+    # unary rules
+    ws.counter = 1
+    for n in range(numnew):
+        agendasetifbetter(ws, newitems[n],
+                          chart.probs[compactcell + newitems[n]])
+    rhs1 = agendapop(ws)
+    while rhs1:
+        for n in range(grammar.numunary):
+            rule = &(grammar.unary[rhs1][n])
+            if rule.rhs1 != rhs1:
+                break
+            elif TESTBIT(grammar.mask, rule.no):
+                continue
+            lhs = rule.lhs
+            prob = rule.prob + chart.probs[compactcell + rhs1]
+            if addedgestruct(&(chart.parseforest[cell + lhs]), right, rule,
+                             arena):
+                newitems[numnew] = lhs
+                numnew += 1
+            if prob < chart.probs[compactcell + lhs]:
+                chart.probs[compactcell + lhs] = prob
+                agendasetifbetter(ws, lhs, prob)
+            # update filter
+            if left > minleft[lhs, right]:
+                minleft[lhs, right] = left
+            if left < maxleft[lhs, right]:
+                maxleft[lhs, right] = left
+            if right < minright[lhs, left]:
+                minright[lhs, left] = right
+            if right > maxright[lhs, left]:
+                maxright[lhs, left] = right
+        rhs1 = agendapop(ws)
+    return numnew
+
+
+cdef inline bint entrylt(UnaryEntry * a, UnaryEntry * b) nogil:
+    return a.prob < b.prob or (a.prob == b.prob and a.count < b.count)
+
+
+cdef void agendasetifbetter(CellWorkspace * ws, uint32_t label,
+                            double prob) nogil:
+    """Push label on unary agenda if new or better than its current entry.
+
+    Equivalent to ``DoubleAgenda.setifbetter()``: a decreased key keeps its
+    count, the old entry is invalidated."""
+    cdef UnaryEntry entry
+    cdef UnaryEntry * heap
+    cdef size_t pos, parent
+    if ws.onagenda[label]:
+        if prob >= ws.agendaprob[label]:
+            return
+        entry.count = ws.agendacount[label]
+    else:
+        entry.count = ws.counter
+        ws.counter += 1
+        ws.onagenda[label] = 1
+        ws.agendacount[label] = entry.count
+    ws.agendaprob[label] = prob
+    entry.prob = prob
+    entry.label = label
+    if ws.heaplen == ws.heapcap:
+        ws.heapcap *= 2
+        heap = <UnaryEntry * >realloc(ws.heap, ws.heapcap * sizeof(UnaryEntry))
+        if heap is NULL:
+            abort()
+        ws.heap = heap
+    pos = ws.heaplen
+    ws.heaplen += 1
+    while pos > 0:
+        parent = (pos - 1) >> 1
+        if not entrylt(&entry, &(ws.heap[parent])):
+            break
+        ws.heap[pos] = ws.heap[parent]
+        pos = parent
+    ws.heap[pos] = entry
+
+
+cdef uint32_t agendapop(CellWorkspace * ws) nogil:
+    """Pop best label from unary agenda, skipping invalidated entries.
+
+    :returns: the label, or 0 if the agenda is empty."""
+    cdef UnaryEntry entry, last
+    cdef size_t pos, child
+    while ws.heaplen:
+        entry = ws.heap[0]
+        ws.heaplen -= 1
+        last = ws.heap[ws.heaplen]
+        pos = 0
+        child = 1
+        while child < ws.heaplen:
+            if (child + 1 < ws.heaplen
+                    and entrylt(&(ws.heap[child + 1]), &(ws.heap[child]))):
+                child += 1
+            if not entrylt(&(ws.heap[child]), &last):
+                break
+            ws.heap[pos] = ws.heap[child]
+            pos = child
+            child = 2 * pos + 1
+        ws.heap[pos] = last
+        if (ws.onagenda[entry.label]
+                and entry.count == ws.agendacount[entry.label]
+                and entry.prob == ws.agendaprob[entry.label]):
+            ws.onagenda[entry.label] = 0
+            return entry.label
+    return 0
+
+
 cdef parse_symbolic(sent, CFGChart_fused chart, Grammar grammar,
-                    tags=None, list whitelist=None):
+                    tags=None, CFGWhitelist whitelist=None):
     cdef:
         short[:, :] minleft, maxleft, minright, maxright
         list unaryagenda
-        set cellwhitelist = None
-        object it = None
+        uint64_t * cellwhitelist = NULL
+        int label
         ProbRule * rule
         short left, right, mid, span, lensent = len(sent)
         short narrowl, narrowr, widel, wider, minmid, maxmid
@@ -515,26 +1009,23 @@ cdef parse_symbolic(sent, CFGChart_fused chart, Grammar grammar,
             cell = cellidx(left, right, lensent, grammar.nonterminals)
             lastidx = len(chart.itemsinorder)
             if whitelist is not None:
-                cellwhitelist = <set > whitelist[
-                    compactcellidx(left, right, lensent, 1)]
+                cellwhitelist = cfgcellbits(
+                    whitelist, compactcellidx(left, right, lensent, 1))
             # apply binary rules; if whitelist is given, loop only over
             # whitelisted labels for cell
             # for lhs in (range(1, grammar.phrasalnonterminals)
             # 		if whitelist is None else cellwhitelist):
-            if whitelist is None:
-                lhs = 0
-            else:
-                it = iter(cellwhitelist)
+            lhs = 0
             while True:
                 if whitelist is None:
                     lhs += 1
                     if lhs >= grammar.phrasalnonterminals:
                         break
                 else:
-                    try:
-                        lhs = next(it)
-                    except StopIteration:
+                    label = anextset(cellwhitelist, lhs + 1, whitelist.slots)
+                    if label == -1:
                         break
+                    lhs = label
                 n = 0
                 rule = &(grammar.bylhs[lhs][n])
                 haditem = chart.hasitem(cell + lhs)
@@ -584,7 +1075,7 @@ cdef parse_symbolic(sent, CFGChart_fused chart, Grammar grammar,
                         break
                     elif TESTBIT(grammar.mask, rule.no) or (
                             whitelist is not None
-                            and rule.lhs not in cellwhitelist):
+                            and not TESTBIT(cellwhitelist, rule.lhs)):
                         continue
                     lhs = rule.lhs
                     chart.addedge(lhs, left, right, right, rule)
@@ -604,7 +1095,8 @@ cdef parse_symbolic(sent, CFGChart_fused chart, Grammar grammar,
     return chart, chart.stats()
 
 
-cdef populatepos(Grammar grammar, CFGChart_fused chart, sent, tags, whitelist,
+cdef populatepos(Grammar grammar, CFGChart_fused chart, sent, tags,
+                 CFGWhitelist whitelist,
                  bint symbolic, short[:, :] minleft, short[:, :] maxleft,
                  short[:, :] minright, short[:, :] maxright):
     """Apply all possible lexical and unary rules on each lexical span.
@@ -614,8 +1106,8 @@ cdef populatepos(Grammar grammar, CFGChart_fused chart, sent, tags, whitelist,
     cdef:
         DoubleAgenda unaryagenda = DoubleAgenda()
         ProbRule * rule
-        LexicalRule lexrule
-        uint32_t n, lhs, rhs1
+        uint32_t n, m, lhs, rhs1
+        int wordid
         short left, right, lensent = len(sent)
     for left, word in enumerate(sent):
         tag = tags[left] if tags else None
@@ -625,17 +1117,19 @@ cdef populatepos(Grammar grammar, CFGChart_fused chart, sent, tags, whitelist,
         tagre = re.compile('%s($|@|\\^|/)' % re.escape(tag)) if tags else None
         right = left + 1
         recognized = False
-        for lexrule in grammar.lexicalbyword.get(word, ()):
+        wordid = grammar.wordid(word)
+        for m in range(grammar.lexwordidx[wordid] if wordid != -1 else 0,
+                       grammar.lexwordidx[wordid + 1] if wordid != -1 else 0):
+            lhs = grammar.lexlhs[m]
             # assert whitelist is None or cell in whitelist, whitelist.keys()
-            if whitelist is not None and lexrule.lhs not in whitelist[
-                    compactcellidx(left, right, lensent, 1)]:
+            if whitelist is not None and not TESTBIT(cfgcellbits(
+                    whitelist, compactcellidx(left, right, lensent, 1)), lhs):
                 continue
-            lhs = lexrule.lhs
             if tag is None or tagre.match(grammar.tolabel[lhs]):
                 chart.addedge(lhs, left, right, right, NULL)
                 chart.updateprob(lhs, left, right,
-                                 0.0 if symbolic else lexrule.prob, 0.0)
-                unaryagenda.setitem(lhs, lexrule.prob)
+                                 0.0 if symbolic else grammar.lexprobs[m], 0.0)
+                unaryagenda.setitem(lhs, grammar.lexprobs[m])
                 recognized = True
                 # update filter
                 if left > minleft[lhs, right]:
@@ -649,7 +1143,7 @@ cdef populatepos(Grammar grammar, CFGChart_fused chart, sent, tags, whitelist,
         # NB: use gold tags if given, even if (word, tag) was not part of
         # training data, modulo state splits etc.
         if not recognized and tag is not None:
-            for lhs in grammar.lexicalbylhs:
+            for lhs in grammar.lexicallhs:
                 if tagre.match(grammar.tolabel[lhs]):
                     chart.addedge(lhs, left, right, right, NULL)
                     chart.updateprob(lhs, left, right, 0.0, 0.0)
@@ -665,7 +1159,7 @@ cdef populatepos(Grammar grammar, CFGChart_fused chart, sent, tags, whitelist,
                     if right > maxright[lhs, left]:
                         maxright[lhs, left] = right
         if not recognized:
-            if tag is None and word not in grammar.lexicalbyword:
+            if tag is None and wordid == -1:
                 return chart, 'no parse: %r not in lexicon' % word
             elif tag is not None and tag not in grammar.toid:
                 return chart, 'no parse: unknown tag %r' % tag
@@ -680,8 +1174,8 @@ cdef populatepos(Grammar grammar, CFGChart_fused chart, sent, tags, whitelist,
                     break
                 elif TESTBIT(grammar.mask, rule.no) or (
                     whitelist is not None
-                    and rule.lhs not in whitelist[
-                        compactcellidx(left, right, lensent, 1)]):
+                    and not TESTBIT(cfgcellbits(whitelist, compactcellidx(
+                        left, right, lensent, 1)), rule.lhs)):
                     continue
                 lhs = rule.lhs
                 item = cellidx(left, right, lensent, grammar.nonterminals) + lhs
@@ -888,5 +1382,5 @@ def test():
     # print(msg, '\n', msg1)
 
 
-__all__ = ['CFGChart', 'DenseCFGChart', 'SparseCFGChart', 'parse', 'renumber',
-           'minmaxmatrices', 'parse_bitpar', 'bitpar_yap_forest', 'bitpar_nbest']
+__all__ = ['ChartPool', 'CFGChart', 'DenseCFGChart', 'SparseCFGChart', 'parse',
+           'renumber', 'minmaxmatrices', 'parse_bitpar', 'bitpar_yap_forest', 'bitpar_nbest']
@@ -1,13 +1,15 @@
 cimport cython
 from libc.string cimport memcmp
-from libc.stdlib cimport malloc, calloc, free, abort
+from libc.stdlib cimport malloc, calloc, realloc, free, abort
 from libc.stdint cimport uint8_t, uint32_t, uint64_t
 from cpython.list cimport PyList_GET_ITEM, PyList_GET_SIZE
 from cpython.set cimport PySet_Contains
 from cpython.float cimport PyFloat_AS_DOUBLE
 from .containers cimport Chart, Grammar, ProbRule, LexicalRule, \
     ChartItem, SmallChartItem, FatChartItem, new_SmallChartItem, \
-    new_FatChartItem, Edge, Edges, MoreEdges, Chart, CFGtoFatChartItem
+    new_FatChartItem, Edge, Edges, EdgesStruct, MoreEdges, EdgeArena, \
+    Chart, CFGtoFatChartItem, SpanSet, compactcellidx, spansetcontains, \
+    arenablock, arenafree, PY2
 from .bit cimport nextset, nextunset, bitcount, bitlength, \
     testbit, anextset, anextunset, abitcount, abitlength, setunion
 from libc.string cimport memset, memcpy
@@ -51,6 +53,35 @@ cdef class FatLCFRSChart(LCFRSChart):
                       ProbRule * rule)
 
 
+cdef struct PackedItem:  # an LCFRS item without Python object overhead
+    uint64_t vec
+    uint32_t label
+
+
+cdef struct ItemList:  # a growable array of item ids
+    uint32_t * ids
+    uint32_t len, cap
+
+
+@cython.final
+cdef class PackedLCFRSChart(Chart):
+    cdef PackedItem * items  # item id => label and bit vector
+    cdef double * probs  # item id => viterbi probability
+    cdef double * agendaprobs  # item id => prob. of derivation on agenda
+    cdef EdgesStruct * parseforest  # item id => edges
+    cdef EdgeArena arena  # edge blocks of parseforest
+    cdef uint32_t * table  # open addressing hash table of item ids + 1
+    cdef ItemList * bylabel  # label => ids of items with viterbi prob.
+    cdef uint32_t numitems, capacity, tablesize, numlabels
+    cdef long getid(self, uint32_t label, uint64_t vec)
+    cdef long additem(self, uint32_t label, uint64_t vec) except -1
+    cdef void addedge(self, uint32_t item, uint32_t left, uint32_t right,
+                      ProbRule * rule)
+    cdef void addlexedge(self, uint32_t item, short wordidx)
+    cdef void updateprob(self, uint32_t item, double prob)
+    cpdef bint hasitem(self, item)
+
+
 # FIXME: Entry/Agenda are used in multiple modules; put in containers?
 @cython.final
 cdef class Entry:
@@ -103,4 +134,28 @@ cdef class DoubleAgenda(Agenda):
     cdef DoubleEntry peekentry(self)
     cdef update_entries(self, list entries)
 
+cdef struct IndexedEntry:
+    double value
+    uint64_t count
+    uint32_t key
+
+
+@cython.final
+cdef class IndexedAgenda:
+    cdef IndexedEntry * heap
+    cdef uint32_t * pos  # key => 1 + index of entry in heap; 0 if absent
+    cdef uint64_t length, counter
+    cdef size_t heapcap, poscap
+    cdef bint contains(self, uint32_t key)
+    cdef double getitem(self, uint32_t key)
+    cdef int setitem(self, uint32_t key, double value) except -1
+    cdef IndexedEntry popentry(self)
+    cdef void siftdown(self, size_t pos)
+    cdef void siftup(self, size_t pos)
+
+
+ctypedef fused Agenda_fused:
+    DoubleAgenda
+    IndexedAgenda
+
 cdef list nsmallest(int n, list entries)
@@ -3,7 +3,9 @@
 Expects binarized, epsilon-free, monotone LCFRS grammars."""
 from __future__ import print_function
 import re
+import time
 import logging
+from array import array
 import numpy as np
 cimport cython
 include "constants.pxi"
@@ -11,6 +13,7 @@ include "agenda.pxi"
 
 cdef SmallChartItem COMPONENT = new_SmallChartItem(0, 0)
 cdef SmallChartItem NONE = new_SmallChartItem(0, 0)
+cdef SmallChartItem TMPITEM = new_SmallChartItem(0, 0)
 cdef FatChartItem FATNONE = new_FatChartItem(0)
 cdef FatChartItem FATCOMPONENT = new_FatChartItem(0)
 cdef double INFINITY = float('infinity')
@@ -18,8 +21,10 @@ cdef double INFINITY = float('infinity')
 cdef inline bint equalitems(LCFRSItem_fused op1, LCFRSItem_fused op2):
     if LCFRSItem_fused is SmallChartItem:
         return op1.label == op2.label and op1.vec == op2.vec
-    return op1.label == op2.label and (
-            memcmp(< uint8_t * >op1.vec, < uint8_t * >op2.vec, sizeof(op1.vec)) == 0)
+    else:
+        return op1.label == op2.label and (
+                memcmp(< uint8_t * >op1.vec, < uint8_t * >op2.vec,
+                       sizeof(op1.vec)) == 0)
 
 
 cdef class LCFRSChart(Chart):
@@ -246,10 +251,293 @@ cdef class FatLCFRSChart(LCFRSChart):
         return self.probs[item.label].get(item, item)
 
 
+cdef inline size_t itemhash(uint32_t label, uint64_t vec):
+    """Hash function for the (label, vec) pairs of a PackedLCFRSChart."""
+    cdef uint64_t h = (vec ^ (<uint64_t>label << 40) ^ label
+                       ) * 0x9E3779B97F4A7C15ULL
+    return h ^ (h >> 29)
+
+
+@cython.final
+cdef class PackedLCFRSChart(Chart):
+    """LCFRS chart for short sentences without Python objects for items.
+
+    Sentences should fit into a single machine word. Items are stored as
+    structs in an array, and are referred to by their index in this array
+    (i.e., an item is a Python integer). The index of an item is found with an
+    open addressing hash table. Probabilities and edges are stored in arrays
+    parallel to the array of items."""
+
+    def __init__(self, Grammar grammar, list sent,
+                 start=None, logprob=True, viterbi=True):
+        if len(sent) >= sizeof(COMPONENT.vec) * 8:
+            raise ValueError('sentence too long for PackedLCFRSChart.')
+        self.grammar = grammar
+        self.sent = sent
+        self.lensent = len(sent)
+        self.start = grammar.toid[grammar.start if start is None else start]
+        self.logprob = logprob
+        self.viterbi = viterbi
+        self.numitems = 0
+        self.capacity = 256
+        self.tablesize = 2 * self.capacity
+        self.numlabels = grammar.nonterminals
+        self.items = <PackedItem *>malloc(self.capacity * sizeof(PackedItem))
+        self.probs = <double *>malloc(self.capacity * sizeof(double))
+        self.agendaprobs = <double *>malloc(self.capacity * sizeof(double))
+        self.parseforest = <EdgesStruct *>calloc(
+                self.capacity, sizeof(EdgesStruct))
+        self.table = <uint32_t *>calloc(self.tablesize, sizeof(uint32_t))
+        self.bylabel = <ItemList *>calloc(self.numlabels, sizeof(ItemList))
+        if (self.items is NULL or self.probs is NULL
+                or self.agendaprobs is NULL or self.parseforest is NULL
+                or self.table is NULL or self.bylabel is NULL):
+            raise MemoryError('allocation error')
+        self.itemsinorder = array(b'L' if PY2 else 'L')
+
+    def __dealloc__(self):
+        cdef uint32_t n
+        arenafree(&(self.arena))
+        if self.bylabel is not NULL:
+            for n in range(self.numlabels):
+                free(self.bylabel[n].ids)
+        free(self.bylabel)
+        free(self.table)
+        free(self.parseforest)
+        free(self.agendaprobs)
+        free(self.probs)
+        free(self.items)
+
+    cdef long getid(self, uint32_t label, uint64_t vec):
+        """Return id of item, or -1 if it is not part of the chart."""
+        cdef size_t mask = self.tablesize - 1
+        cdef size_t n = itemhash(label, vec) & mask
+        cdef uint32_t idx
+        while self.table[n]:
+            idx = self.table[n] - 1
+            if self.items[idx].vec == vec and self.items[idx].label == label:
+                return idx
+            n = (n + 1) & mask
+        return -1
+
+    cdef long additem(self, uint32_t label, uint64_t vec) except -1:
+        """Add an item which is not part of the chart; return its id."""
+        cdef size_t mask, n, m
+        cdef uint32_t * table
+        if self.numitems == self.capacity:
+            # grow parallel arrays
+            self.capacity *= 2
+            self.items = <PackedItem *>realloc(
+                    self.items, self.capacity * sizeof(PackedItem))
+            self.probs = <double *>realloc(
+                    self.probs, self.capacity * sizeof(double))
+            self.agendaprobs = <double *>realloc(
+                    self.agendaprobs, self.capacity * sizeof(double))
+            self.parseforest = <EdgesStruct *>realloc(
+                    self.parseforest, self.capacity * sizeof(EdgesStruct))
+            if (self.items is NULL or self.probs is NULL
+                    or self.agendaprobs is NULL or self.parseforest is NULL):
+                raise MemoryError('allocation error')
+            memset(&(self.parseforest[self.numitems]), 0,
+                   (self.capacity - self.numitems) * sizeof(EdgesStruct))
+        if 2 * (self.numitems + 1) > self.tablesize:
+            # keep load factor of hash table below 0.5
+            table = <uint32_t *>calloc(2 * self.tablesize, sizeof(uint32_t))
+            if table is NULL:
+                raise MemoryError('allocation error')
+            mask = 2 * self.tablesize - 1
+            for m in range(self.numitems):
+                n = itemhash(self.items[m].label, self.items[m].vec) & mask
+                while table[n]:
+                    n = (n + 1) & mask
+                table[n] = m + 1
+            free(self.table)
+            self.table = table
+            self.tablesize *= 2
+        mask = self.tablesize - 1
+        n = itemhash(label, vec) & mask
+        while self.table[n]:
+            n = (n + 1) & mask
+        self.table[n] = self.numitems + 1
+        self.items[self.numitems].label = label
+        self.items[self.numitems].vec = vec
+        self.probs[self.numitems] = INFINITY
+        self.agendaprobs[self.numitems] = INFINITY
+        self.numitems += 1
+        return self.numitems - 1
+
+    cdef void addedge(self, uint32_t item, uint32_t left, uint32_t right,
+                      ProbRule * rule):
+        """Add new edge; the ids of both children are stored in the edge."""
+        cdef Edge * edge
+        cdef EdgesStruct * edges = &(self.parseforest[item])
+        cdef MoreEdges * edgelist
+        if edges.head is NULL or edges.len == EDGES_SIZE:
+            if edges.head is NULL:
+                self.itemsinorder.append(item)
+            edgelist = arenablock(&(self.arena))
+            edgelist.prev = edges.head
+            edges.head = edgelist
+            edges.len = 0
+        edge = &(edges.head.data[edges.len])
+        edge.rule = rule
+        edge.pos.lvec = (<uint64_t>right << 32) | left
+        edges.len += 1
+
+    cdef void addlexedge(self, uint32_t item, short wordidx):
+        """Add lexical edge."""
+        cdef Edge * edge
+        cdef EdgesStruct * edges = &(self.parseforest[item])
+        cdef MoreEdges * edgelist
+        if edges.head is NULL or edges.len == EDGES_SIZE:
+            if edges.head is NULL:
+                self.itemsinorder.append(item)
+            edgelist = arenablock(&(self.arena))
+            edgelist.prev = edges.head
+            edges.head = edgelist
+            edges.len = 0
+        edge = &(edges.head.data[edges.len])
+        edge.rule = NULL
+        edge.pos.mid = wordidx + 1
+        edges.len += 1
+
+    cdef void updateprob(self, uint32_t item, double prob):
+        """Update viterbi probability of item if better than current one.
+
+        The first time an item gets a probability, it becomes available as a
+        sibling for binary rules."""
+        cdef ItemList * siblings
+        if self.probs[item] == INFINITY:
+            siblings = &(self.bylabel[self.items[item].label])
+            if siblings.len == siblings.cap:
+                siblings.cap = 2 * siblings.cap if siblings.cap else 16
+                siblings.ids = <uint32_t *>realloc(
+                        siblings.ids, siblings.cap * sizeof(uint32_t))
+                if siblings.ids is NULL:
+                    abort()
+            siblings.ids[siblings.len] = item
+            siblings.len += 1
+        if prob < self.probs[item]:
+            self.probs[item] = prob
+
+    cdef double subtreeprob(self, item):
+        return self.probs[<uint32_t>item]
+
+    cdef _left(self, item, Edge * edge):
+        if edge.rule is NULL:
+            return None
+        return <uint32_t>(edge.pos.lvec & 0xFFFFFFFFUL)
+
+    cdef _right(self, item, Edge * edge):
+        if edge.rule is NULL or edge.rule.rhs2 == 0:
+            return None
+        return <uint32_t>(edge.pos.lvec >> 32)
+
+    cdef uint32_t label(self, item):
+        return self.items[<uint32_t>item].label
+
+    def indices(self, item):
+        cdef uint64_t vec = self.items[<uint32_t>item].vec
+        cdef short n
+        return [n for n in range(self.lensent) if testbit(vec, n)]
+
+    def itemstr(self, item):
+        return '%s[%s]' % (
+                self.grammar.tolabel[self.label(item)],
+                bin(self.items[<uint32_t>item].vec)[2:].zfill(
+                    self.lensent)[::-1])
+
+    def root(self):
+        cdef long result = self.getid(
+                self.start, (1UL << self.lensent) - 1)
+        return None if result == -1 else result
+
+    def getitems(self):
+        return self.itemsinorder
+
+    cdef Edges getedges(self, item):
+        """Get edges for item."""
+        if item is None:
+            return None
+        result = Edges()
+        result.len = self.parseforest[<uint32_t>item].len
+        result.head = self.parseforest[<uint32_t>item].head
+        return result
+
+    cpdef bint hasitem(self, item):
+        """Test if item is in chart."""
+        return (item is not None and 0 <= item < self.numitems
+                and self.parseforest[<uint32_t>item].head is not NULL)
+
+    cdef ChartItem asChartItem(self, item):
+        return new_SmallChartItem(self.items[<uint32_t>item].label,
+                                  self.items[<uint32_t>item].vec)
+
+    cdef size_t asCFGspan(self, item, size_t nonterminals):
+        cdef uint64_t vec = self.items[<uint32_t>item].vec
+        cdef int start = nextset(vec, 0)
+        cdef int end = nextunset(vec, start)
+        assert nextset(vec, end) == -1
+        return compactcellidx(start, end, self.lensent, 1)
+
+    def toitem(self, node, item):
+        """Convert Tree node with integer indices as terminals to an item id.
+
+        Returns ``None`` if the item is not part of the chart."""
+        cdef long result
+        try:
+            label = self.grammar.toid[node.label]
+        except KeyError:
+            return None
+        result = self.getid(label, sum(1 << n for n in node.leaves()))
+        return None if result == -1 else result
+
+    def filter(self):
+        """Drop entries not part of a derivation headed by root of chart."""
+        cdef Edge * edge
+        cdef MoreEdges * edgelist
+        cdef uint32_t item
+        cdef short n
+        cdef set items = set()
+        cdef list agenda = [self.root()] if self else []
+        while agenda:
+            item = agenda.pop()
+            if item in items:
+                continue
+            items.add(item)
+            edgelist = self.parseforest[item].head
+            while edgelist is not NULL:
+                for n in range(self.parseforest[item].len
+                               if edgelist is self.parseforest[item].head
+                               else EDGES_SIZE):
+                    edge = &(edgelist.data[n])
+                    if edge.rule is not NULL:
+                        agenda.append(self._left(item, edge))
+                        if edge.rule.rhs2:
+                            agenda.append(self._right(item, edge))
+                edgelist = edgelist.prev
+        # NB: edges are allocated from an arena owned by the chart,
+        # and are freed together with the chart.
+        for item in self.itemsinorder:
+            if item not in items:
+                self.parseforest[item].len = 0
+                self.parseforest[item].head = NULL
+        self.itemsinorder = array(b'L' if PY2 else 'L', [
+                item for item in self.itemsinorder if item in items])
+
+    def __bool__(self):
+        """Return true when the root item is in the chart.
+
+        i.e., test whether sentence has been parsed successfully."""
+        return self.hasitem(self.root())
+
+
 def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
           start=None, list whitelist=None, bint splitprune=False,
           bint markorigin=False, estimates=None, bint symbolic=False,
-          double beam_beta=0.0, int beam_delta=50):
+          double beam_beta=0.0, int beam_delta=50, double maxtime=0.0,
+          size_t maxitems=0, size_t maxagenda=0, bint packedchart=False,
+          bint indexedagenda=False):
     """Parse sentence and produce a chart.
 
     :param sent: A sequence of tokens that will be parsed.
@@ -262,7 +550,9 @@ def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
             derivations should be headed by; e.g., ``grammar.toid['ROOT']``.
             If not given, the default specified by ``grammar`` is used.
     :param whitelist: a whitelist of allowed ChartItems. Anything else is not
-            added to the agenda.
+            added to the agenda. A list with for each label a ``SpanSet``
+            (or a set of items with label 0), or ``None`` to allow all items
+            with that label.
     :param splitprune: coarse stage used a split-PCFG where discontinuous node
             appear as multiple CFG nodes. Every discontinuous node will result
             in multiple lookups into whitelist to see whether it should be
@@ -275,16 +565,49 @@ def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
             estimates ('SX' or 'SXlrgaps'), and the estimates themselves in a
             4-dimensional numpy matrix. If estimates are not consistent, it is
             no longer guaranteed that the optimal parse will be found.
-            experimental.
+            Instead of a matrix, an ``estimates.OutsideEstimates`` object may
+            be given; the estimates for the length of ``sent`` are then
+            selected (and computed if necessary) automatically.
     :param symbolic: If True, only compute parse forest, disregard
             probabilities. The agenda is an O(1) queue instead of a O(log n)
             priority queue.
+    :param packedchart: use a ``PackedLCFRSChart``, which stores items in
+            arrays instead of as Python objects; this saves memory and
+            garbage collection overhead with large grammars. Only applies to
+            sentences shorter than 64 words and when ``symbolic`` is False;
+            otherwise the default chart is used.
+    :param indexedagenda: with ``packedchart``, use an ``IndexedAgenda``
+            (a heap of C structs) instead of a ``DoubleAgenda``; the result is
+            the same.
     :param beam_beta: keep track of the best score in each cell and only allow
             items which are within a multiple of ``beam_beta`` of the best score.
             Should be a negative log probability. Pass ``0.0`` to disable.
     :param beam_delta: the maximum span length to which beam search is applied.
+    :param maxtime: abort parsing after this many seconds of wall time;
+            pass ``0.0`` to disable.
+    :param maxitems: abort parsing when the chart contains more than this
+            number of items; pass ``0`` to disable.
+    :param maxagenda: abort parsing when the agenda contains more than this
+            number of items; pass ``0`` to disable.
+
+    When one of these limits is exceeded, an empty chart is returned (i.e.,
+    no parse), and the message reports which limit was exceeded. The limits
+    are not applied in symbolic mode.
     """
-    if len(sent) < sizeof(COMPONENT.vec) * 8:
+    if estimates is not None and hasattr(estimates[1], 'forlength'):
+        estimates = estimates[0], estimates[1].forlength(len(sent))
+    if packedchart and not symbolic and len(sent) < sizeof(COMPONENT.vec) * 8:
+        chart = PackedLCFRSChart(grammar, list(sent), start)
+        if indexedagenda:
+            return parse_packed(<PackedLCFRSChart > chart, IndexedAgenda(),
+                                sent, grammar, tags, exhaustive, whitelist,
+                                splitprune, markorigin, estimates, beam_beta,
+                                beam_delta, maxtime, maxitems, maxagenda)
+        return parse_packed(<PackedLCFRSChart > chart, DoubleAgenda(),
+                            sent, grammar, tags, exhaustive, whitelist,
+                            splitprune, markorigin, estimates, beam_beta,
+                            beam_delta, maxtime, maxitems, maxagenda)
+    elif len(sent) < sizeof(COMPONENT.vec) * 8:
         chart = SmallLCFRSChart(grammar, list(sent), start)
         if symbolic:
             return parse_symbolic( < SmallLCFRSChart > chart,
@@ -292,7 +615,8 @@ def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
                                   whitelist, splitprune, markorigin)
         return parse_main(< SmallLCFRSChart > chart, < SmallChartItem > chart.root(),
                            sent, grammar, tags, exhaustive, whitelist, splitprune,
-                           markorigin, estimates, beam_beta, beam_delta)
+                           markorigin, estimates, beam_beta, beam_delta,
+                           maxtime, maxitems, maxagenda)
     chart = FatLCFRSChart(grammar, list(sent), start)
     if symbolic:
         return parse_symbolic( < FatLCFRSChart > chart,
@@ -300,13 +624,15 @@ def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
                               whitelist, splitprune, markorigin)
     return parse_main(< FatLCFRSChart > chart, < FatChartItem > chart.root(),
                        sent, grammar, tags, exhaustive, whitelist, splitprune,
-                       markorigin, estimates, beam_beta, beam_delta)
+                       markorigin, estimates, beam_beta, beam_delta,
+                       maxtime, maxitems, maxagenda)
 
 
 cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
                 Grammar grammar, tags, bint exhaustive, list whitelist,
                 bint splitprune, bint markorigin, estimates,
-                double beam_beta, int beam_delta):
+                double beam_beta, int beam_delta, double maxtime,
+                size_t maxitems, size_t maxagenda):
     cdef:
         DoubleAgenda agenda = DoubleAgenda()  # the agenda
         list probs = chart.probs  # viterbi probabilities for items
@@ -314,10 +640,11 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
         LCFRSItem_fused item, newitem
         DoubleEntry entry
         double[:, :, :, :] outside = None  # outside estimates, if provided
-        double siblingprob, score
+        double siblingprob, score, deadline = time.time() + maxtime
         short lensent = len(sent), estimatetype = 0
         int length = 1, left = 0, right = 0, gaps = 0
-        size_t blocked = 0, maxA = 0, n
+        size_t blocked = 0, maxA = 0, n, numpopped = 0
+        str limit = None
     if estimates is not None:
         estimatetypestr, outside = estimates
         estimatetype = {'SX': SX, 'SXlrgaps': SXlrgaps}[estimatetypestr]
@@ -511,6 +838,21 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 
         if agenda.length > maxA:
             maxA = agenda.length
+        # check whether this sentence is taking too many resources
+        numpopped += 1
+        if maxagenda and agenda.length > maxagenda:
+            limit = 'agenda size'
+        elif maxitems and len(chart.itemsinorder) > maxitems:
+            limit = 'chart size'
+        elif maxtime and numpopped % 16 == 0 and time.time() > deadline:
+            limit = 'time'
+        if limit is not None:
+            # discard incomplete chart
+            msg = ('no parse: %s limit exceeded; agenda max %d, now %d, '
+                   '%s, blocked %d' % (limit, maxA, len(agenda),
+                                       chart.stats(), blocked))
+            return chart.__class__(grammar, list(sent),
+                                   grammar.tolabel[chart.start]), msg
     msg = ('agenda max %d, now %d, %s, blocked %d' % (
         maxA, len(agenda), chart.stats(), blocked))
     if not chart:
@@ -526,13 +868,12 @@ cdef populatepos(Grammar grammar, DoubleAgenda agenda,
     :returns: a tuple ``(success, msg)`` where ``success`` is True if a POS tag
             was found for every word in the sentence."""
     cdef:
-        LexicalRule lexrule
         LCFRSItem_fused newitem
         double[:, :, :, :] outside = None  # outside estimates, if provided
         double score
         short wordidx, lensent = len(sent), estimatetype = 0
-        int length = 1, left = 0, right = 0, gaps = 0
-        uint32_t lhs
+        int length = 1, left = 0, right = 0, gaps = 0, wordid
+        uint32_t lhs, n
         size_t blocked = 0
         bint recognized
     if estimates is not None:
@@ -560,22 +901,24 @@ cdef populatepos(Grammar grammar, DoubleAgenda agenda,
             left = wordidx
             gaps = 0
             right = lensent - 1 - wordidx
-        for lexrule in grammar.lexicalbyword.get(word, ()):
-            if not tags or tagre.match(grammar.tolabel[lexrule.lhs]):
-                score = -1 if symbolic else lexrule.prob
+        wordid = grammar.wordid(word)
+        for n in range(grammar.lexwordidx[wordid] if wordid != -1 else 0,
+                       grammar.lexwordidx[wordid + 1] if wordid != -1 else 0):
+            lhs = grammar.lexlhs[n]
+            if not tags or tagre.match(grammar.tolabel[lhs]):
+                score = -1 if symbolic else grammar.lexprobs[n]
                 if estimatetype == SX:
-                    score += outside[lexrule.lhs, left, right, 0]
+                    score += outside[lhs, left, right, 0]
                     if score > MAX_LOGPROB:
                         continue
                 elif estimatetype == SXlrgaps:
-                    score += outside[
-                        lexrule.lhs, length, left + right, gaps]
+                    score += outside[lhs, length, left + right, gaps]
                     if score > MAX_LOGPROB:
                         continue
                 # NB: do NOT add length of span to score, so that the scores of
                 # POS tags are all strictly smaller than any unaries on them.
-                newitem.label = lexrule.lhs
-                newitem.prob = 0.0 if symbolic else lexrule.prob
+                newitem.label = lhs
+                newitem.prob = 0.0 if symbolic else grammar.lexprobs[n]
                 if LCFRSItem_fused is SmallChartItem:
                     newitem.vec = 1UL << wordidx
                 elif LCFRSItem_fused is FatChartItem:
@@ -595,7 +938,7 @@ cdef populatepos(Grammar grammar, DoubleAgenda agenda,
         # NB: use gold tags if given, even if (word, tag) was not part of
         # training data, modulo state splits etc.
         if not recognized and tag is not None:
-            for lhs in grammar.lexicalbylhs:
+            for lhs in grammar.lexicallhs:
                 if tagre.match(grammar.tolabel[lhs]) is not None:
                     score = -1 if symbolic else 0.0
                     if estimatetype == SX:
@@ -626,7 +969,7 @@ cdef populatepos(Grammar grammar, DoubleAgenda agenda,
                     else:
                         raise ValueError('tag %r is blocked.' % tag)
         if not recognized:
-            if tag is None and word not in grammar.lexicalbyword:
+            if tag is None and wordid == -1:
                 return False, 'no parse: %r not in lexicon' % word
             elif tag is not None and tag not in grammar.toid:
                 return False, 'no parse: unknown tag %r' % tag
@@ -718,51 +1061,62 @@ cdef inline int process_lexedge(LCFRSItem_fused newitem,
 cdef inline bint checkwhitelist(LCFRSItem_fused newitem, list whitelist,
                                 bint splitprune, bint markorigin):
     """Return False if item is not on whitelist."""
-    cdef uint32_t n, cnt, label
+    cdef uint32_t n, cnt
     cdef int a, b
-    cdef list componentlist = None
-    cdef set componentset = None
-    if whitelist is not None and whitelist[newitem.label] is not None:
-        if splitprune:  # disc. item to be treated as several split items?
-            if markorigin:
-                componentlist = <list > (whitelist[newitem.label])
-            else:
-                componentset = <set > (whitelist[newitem.label])
-            b = cnt = 0
+    cdef object spans
+    if whitelist is None:
+        return True
+    spans = whitelist[newitem.label]
+    if spans is None:
+        return True
+    if splitprune:  # disc. item to be treated as several split items?
+        b = cnt = 0
+        if LCFRSItem_fused is SmallChartItem:
+            a = nextset(newitem.vec, b)
+        elif LCFRSItem_fused is FatChartItem:
+            a = anextset(newitem.vec, b, SLOTS)
+        while a != -1:
             if LCFRSItem_fused is SmallChartItem:
+                b = nextunset(newitem.vec, a)
+                # given a=3, b=6, make bitvector: 1000000 - 1000 = 111000
+                COMPONENT.vec = (1UL << b) - (1UL << a)
+                if not inspans((<list>spans)[cnt] if markorigin else spans,
+                               COMPONENT):
+                    return False
                 a = nextset(newitem.vec, b)
             elif LCFRSItem_fused is FatChartItem:
+                b = anextunset(newitem.vec, a, SLOTS)
+                # given a=3, b=6, make bitvector: 1000000 - 1000 = 111000
+                memset(< void * >FATCOMPONENT.vec, 0,
+                        SLOTS * sizeof(uint64_t))
+                for n in range(a, b):
+                    SETBIT(FATCOMPONENT.vec, n)
+                if not inspans((<list>spans)[cnt] if markorigin else spans,
+                               FATCOMPONENT):
+                    return False
                 a = anextset(newitem.vec, b, SLOTS)
-            while a != -1:
-                if LCFRSItem_fused is SmallChartItem:
-                    b = nextunset(newitem.vec, a)
-                    # given a=3, b=6, make bitvector: 1000000 - 1000 = 111000
-                    COMPONENT.vec = (1UL << b) - (1UL << a)
-                elif LCFRSItem_fused is FatChartItem:
-                    b = anextunset(newitem.vec, a, SLOTS)
-                    # given a=3, b=6, make bitvector: 1000000 - 1000 = 111000
-                    memset(< void * >FATCOMPONENT.vec, 0,
-                            SLOTS * sizeof(uint64_t))
-                    for n in range(a, b):
-                        SETBIT(FATCOMPONENT.vec, n)
-                if markorigin:
-                    componentset = <set > (componentlist[cnt])
-                if LCFRSItem_fused is SmallChartItem:
-                    if PySet_Contains(componentset, COMPONENT) != 1:
-                        return False
-                    a = nextset(newitem.vec, b)
-                elif LCFRSItem_fused is FatChartItem:
-                    if PySet_Contains(componentset, FATCOMPONENT) != 1:
-                        return False
-                    a = anextset(newitem.vec, b, SLOTS)
-                cnt += 1
+            cnt += 1
+        return True
+    return inspans(spans, newitem)
+
+
+cdef inline bint inspans(object spans, LCFRSItem_fused item):
+    """Test whether the span of item is in the whitelist for a label.
+
+    The whitelist for a label is a ``SpanSet``, or a set of items with label
+    0."""
+    cdef uint32_t label
+    cdef bint result
+    if type(spans) is SpanSet:
+        if LCFRSItem_fused is SmallChartItem:
+            return spansetcontains(<SpanSet>spans, item.vec)
         else:
-            label = newitem.label
-            newitem.label = 0
-            if PySet_Contains(whitelist[label], newitem) != 1:
-                return False
-            newitem.label = label
-    return True
+            spans = (<SpanSet>spans).fat
+    label = item.label
+    item.label = 0
+    result = PySet_Contains(spans, item) == 1
+    item.label = label
+    return result
 
 
 cdef inline void combine_item(LCFRSItem_fused newitem,
@@ -797,40 +1151,11 @@ cdef inline bint concat(ProbRule * rule,
     NB: note reversal due to the way binary numbers are represented
     the least significant bit (rightmost) corresponds to the lowest
     index in the sentence / constituent (leftmost)."""
-    cdef uint64_t lvec, rvec, mask
     cdef uint64_t * alvec
     cdef uint64_t * arvec
     cdef int lpos, rpos, n
     if LCFRSItem_fused is SmallChartItem:
-        lvec = left.vec
-        rvec = right.vec
-        if lvec & rvec:
-            return False
-        mask = rvec if testbit(rule.args, 0) else lvec
-        for n in range(bitlength(rule.lengths)):
-            if testbit(rule.args, n):  # component from right vector
-                if rvec & mask == 0:
-                    return False  # check for expected component
-                rvec |= rvec - 1  # trailing 0 bits => 1 bits
-                mask = rvec & (~rvec - 1)  # mask of 1 bits up to first 0 bit
-            else:  # component from left vector
-                if lvec & mask == 0:
-                    return False  # check for expected component
-                lvec |= lvec - 1  # trailing 0 bits => 1 bits
-                mask = lvec & (~lvec - 1)  # mask of 1 bits up to first 0 bit
-            # zero out component
-            lvec &= ~mask
-            rvec &= ~mask
-            if testbit(rule.lengths, n):  # a gap
-                # check that there is a gap in both vectors
-                if (lvec ^ rvec) & (mask + 1):
-                    return False
-                # increase mask to cover gap
-                # get minimum of trailing zero bits of lvec & rvec
-                mask = (~lvec & (lvec - 1)) & (~rvec & (rvec - 1))
-            mask += 1  # e.g., 00111 => 01000
-        # success if we've reached the end of both left and right vector
-        return lvec == rvec == 0
+        return concatvec(rule, left.vec, right.vec)
     elif LCFRSItem_fused is FatChartItem:
         alvec = left.vec
         arvec = right.vec
@@ -876,6 +1201,379 @@ cdef inline bint concat(ProbRule * rule,
         return lpos == rpos == -1
 
 
+cdef inline bint concatvec(ProbRule * rule, uint64_t lvec, uint64_t rvec):
+    """Test whether two bitvectors combine according to a given rule.
+
+    Version of ``concat()`` for bitvectors that fit in a single machine
+    word."""
+    cdef uint64_t mask
+    cdef int n
+    if lvec & rvec:
+        return False
+    mask = rvec if testbit(rule.args, 0) else lvec
+    for n in range(bitlength(rule.lengths)):
+        if testbit(rule.args, n):  # component from right vector
+            if rvec & mask == 0:
+                return False  # check for expected component
+            rvec |= rvec - 1  # trailing 0 bits => 1 bits
+            mask = rvec & (~rvec - 1)  # mask of 1 bits up to first 0 bit
+        else:  # component from left vector
+            if lvec & mask == 0:
+                return False  # check for expected component
+            lvec |= lvec - 1  # trailing 0 bits => 1 bits
+            mask = lvec & (~lvec - 1)  # mask of 1 bits up to first 0 bit
+        # zero out component
+        lvec &= ~mask
+        rvec &= ~mask
+        if testbit(rule.lengths, n):  # a gap
+            # check that there is a gap in both vectors
+            if (lvec ^ rvec) & (mask + 1):
+                return False
+            # increase mask to cover gap
+            # get minimum of trailing zero bits of lvec & rvec
+            mask = (~lvec & (lvec - 1)) & (~rvec & (rvec - 1))
+        mask += 1  # e.g., 00111 => 01000
+    # success if we've reached the end of both left and right vector
+    return lvec == rvec == 0
+
+
+cdef parse_packed(PackedLCFRSChart chart, Agenda_fused agenda, sent,
+                  Grammar grammar, tags, bint exhaustive, list whitelist,
+                  bint splitprune, bint markorigin, estimates,
+                  double beam_beta, int beam_delta, double maxtime,
+                  size_t maxitems, size_t maxagenda):
+    """Version of ``parse_main()`` for a ``PackedLCFRSChart``.
+
+    The agenda contains item ids; the probability of the derivation with
+    which an item is on the agenda is kept in ``chart.agendaprobs``."""
+    cdef:
+        ProbRule * rule
+        ItemList * siblings
+        double[:, :, :, :] outside = None  # outside estimates, if provided
+        double prob, newprob, score, deadline = time.time() + maxtime
+        uint64_t vec, newvec, sibvec, goalvec = (1UL << len(sent)) - 1
+        uint32_t item, sib, label
+        short lensent = len(sent), estimatetype = 0
+        int length = 1, left = 0, right = 0, gaps = 0
+        size_t blocked = 0, maxA = 0, n, m, numpopped = 0
+        str limit = None
+    if estimates is not None:
+        estimatetypestr, outside = estimates
+        estimatetype = {'SX': SX, 'SXlrgaps': SXlrgaps}[estimatetypestr]
+
+    # assign POS tags
+    covered, msg = populatepos_packed(
+        grammar, agenda, chart, sent, tags, whitelist, estimates)
+    if not covered:
+        return chart, msg
+
+    while agenda.length:  # main parsing loop
+        item = agenda.popentry().key
+        prob = chart.agendaprobs[item]
+        # store viterbi probability; cannot do this when this item is added to
+        # the agenda because that would give rise to duplicate edges.
+        chart.updateprob(item, prob)
+        label = chart.items[item].label
+        vec = chart.items[item].vec
+        if label == chart.start and vec == goalvec:
+            if not exhaustive:
+                break
+        else:
+            # unary
+            length = bitcount(vec)
+            if estimates is not None:
+                left = nextset(vec, 0)
+                gaps = bitlength(vec) - length - left
+                right = lensent - length - left - gaps
+            for n in range(grammar.numunary):
+                rule = &(grammar.unary[label][n])
+                if rule.rhs1 != label:
+                    break
+                elif TESTBIT(grammar.mask, rule.no):
+                    continue
+                score = newprob = prob + rule.prob
+                if estimatetype == SX:
+                    score += outside[rule.lhs, left, right, 0]
+                    if score > MAX_LOGPROB:
+                        continue
+                elif estimatetype == SXlrgaps:
+                    score += outside[
+                        rule.lhs, length, left + right, gaps]
+                    if score > MAX_LOGPROB:
+                        continue
+                else:
+                    # add length of span to score so that all items of length n
+                    # have a strictly lower score than items with length n + 1.
+                    score += length * MAX_LOGPROB
+                if not process_edge_packed(
+                        rule.lhs, vec, newprob, score, rule, item, 0,
+                        agenda, chart, estimatetype, whitelist,
+                        splitprune and grammar.fanout[rule.lhs] != 1,
+                        markorigin, 0.0):
+                    blocked += 1
+            # binary production, item from agenda is on the right
+            for n in range(grammar.numbinary):
+                rule = &(grammar.rbinary[label][n])
+                if rule.rhs2 != label:
+                    break
+                elif TESTBIT(grammar.mask, rule.no):
+                    continue
+                siblings = &(chart.bylabel[rule.rhs1])
+                for m in range(siblings.len):
+                    sib = siblings.ids[m]
+                    sibvec = chart.items[sib].vec
+                    if not concatvec(rule, sibvec, vec):
+                        continue
+                    newvec = sibvec ^ vec
+                    score = newprob = prob + chart.probs[sib] + rule.prob
+                    length = bitcount(newvec)
+                    if estimatetype == SX:
+                        left = nextset(newvec, 0)
+                        right = lensent - length - left
+                        score += outside[rule.lhs, left, right, 0]
+                        if score > MAX_LOGPROB:
+                            continue
+                    elif estimatetype == SXlrgaps:
+                        left = nextset(newvec, 0)
+                        gaps = bitlength(newvec) - length - left
+                        right = lensent - length - left - gaps
+                        score += outside[rule.lhs, length, left + right, gaps]
+                        if score > MAX_LOGPROB:
+                            continue
+                    else:
+                        score += length * MAX_LOGPROB
+                    if not process_edge_packed(
+                            rule.lhs, newvec, newprob, score, rule, sib, item,
+                            agenda, chart, estimatetype, whitelist,
+                            splitprune and grammar.fanout[rule.lhs] != 1,
+                            markorigin,
+                            beam_beta if length <= beam_delta else 0.0):
+                        blocked += 1
+            # binary production, item from agenda is on the left
+            for n in range(grammar.numbinary):
+                rule = &(grammar.lbinary[label][n])
+                if rule.rhs1 != label:
+                    break
+                elif TESTBIT(grammar.mask, rule.no):
+                    continue
+                siblings = &(chart.bylabel[rule.rhs2])
+                for m in range(siblings.len):
+                    sib = siblings.ids[m]
+                    sibvec = chart.items[sib].vec
+                    if not concatvec(rule, vec, sibvec):
+                        continue
+                    newvec = vec ^ sibvec
+                    score = newprob = prob + chart.probs[sib] + rule.prob
+                    length = bitcount(newvec)
+                    if estimatetype == SX:
+                        left = nextset(newvec, 0)
+                        right = lensent - length - left
+                        score += outside[rule.lhs, left, right, 0]
+                        if score > MAX_LOGPROB:
+                            continue
+                    elif estimatetype == SXlrgaps:
+                        left = nextset(newvec, 0)
+                        gaps = bitlength(newvec) - length - left
+                        right = lensent - length - left - gaps
+                        score += outside[rule.lhs, length, left + right, gaps]
+                        if score > MAX_LOGPROB:
+                            continue
+                    else:
+                        score += length * MAX_LOGPROB
+                    if not process_edge_packed(
+                            rule.lhs, newvec, newprob, score, rule, item, sib,
+                            agenda, chart, estimatetype, whitelist,
+                            splitprune and grammar.fanout[rule.lhs] != 1,
+                            markorigin,
+                            beam_beta if length <= beam_delta else 0.0):
+                        blocked += 1
+
+        if agenda.length > maxA:
+            maxA = agenda.length
+        # check whether this sentence is taking too many resources
+        numpopped += 1
+        if maxagenda and agenda.length > maxagenda:
+            limit = 'agenda size'
+        elif maxitems and len(chart.itemsinorder) > maxitems:
+            limit = 'chart size'
+        elif maxtime and numpopped % 16 == 0 and time.time() > deadline:
+            limit = 'time'
+        if limit is not None:
+            # discard incomplete chart
+            msg = ('no parse: %s limit exceeded; agenda max %d, now %d, '
+                   '%s, blocked %d' % (limit, maxA, len(agenda),
+                                       chart.stats(), blocked))
+            return chart.__class__(grammar, list(sent),
+                                   grammar.tolabel[chart.start]), msg
+    msg = ('agenda max %d, now %d, %s, blocked %d' % (
+        maxA, len(agenda), chart.stats(), blocked))
+    if not chart:
+        return chart, 'no parse ' + msg
+    return chart, msg
+
+
+cdef populatepos_packed(Grammar grammar, Agenda_fused agenda,
+                        PackedLCFRSChart chart, sent, tags, whitelist,
+                        estimates):
+    """Version of ``populatepos()`` for a ``PackedLCFRSChart``."""
+    cdef:
+        double[:, :, :, :] outside = None  # outside estimates, if provided
+        double score
+        short wordidx, lensent = len(sent), estimatetype = 0
+        int length = 1, left = 0, right = 0, gaps = 0, wordid
+        uint32_t lhs, n
+        bint recognized
+    if estimates is not None:
+        estimatetypestr, outside = estimates
+        estimatetype = {'SX': SX, 'SXlrgaps': SXlrgaps}[estimatetypestr]
+
+    for wordidx, word in enumerate(sent):  # add preterminals to chart
+        recognized = False
+        tag = tags[wordidx] if tags else None
+        # if we are given gold tags, make sure we only allow matching
+        # tags - after removing addresses introduced by the DOP reduction
+        # and other state splits.
+        tagre = re.compile('%s($|@|\\^|/)' % re.escape(tag)) if tags else None
+        if estimates is not None:
+            left = wordidx
+            gaps = 0
+            right = lensent - 1 - wordidx
+        wordid = grammar.wordid(word)
+        for n in range(grammar.lexwordidx[wordid] if wordid != -1 else 0,
+                       grammar.lexwordidx[wordid + 1] if wordid != -1 else 0):
+            lhs = grammar.lexlhs[n]
+            if not tags or tagre.match(grammar.tolabel[lhs]):
+                score = grammar.lexprobs[n]
+                if estimatetype == SX:
+                    score += outside[lhs, left, right, 0]
+                    if score > MAX_LOGPROB:
+                        continue
+                elif estimatetype == SXlrgaps:
+                    score += outside[lhs, length, left + right, gaps]
+                    if score > MAX_LOGPROB:
+                        continue
+                if process_lexedge_packed(
+                        lhs, wordidx, grammar.lexprobs[n], score,
+                        agenda, chart, whitelist):
+                    recognized = True
+        # NB: use gold tags if given, even if (word, tag) was not part of
+        # training data, modulo state splits etc.
+        if not recognized and tag is not None:
+            for lhs in grammar.lexicallhs:
+                if tagre.match(grammar.tolabel[lhs]) is not None:
+                    score = 0.0
+                    if estimatetype == SX:
+                        score += outside[lhs, left, right, 0]
+                        if score > MAX_LOGPROB:
+                            continue
+                    elif estimatetype == SXlrgaps:
+                        score += outside[lhs, length, left + right, gaps]
+                        if score > MAX_LOGPROB:
+                            continue
+                    # prevent pruning of provided tags => whitelist == None
+                    if process_lexedge_packed(
+                            lhs, wordidx, 0.0, score, agenda, chart, None):
+                        recognized = True
+                    else:
+                        raise ValueError('tag %r is blocked.' % tag)
+        if not recognized:
+            if tag is None and wordid == -1:
+                return False, 'no parse: %r not in lexicon' % word
+            elif tag is not None and tag not in grammar.toid:
+                return False, 'no parse: unknown tag %r' % tag
+            return False, 'no parse: all tags for %r blocked' % word
+    return True, ''
+
+
+cdef inline bint process_edge_packed(uint32_t label, uint64_t vec,
+                                     double prob, double score,
+                                     ProbRule * rule, uint32_t left,
+                                     uint32_t right, Agenda_fused agenda,
+                                     PackedLCFRSChart chart, int estimatetype,
+                                     list whitelist, bint splitprune,
+                                     bint markorigin,
+                                     double beam_beta) except -1:
+    """Version of ``process_edge()`` for a ``PackedLCFRSChart``.
+
+    :returns: ``True`` when edge is accepted in the chart, ``False`` when
+            blocked."""
+    cdef long item = chart.getid(label, vec), beamitem
+    cdef bint inagenda = False
+    if item != -1:
+        if Agenda_fused is DoubleAgenda:
+            inagenda = item in agenda.mapping
+        elif Agenda_fused is IndexedAgenda:
+            inagenda = agenda.contains(item)
+    if item == -1:
+        # check if we need to prune this item
+        if whitelist is not None:
+            TMPITEM.label = label
+            TMPITEM.vec = vec
+            if not checkwhitelist(TMPITEM, whitelist, splitprune, markorigin):
+                return False
+        if beam_beta:
+            # the item with label 0 holds the best score for this span
+            beamitem = chart.getid(0, vec)
+            if beamitem == -1:
+                beamitem = chart.additem(0, vec)
+                chart.probs[beamitem] = prob
+            elif prob > chart.probs[beamitem] + beam_beta:
+                return False
+            elif prob < chart.probs[beamitem]:
+                chart.probs[beamitem] = prob
+        # haven't seen this item before, won't prune, add to agenda
+        item = chart.additem(label, vec)
+        agenda.setitem(item, score)
+        chart.agendaprobs[item] = prob
+    # in agenda (maybe in chart)
+    elif inagenda:
+        # lower score? => decrease-key in agenda
+        if score < agenda.getitem(item):
+            agenda.setitem(item, score)
+            chart.agendaprobs[item] = prob
+    # not in agenda => must be in chart
+    elif prob < chart.probs[item]:
+        # re-add to agenda because we found a better score.
+        agenda.setitem(item, score)
+        chart.agendaprobs[item] = prob
+        if estimatetype != SXlrgaps:
+            # This should only happen because of an inconsistent or
+            # non-monotonic estimate.
+            logging.warning('WARN: re-adding item to agenda already in chart:'
+                            ' %s', chart.itemstr(item))
+    # store this edge, regardless of whether the item was new (unary chains)
+    chart.addedge(item, left, right, rule)
+    return True
+
+
+cdef inline bint process_lexedge_packed(uint32_t label, short wordidx,
+                                        double prob, double score,
+                                        Agenda_fused agenda,
+                                        PackedLCFRSChart chart,
+                                        list whitelist) except -1:
+    """Version of ``process_lexedge()`` for a ``PackedLCFRSChart``.
+
+    :returns: ``True`` when edge is accepted in the chart, ``False`` when
+            blocked."""
+    cdef uint64_t vec = 1UL << wordidx
+    cdef long item = chart.getid(label, vec)
+    if item != -1:
+        raise ValueError('lexical edge already in chart: %s' %
+                         chart.itemstr(item))
+    # check if we need to prune this item
+    elif whitelist is not None:
+        TMPITEM.label = label
+        TMPITEM.vec = vec
+        if not checkwhitelist(TMPITEM, whitelist, False, False):
+            return False
+    # haven't seen this item before, won't prune
+    item = chart.additem(label, vec)
+    agenda.setitem(item, score)
+    chart.agendaprobs[item] = prob
+    chart.addlexedge(item, wordidx)
+    return True
+
+
 cdef parse_symbolic(LCFRSChart_fused chart, LCFRSItem_fused goal,
                     sent, Grammar grammar, tags,
                     list whitelist, bint splitprune, bint markorigin):
@@ -1113,4 +1811,5 @@ def test():
 
 
 __all__ = ['Agenda', 'DoubleAgenda', 'LCFRSChart', 'SmallLCFRSChart',
-           'FatLCFRSChart', 'getparent', 'merge', 'parse']
+           'FatLCFRSChart', 'PackedLCFRSChart', 'IndexedAgenda', 'getparent',
+           'merge', 'parse']
@@ -13,7 +13,6 @@ import gzip
 import time
 import codecs
 import logging
-import multiprocessing
 from math import log
 from collections import defaultdict, Counter
 try:
@@ -31,7 +30,7 @@ from . import eval as evalmod
 from . import __version__, treebank, treebanktransforms, treetransforms, \
     grammar, lexicon, parser, estimates
 from .treetransforms import binarizetree
-from .util import workerfunc
+from .util import workerfunc, sharedpool
 from .containers import Grammar
 
 INTERNALPARAMS = None
@@ -331,6 +330,15 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
     tbfanout, n = treetransforms.treebankfanout(trees)
     logging.info('binarized treebank fan-out: %d #%d', tbfanout, n)
     mappings = [None for _ in stages]
+    autolevels = [stage.collapse[1] for stage in stages
+                  if stage.collapse and stage.collapse[0] == 'auto']
+    if autolevels:
+        tbmappings = treebanktransforms.derivemappings(
+            trees, levels=max(autolevels) + 1)
+        for level, tbmapping in sorted(tbmappings.items()):
+            logging.info('derived phrase label clusters, level %d: %s',
+                         level, '; '.join('%s: %s' % (a, ' '.join(sorted(b)))
+                                          for a, b in sorted(tbmapping.items())))
     for n, stage in enumerate(stages):
         traintrees = trees
         stage.mapping = None
@@ -348,7 +356,9 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
         if stage.collapse:
             traintrees, mappings[n] = treebanktransforms.collapselabels(
                 [tree.copy(True) for tree in traintrees],
-                tbmapping=treebanktransforms.MAPPINGS[
+                tbmapping=tbmappings[stage.collapse[1]]
+                if stage.collapse[0] == 'auto'
+                else treebanktransforms.MAPPINGS[
                     stage.collapse[0]][stage.collapse[1]])
             logging.info('collapsed phrase labels for multilevel '
                          'coarse-to-fine parsing to %s level %d',
@@ -392,7 +402,7 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
                         traintrees, sents, binarized=stage.binarized,
                         maxdepth=stage.maxdepth,
                         maxfrontier=stage.maxfrontier,
-                        extrarules=extrarules)
+                        extrarules=extrarules, numproc=numproc)
                 # dump fragments
                 with codecs.getwriter('utf8')(gzip.open('%s/%s.fragments.gz' %
                                                         (resultdir, stage.name), 'w')) as out:
@@ -434,33 +444,14 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
                     '%s/%s.backtransform.gz' % (resultdir, stage.name),
                         'wb')) as out:
                     out.writelines('%s\n' % a for a in backtransform)
-                if n and stage.prune:
-                    msg = gram.getmapping(stages[prevn].grammar,
-                                          striplabelre=None if stages[prevn].dop
-                                          else re.compile('@.+$'),
-                                          neverblockre=re.compile('.+}<'),
-                                          splitprune=stage.splitprune and stages[prevn].split,
-                                          markorigin=stages[prevn].markorigin,
-                                          mapping=stage.mapping)
-                else:
-                    # recoverfragments() relies on this mapping to identify
-                    # binarization nodes
-                    msg = gram.getmapping(None,
-                                          striplabelre=None,
-                                          neverblockre=re.compile('.+}<'),
-                                          splitprune=False, markorigin=False,
-                                          mapping=stage.mapping)
+                msg = gram.getmapping(
+                    stages[prevn].grammar if n and stage.prune else None,
+                    **parser.mappingargs(stage, stages[prevn]
+                                         if n and stage.prune else None))
                 logging.info(msg)
             elif n and stage.prune:  # dop reduction
                 msg = gram.getmapping(stages[prevn].grammar,
-                                      striplabelre=None if stages[prevn].dop
-                                      and stages[prevn].dop not in ('doubledop', 'dop1')
-                                      else re.compile('@[-0-9]+$'),
-                                      neverblockre=re.compile(stage.neverblockre)
-                                      if stage.neverblockre else None,
-                                      splitprune=stage.splitprune and stages[prevn].split,
-                                      markorigin=stages[prevn].markorigin,
-                                      mapping=stage.mapping)
+                                      **parser.mappingargs(stage, stages[prevn]))
                 if stage.mode == 'dop-rerank':
                     gram.getrulemapping(
                         stages[prevn].grammar, re.compile(r'@[-0-9]+\b'))
@@ -494,13 +485,15 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
             logging.info(gram.testgrammar()[1])
             if n and stage.prune:
                 msg = gram.getmapping(stages[prevn].grammar,
-                                      striplabelre=None,
-                                      neverblockre=re.compile(stage.neverblockre)
-                                      if stage.neverblockre else None,
-                                      splitprune=stage.splitprune and stages[prevn].split,
-                                      markorigin=stages[prevn].markorigin,
-                                      mapping=stage.mapping)
+                                      **parser.mappingargs(stage, stages[prevn]))
                 logging.info(msg)
+        if stage.mode != 'mc-rerank':
+            gram.tofile('%s/%s.grammar.bin' % (resultdir, stage.name))
+        if stage.mode != 'mc-rerank' and (
+                n and stage.prune or stage.dop in ('doubledop', 'dop1')):
+            gram.savemapping('%s/%s.mapping.npz' % (resultdir, stage.name),
+                             stages[prevn].grammar if n and stage.prune
+                             else None)
         logging.info('wrote grammar to %s/%s.{rules,lex%s}.gz',
                      resultdir, stage.name,
                      ',backtransform' if stage.dop in ('doubledop', 'dop1') else '')
@@ -516,13 +509,16 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
             if stage.estimates == 'SX':
                 outside = estimates.getpcfgestimates(gram, testmaxwords,
                                                      gram.toid[trees[0].label])
+                np.savez_compressed('%s/%s.outside.npz' % (
+                    resultdir, stage.name), outside=outside)
             elif stage.estimates == 'SXlrgaps':
-                outside = estimates.getestimates(gram, testmaxwords,
-                                                 gram.toid[trees[0].label])
+                outside = estimates.OutsideEstimates(
+                    gram, gram.toid[trees[0].label],
+                    maxbytes=stage.estimatesmem * 1024 ** 2)
+                outside.tofile('%s/%s.outside.npz' % (resultdir, stage.name),
+                               lengths=range(1, testmaxwords + 1))
             logging.info('estimates done. cpu time elapsed: %gs',
                          time.clock() - begin)
-            np.savez_compressed('%s/%s.outside.npz' % (
-                resultdir, stage.name), outside=outside)
             logging.info('saved %s estimates', stage.estimates)
         elif stage.estimates:
             raise ValueError('unrecognized value; specify SX or SXlrgaps.')
@@ -558,10 +554,13 @@ def doparsing(**kwds):
         initworker(params)
         dowork = (worker(a) for a in params.testset.items())
     else:
-        pool = multiprocessing.Pool(processes=params.numproc,
-                                    initializer=initworker, initargs=(params,))
-        dowork = pool.imap_unordered(
-            mpworker, params.testset.items())
+        pool = sharedpool(params.numproc,
+                          initializer=initworker, initargs=(params,))
+        # parse the longest sentences first; otherwise a long sentence at
+        # the end may keep a single worker busy after the rest is done.
+        dowork = pool.imap_unordered(mpworker, sorted(
+            params.testset.items(), key=lambda a: len(a[1][0]),
+            reverse=True))
     logging.info('going to parse %d sentences.', len(params.testset))
     # main parse loop over each sentence in test corpus
     for nsent, data in enumerate(dowork, 1):
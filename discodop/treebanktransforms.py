@@ -8,6 +8,7 @@ from __future__ import division, print_function, absolute_import, \
     unicode_literals
 import re
 from itertools import islice
+from collections import Counter, defaultdict
 from .tree import Tree, ParentedTree, escape, unescape, ptbescape
 from .treebank import EXPORTNONTERMINAL
 from .treetransforms import addfanoutmarkers, removefanoutmarkers
@@ -1055,6 +1056,91 @@ def collapselabels(trees, _sents=None, tbmapping=None):
     return trees, mapping
 
 
+def derivemappings(trees, levels=3):
+    """Derive a hierarchy of phrasal label clusters from a treebank.
+
+    Serves as an alternative to the presets in ``MAPPINGS`` for multilevel
+    coarse-to-fine parsing. Each phrasal label is represented by the
+    frequencies of the labels of its parents and children; starting from
+    singleton clusters, the two clusters with the most similar context
+    distributions (by Ward's criterion) are merged until a single cluster
+    remains. Level ``n`` of the result is the partition with ``2 ** n``
+    clusters (or the number of labels, if smaller), so that each level is a
+    refinement of the previous.
+
+    :param trees: a list of trees, as passed to ``collapselabels``.
+    :param levels: the number of levels to derive.
+    :returns: a dictionary of the form ``{level: tbmapping, ...}``, where
+        ``tbmapping`` can be passed to ``collapselabels``. The coarsest level
+        is ``{'P': {all phrasal labels}}``."""
+    def firsttoken(label):
+        """Return the label stripped of binarization and other annotations."""
+        match = LABELRE.search(label)
+        return match.group() if match else None
+
+    freq = Counter()
+    vectors = defaultdict(Counter)
+    tokens = set()
+    for tree in trees:
+        for node in tree.subtrees():
+            tokens.update(LABELRE.findall(node.label))
+            if not node or not isinstance(node[0], Tree):
+                continue
+            label = firsttoken(node.label)
+            for child in node:
+                childlabel = firsttoken(child.label)
+                if label is None or childlabel is None:
+                    continue
+                if node is not tree:
+                    vectors[label][childlabel] += 1
+                if child and isinstance(child[0], Tree):
+                    freq[childlabel] += 1
+                    vectors[childlabel]['^' + label] += 1
+
+    def mergecost(cluster1, cluster2):
+        """Ward's criterion for merging two clusters.
+
+        This is the increase in the weighted sum of squared distances to the
+        centroids when merging the two clusters."""
+        (_, vec1, total1), (_, vec2, total2) = cluster1, cluster2
+        return total1 * total2 / (total1 + total2) * sum(
+                (vec1[key] / total1 - vec2[key] / total2) ** 2
+                for key in set(vec1) | set(vec2))
+
+    # clusters are tuples (labels, context vector, total), in a fixed order
+    clusters = [({a}, vectors[a], sum(vectors[a].values()) or 1)
+                for a in sorted(freq, key=lambda a: (-freq[a], a))]
+    sizes = {level: min(2 ** level, len(clusters))
+             for level in range(levels)}
+    partitions = {}
+    while True:
+        if len(clusters) in sizes.values():
+            partitions[len(clusters)] = [labels for labels, _, _ in clusters]
+        if len(clusters) <= 1:
+            break
+        _, i, j = min((mergecost(clusters[i], clusters[j]), i, j)
+                      for i in range(len(clusters))
+                      for j in range(i + 1, len(clusters)))
+        (labels1, vec1, total1), (labels2, vec2, total2) = (
+                clusters[i], clusters[j])
+        clusters[i] = (labels1 | labels2, vec1 + vec2, total1 + total2)
+        del clusters[j]
+    # pick names for the clusters that do not clash with existing labels
+    prefix = 'P'
+    while any(a == prefix or a[len(prefix):].isdigit()
+              and a.startswith(prefix) for a in tokens):
+        prefix += 'P'
+    result = {}
+    for level in range(levels):
+        partition = partitions[sizes[level]]
+        if len(partition) == 1:
+            result[level] = {prefix: set(partition[0])}
+        else:
+            result[level] = {'%s%d' % (prefix, n): set(labels)
+                             for n, labels in enumerate(partition)}
+    return result
+
+
 def rrtransform(tree, morphlevels=0, percolatefeatures=None,
                 adjunctionlabel=None, ignorefunctions=None, ignorecategories=None,
                 adjleft=True, adjright=True):
@@ -1381,6 +1467,7 @@ def getmaxid(tree):
 
 
 __all__ = ['expandpresets', 'transform', 'reversetransform', 'collapselabels',
+           'derivemappings',
            'dlevel', 'rrtransform', 'rrbacktransform', 'rindex', 'labels', 'pop',
            'strip', 'ancestors', 'bracketings', 'morphfeats', 'unifymorphfeat',
            'function', 'functions', 'hassecedge']
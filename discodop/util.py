@@ -1,5 +1,6 @@
 """Misc code to avoid cyclic imports."""
 import io
+import gc
 import os
 import sys
 import gzip
@@ -42,6 +43,26 @@ def workerfunc(func):
     return wrapper
 
 
+def sharedpool(processes, initializer=None, initargs=()):
+    """Create a multiprocessing pool whose workers share memory of objects.
+
+    The objects created so far (e.g., grammars) are shared with the parent
+    process. On Python 3.7+, all objects tracked by the garbage collector are
+    moved to a permanent generation first; otherwise each garbage collection in
+    a worker touches every object, which causes copy-on-write of all pages
+    inherited from the parent process. The parent process unfreezes its objects
+    again once the workers have been started."""
+    import multiprocessing
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    try:
+        return multiprocessing.Pool(processes=processes,
+                                    initializer=initializer, initargs=initargs)
+    finally:
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+
 def openread(filename, encoding='utf8'):
     """Open stdin/text file for reading; decompress .gz files on-the-fly."""
     if filename == '-':
@@ -146,5 +167,5 @@ ANSICOLOR = {
     'white': 37,
 }
 
-__all__ = ['ishead', 'which', 'workerfunc', 'openread', 'slice_bounds',
-           'OrderedSet', 'ANSICOLOR']
+__all__ = ['ishead', 'which', 'workerfunc', 'sharedpool', 'openread',
+           'slice_bounds', 'OrderedSet', 'ANSICOLOR']
@@ -98,11 +98,14 @@ if __name__ == '__main__':
 	if sys.version_info[:2] != (2, 7) and sys.version_info[:2] < (3, 3):
 		raise RuntimeError('Python version 2.7 or >= 3.3 required.')
 	os.environ['GCC_COLORS'] = 'auto'
+	# OpenMP is used for multithreaded parsing; without it, code using
+	# prange() is executed sequentially.
+	OPENMP = ['-fopenmp'] if sys.platform.startswith('linux') else []
 	extra_compile_args = ['-O3', '-march=native', '-DNDEBUG',
 			'-Wno-strict-prototypes', '-Wno-unused-function',
 			'-Wno-unreachable-code',
-			'-DPY2=%d' % PY2]
-	extra_link_args = ['-DNDEBUG']
+			'-DPY2=%d' % PY2] + OPENMP
+	extra_link_args = ['-DNDEBUG'] + OPENMP
 	if USE_CYTHON:
 		if DEBUG:
 			directives.update(wraparound=True, boundscheck=True)
@@ -110,8 +113,8 @@ if __name__ == '__main__':
 					'-Wno-strict-prototypes', '-Wno-unused-function',
 					'-Wno-unreachable-code',
 					# '-fsanitize=address', '-fsanitize=undefined',
-					'-fno-omit-frame-pointer']
-			extra_link_args = ['-g']
+					'-fno-omit-frame-pointer'] + OPENMP
+			extra_link_args = ['-g'] + OPENMP
 		ext_modules = cythonize(
 				[Extension(
 					'*',
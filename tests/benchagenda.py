@@ -0,0 +1,67 @@
+"""Benchmark of the agenda implementations of the PLCFRS parser.
+
+Usage: python benchagenda.py [treebank] [maxlen]
+
+Induces a PLCFRS and a DOP reduction from an export-format treebank,
+parses its sentences of up to ``maxlen`` words (default: 40) exhaustively,
+and reports the parsing time of the current parser (a ``SmallLCFRSChart``
+with a ``DoubleAgenda``), and of a ``PackedLCFRSChart`` with a
+``DoubleAgenda`` and with an ``IndexedAgenda``.
+
+The default treebank, ``alpinosample.export`` in the root of the
+repository, only has 3 sentences and serves as a smoke test; for realistic
+grammars and timings, pass a larger treebank, e.g., the training section
+of Negra or Tiger in export format."""
+from __future__ import division, print_function
+import os
+import sys
+import time
+from discodop import plcfrs
+from discodop.containers import Grammar
+from discodop.grammar import treebankgrammar, dopreduction
+from discodop.treebank import NegraCorpusReader
+from discodop.treetransforms import binarize, addfanoutmarkers
+
+
+def bench(grammar, sents, repeat=3, **kwds):
+	"""Return best time of parsing sents, and the number of chart items."""
+	best, numitems = None, None
+	for _ in range(repeat):
+		begin = time.time()
+		numitems = [len(plcfrs.parse(sent, grammar, exhaustive=True,
+				**kwds)[0].getitems()) for sent in sents]
+		elapsed = time.time() - begin
+		best = elapsed if best is None else min(best, elapsed)
+	return best, numitems
+
+
+def main():
+	treebank = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+			os.path.dirname(os.path.abspath(__file__)), '..',
+			'alpinosample.export')
+	maxlen = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+	corpus = NegraCorpusReader(treebank, punct='move')
+	sents = list(corpus.sents().values())
+	trees = [addfanoutmarkers(binarize(a.copy(True), horzmarkov=1))
+			for a in corpus.trees().values()]
+	testsents = [sent for sent in sents if len(sent) <= maxlen]
+	grammars = [
+			('plcfrs', Grammar(treebankgrammar(trees, sents),
+				start=trees[0].label)),
+			('dopreduction', Grammar(dopreduction(trees, sents)[0],
+				start=trees[0].label))]
+	print('%d sentences <= %d words' % (len(testsents), maxlen))
+	print('%-12s %12s %12s %12s %8s' % ('grammar', 'current',
+			'packed+heap', 'packed+idx', 'speedup'))
+	for name, grammar in grammars:
+		time0, items0 = bench(grammar, testsents)
+		time1, items1 = bench(grammar, testsents, packedchart=True)
+		time2, items2 = bench(grammar, testsents, packedchart=True,
+				indexedagenda=True)
+		assert items0 == items1 == items2
+		print('%-12s %11.3fs %11.3fs %11.3fs %7.2fx' % (
+				name, time0, time1, time2, time0 / time2))
+
+
+if __name__ == '__main__':
+	main()
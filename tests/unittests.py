@@ -4,6 +4,7 @@ from __future__ import division, print_function, absolute_import, \
 		unicode_literals
 import os
 import re
+import tempfile
 from unittest import TestCase
 from itertools import count, islice
 from operator import itemgetter
@@ -17,6 +18,36 @@ from discodop.heads import sethead
 from discodop.grammar import flatten, UniqueIDs
 
 
+def sampletrees(split=False):
+	"""Read and binarize the trees of alpinosample.export.
+
+	:param split: if True, split discontinuous constituents for a PCFG;
+		otherwise, add fan-out markers for an LCFRS.
+	:returns: a tuple ``(trees, sents)``."""
+	from discodop.treebank import NegraCorpusReader
+	from discodop.treetransforms import addfanoutmarkers
+	corpus = NegraCorpusReader('alpinosample.export', punct='move')
+	sents = list(corpus.sents().values())
+	if split:
+		trees = [binarize(splitdiscnodes(a.copy(True)), horzmarkov=1)
+				for a in corpus.trees().values()]
+	else:
+		trees = [addfanoutmarkers(binarize(a.copy(True), horzmarkov=1))
+				for a in corpus.trees().values()]
+	return trees, sents
+
+
+def samplegrammar(split=False):
+	"""Return a treebank grammar of alpinosample.export.
+
+	:returns: a tuple ``(trees, sents, grammar)``; cf. ``sampletrees()``."""
+	from discodop.grammar import treebankgrammar
+	from discodop.containers import Grammar
+	trees, sents = sampletrees(split)
+	grammar = Grammar(treebankgrammar(trees, sents), start=trees[0].label)
+	return trees, sents, grammar
+
+
 class Test_treetransforms(object):
 	def test_binarize(self):
 		treestr = '(S (VP (PDS 0) (ADV 3) (VVINF 4)) (VMFIN 1) (PIS 2))'
@@ -212,6 +243,61 @@ class Test_grammar(object):
 				'(S|<VP>_2 (VP_3 (VP|<NP>_3 {0} (VP|<ADV>_2 {2} (VP|<VVPP> '
 				'{3})))) (S|<VAFIN> {1}))')
 
+	def test_tofile(self):
+		import pickle
+		import shutil
+		import tempfile
+		from discodop.grammar import dopreduction
+		from discodop.containers import Grammar
+		from discodop import plcfrs
+		trees, sents = sampletrees()
+		xgrammar, altweights = dopreduction(trees, sents)
+		grammar = Grammar(xgrammar, start=trees[0].label)
+		for name in altweights:
+			grammar.register(name, altweights[name])
+		tmpdir = tempfile.mkdtemp()
+		try:
+			filename = os.path.join(tmpdir, 'dop.grammar.bin')
+			grammar.tofile(filename)
+			grammar1 = Grammar.fromfile(filename)
+			assert str(grammar1) == str(grammar)
+			assert grammar1.modelnames == grammar.modelnames
+			assert grammar1.rulenos == grammar.rulenos
+			assert (grammar1.models == grammar.models).all()
+			grammar1.switch('shortest', logprob=False)
+			grammar.switch('shortest', logprob=False)
+			assert str(grammar1) == str(grammar)
+			grammar2 = pickle.loads(pickle.dumps(grammar1))
+			assert str(grammar2) == str(grammar)
+			grammar1.switch('default')
+			grammar.switch('default')
+			chart, _ = plcfrs.parse(sents[0], grammar, exhaustive=True)
+			chart1, _ = plcfrs.parse(sents[0], grammar1, exhaustive=True)
+			assert chart1 and len(chart1.getitems()) == len(chart.getitems())
+			assert str(chart1) == str(chart)
+			# words are looked up with the hash table of the lexicon
+			for word in sorted(grammar.lexicalbyword) + ['xyzzy']:
+				for gram in (grammar, grammar1):
+					_, msg = plcfrs.parse([word], gram)
+					assert ('not in lexicon' in msg) == (word == 'xyzzy'), (
+							word, msg)
+			del grammar1, grammar2, chart1
+			assert not os.path.exists(filename + '.tmp')
+			# a truncated file is rejected instead of being mapped
+			with open(filename, 'rb') as inp:
+				data = inp.read()
+			for size in (9000 * len(data) // 11700, len(data) - 1, 200):
+				with open(filename, 'wb') as out:
+					out.write(data[:size])
+				try:
+					Grammar.fromfile(filename)
+				except ValueError:
+					pass
+				else:
+					raise AssertionError('expected ValueError')
+		finally:
+			shutil.rmtree(tmpdir)
+
 
 class TestHeap(TestCase):
 	testN = 100
@@ -527,8 +613,12 @@ def test_grammar(debug=False):
 		if chart:
 			mpp, parsetrees = {}, {}
 			derivations, _ = lazykbest(chart, 1000, '}<')
+			cache = {}  # memoized expansions give the same trees
 			for d, (t, p) in zip(chart.rankededges[chart.root()], derivations):
-				r = Tree(recoverfragments(d.key, chart, backtransform))
+				r = recoverfragments(d.key, chart, backtransform)
+				assert recoverfragments(
+						d.key, chart, backtransform, cache) == r
+				r = Tree(r)
 				r = str(removefanoutmarkers(unbinarize(r)))
 				mpp[r] = mpp.get(r, 0.0) + exp(-p)
 				parsetrees.setdefault(r, []).append((t, p))
@@ -552,6 +642,229 @@ def test_grammar(debug=False):
 	Grammar(treebankgrammar([tree], [[str(a) for a in range(10)]]))
 
 
+def test_dopgrammar_numproc():
+	"""Compiling fragments with multiple processes gives the same grammar."""
+	from discodop.grammar import dopgrammar, compiletsg
+	from discodop.fragments import recurringfragments
+	trees, sents = sampletrees()
+	fragments = recurringfragments(trees, sents, numproc=1, disc=True,
+			indices=True, maxdepth=3)
+	for binarized in (True, False):
+		assert (dopgrammar(trees, fragments, binarized=binarized, numproc=1)
+				== dopgrammar(trees, fragments, binarized=binarized,
+					numproc=2))
+	weights = {frag: len(idx) for frag, idx in fragments.items()}
+	assert compiletsg(weights, numproc=1) == compiletsg(weights, numproc=2)
+
+
+def test_flattenfragments_ids():
+	"""Fragments flattened in worker processes get consistent node IDs."""
+	from discodop.grammar import flattenfragments, UniqueIDs
+	# the first and last fragment share the label for 'X@a Y@b';
+	# with two processes, they end up in different chunks.
+	fragments = ['(S (X 0=a) (Y 1=b) (Z 2=c) (W 3=d))']
+	fragments += ['(S (V 0=%s) (Y 1=b) (Z 2=c) (W 3=d))' % a
+			for a in 'efghij']
+	fragments += ['(S (X 0=a) (Y 1=b) (Z 2=c) (U 3=e))']
+	results = []
+	for numproc in (1, 2):
+		ids, backtransform, result = UniqueIDs(), {}, []
+		for prods, newfrag in flattenfragments(
+				fragments, ids, backtransform, True, numproc):
+			backtransform[prods[0]] = newfrag
+			result.append(prods)
+		results.append(result)
+	assert results[0] == results[1]
+	first, last = [[rule[0] for rule, _ in prods if rule[1:] == ('X@a', 'Y@b')]
+			for prods in (results[1][0], results[1][-1])]
+	assert len(first) == 1 and '}<' in first[0] and first == last
+
+
+def test_iterkbest():
+	"""Derivations from the generator match those of lazykbest."""
+	from discodop import plcfrs
+	from discodop.containers import Grammar
+	from discodop.grammar import dopreduction
+	from discodop.kbest import lazykbest, iterkbest
+	trees, sents = sampletrees()
+	grammar = Grammar(dopreduction(trees, sents)[0], start=trees[0].label)
+	for sent in sents:
+		chart, _ = plcfrs.parse(sent, grammar, exhaustive=True)
+		if not chart:
+			continue
+		derivations, _ = lazykbest(chart, 100)
+		assert len(derivations) == len(set(derivations)) == 100
+		probs = [p for _, p in derivations]
+		assert all(a <= b + 1e-9 for a, b in zip(probs, probs[1:]))
+		gen = iterkbest(chart, 100)
+		first = [next(gen) for _ in range(10)]
+		assert first == derivations[:10]
+		assert len(chart.rankededges[chart.root()]) == 10
+		assert first + list(gen) == derivations
+
+
+def test_maxtrees():
+	"""Marginalization with integer tree hashes gives the same best trees."""
+	from discodop.grammar import doubledop
+	from discodop import plcfrs
+	from discodop.containers import Grammar
+	from discodop.disambiguation import getderivations, marginalize, \
+			recoverfragments, treehash
+	trees, sents = sampletrees()
+	grammarx, backtransform, _, _ = doubledop(trees, sents, numproc=1)
+	grammar = Grammar(grammarx, start=trees[0].label)
+	grammar.getmapping(None, neverblockre=re.compile('.+}<'))
+	for sent in sents:
+		chart, _ = plcfrs.parse(sent, grammar, exhaustive=True)
+		derivations, entries = getderivations(chart, 1000,
+				derivstrings=False)
+		treestrs = [recoverfragments(entry.key, chart, backtransform)
+				for entry in entries]
+		hashes = [treehash(entry.key, chart, backtransform)
+				for entry in entries]
+		assert len(set(treestrs)) == len(set(hashes)) == len(
+				set(zip(treestrs, hashes)))
+		for method in ('mpp', 'mpd', 'shortest'):
+			parses, msg = marginalize(method, derivations, entries, chart,
+					backtransform=backtransform, sent=sent)
+			best, msg1 = marginalize(method, derivations, entries, chart,
+					backtransform=backtransform, sent=sent, maxtrees=1)
+			assert msg == msg1 and len(best) == 1
+			assert best[0][:2] == max(parses, key=itemgetter(1))[:2]
+
+
+def test_getsamples():
+	"""Derivations are sampled according to their probabilities."""
+	from math import exp
+	from collections import Counter
+	from discodop.grammar import doubledop
+	from discodop import plcfrs
+	from discodop.containers import Grammar
+	from discodop.coarsetofine import insideoutside
+	from discodop.disambiguation import getderivations, getsamples, \
+			marginalize
+	trees, sents = sampletrees()
+	grammarx, backtransform, _, _ = doubledop(trees, sents, numproc=1)
+	grammar = Grammar(grammarx, start=trees[0].label)
+	grammar.getmapping(None, neverblockre=re.compile('.+}<'))
+	for sent in sents:
+		chart, _ = plcfrs.parse(sent, grammar, exhaustive=True)
+		if not chart:
+			continue
+		samples = getsamples(chart, 20000)
+		assert len(samples) == len(chart.rankededges[chart.root()]) == 20000
+		sentprob = insideoutside(chart)[3]
+		counts = Counter(deriv for deriv, _ in samples)
+		for deriv, prob in set(samples):
+			assert abs(counts[deriv] / 20000 - exp(-prob - sentprob)) < 0.02
+		derivations, entries = getderivations(chart, 1000, kbest=False,
+				sample=True)
+		assert len(derivations) == len(entries) == len(set(derivations))
+		parses, _ = marginalize('mpp', derivations, entries, chart,
+				backtransform=backtransform)
+		kbestparses, _ = marginalize('mpp', *getderivations(chart, 1000),
+				chart=chart, backtransform=backtransform)
+		assert {a for a, _, _ in parses} <= {a for a, _, _ in kbestparses}
+
+
+def test_earlystop():
+	"""Stopping k-best extraction early gives the same most probable parse."""
+	from math import exp
+	from discodop.grammar import doubledop
+	from discodop import plcfrs
+	from discodop.containers import Grammar
+	from discodop.coarsetofine import insideoutside
+	from discodop.disambiguation import getderivations, marginalize
+	trees, sents = sampletrees()
+	grammarx, backtransform, _, _ = doubledop(trees, sents, numproc=1)
+	grammar = Grammar(grammarx, start=trees[0].label)
+	grammar.getmapping(None, neverblockre=re.compile('.+}<'))
+	for sent in sents:
+		chart, _ = plcfrs.parse(sent, grammar, exhaustive=True)
+		if not chart:
+			continue
+		results = []
+		for earlystop in (False, True):
+			derivations, entries = getderivations(chart, 10000,
+					derivstrings=False, earlystop=earlystop,
+					backtransform=backtransform)
+			parses, _ = marginalize('mpp', derivations, entries, chart,
+					backtransform=backtransform)
+			results.append((max(parses, key=itemgetter(1))[0], len(entries)))
+			if not earlystop:  # all derivations have been enumerated
+				sentprob = insideoutside(chart)[3]
+				assert abs(sum(exp(-entry.value) for entry in entries)
+						- exp(sentprob)) < 1e-6 * exp(sentprob)
+		assert results[0][0] == results[1][0]
+		assert results[1][1] <= results[0][1]
+
+
+def test_chartdecode():
+	"""Max-rule-product and MCC from the chart are optimal.
+
+	Posteriors are computed by enumerating all derivations."""
+	from math import exp, log
+	from collections import defaultdict
+	from discodop.grammar import dopreduction
+	from discodop import plcfrs
+	from discodop.containers import Grammar
+	from discodop.coarsetofine import insideoutside
+	from discodop.disambiguation import getderivations, marginalize, \
+			REMOVEIDS
+
+	def edges(tree):
+		return {(node.label, tuple(sorted(node.leaves())))
+				+ tuple((child.label, tuple(sorted(child.leaves())))
+					for child in node if isinstance(child, Tree))
+				for node in tree.subtrees()}
+
+	def consts(tree):
+		return {(node.label, tuple(sorted(node.leaves())))
+				for node in tree.subtrees() if '|<' not in node.label}
+
+	trees = [binarize(Tree(a)) for a in (
+			'(S (NP (PN 0)) (VP (V 1) (NP (NP (DT 2) (N 3)) '
+				'(PP (P 4) (NP (DT 5) (N 6))))))',
+			'(S (NP (PN 0)) (VP (VP (V 1) (NP (DT 2) (N 3))) '
+				'(PP (P 4) (NP (DT 5) (N 6)))))',
+			'(S (NP (DT 0) (N 1)) (VP (V 2) (NP (DT 3) (N 4) (PP (P 5) '
+				'(NP (DT 6) (N 7))))))')]
+	sents = [a.split() for a in (
+			'I saw the man with the telescope',
+			'she ate the pizza with a fork',
+			'the man ate a pizza with the fork')]
+	grammar = Grammar(dopreduction(trees, sents)[0], start=trees[0].label)
+	for sent in sents[:2] + [a.split() for a in (
+			'she saw the man with a fork', 'I ate the pizza')]:
+		chart, _ = plcfrs.parse(sent, grammar, exhaustive=True)
+		assert chart
+		sentprob = exp(insideoutside(chart)[3])
+		derivations, _ = getderivations(chart, 50000)
+		# all derivations have been enumerated
+		assert abs(sum(exp(-prob) for _, prob in derivations)
+				- sentprob) < 1e-9 * sentprob
+		parsetrees = defaultdict(float)
+		for deriv, prob in derivations:
+			parsetrees[REMOVEIDS.sub('', deriv)] += exp(-prob) / sentprob
+		edgepost, constpost = defaultdict(float), defaultdict(float)
+		candidates = [Tree(a) for a in parsetrees]
+		for tree, prob in zip(candidates, parsetrees.values()):
+			for edge in edges(tree):
+				edgepost[edge] += prob
+			for const in consts(tree):
+				constpost[const] += prob
+		(tree, score, _), = marginalize('mrp', [], [], chart)[0]
+		assert abs(log(score) - sum(log(edgepost[edge])
+				for edge in edges(Tree(tree)))) < 1e-6
+		assert all(score >= exp(sum(log(edgepost[edge])
+				for edge in edges(a))) - 1e-9 for a in candidates)
+		(tree, score, _), = marginalize('mcc-chart', [], [], chart)[0]
+		assert abs(score - sum(2 * constpost[const] - 1
+				for const in consts(Tree(tree)))) < 1e-6
+		assert all(score >= sum(2 * constpost[const] - 1
+				for const in consts(a)) - 1e-9 for a in candidates)
+
+
 def test_optimalbinarize():
 	"""Verify that all optimal parsing complexities are lower than or
 	equal to the complexities of right-to-left binarizations."""
@@ -693,6 +1006,45 @@ def test_transforms():
 	print('exact', exact)
 
 
+def test_derivemappings():
+	"""Derived label clusters form a hierarchy usable for multilevel CTF."""
+	from discodop.treebanktransforms import derivemappings, collapselabels
+	from discodop.treebank import NegraCorpusReader
+	from discodop.parser import expandctflevels
+	from discodop.treetransforms import addfanoutmarkers
+	corpus = NegraCorpusReader('alpinosample.export', punct='move')
+	trees = [addfanoutmarkers(binarize(a.copy(True), horzmarkov=1))
+			for a in corpus.trees().values()]
+	phrasal = {a.label for tree in corpus.trees().values()
+			for a in tree.subtrees(lambda n: isinstance(n[0], Tree))
+			if a is not tree}
+	tbmappings = derivemappings(trees, levels=4)
+	assert tbmappings[0] == {'P': phrasal}
+	prev = None
+	for level in range(4):
+		tbmapping = tbmappings[level]
+		assert 1 <= len(tbmapping) <= 2 ** level
+		assert set.union(*tbmapping.values()) == phrasal
+		assert sum(len(a) for a in tbmapping.values()) == len(phrasal)
+		_, mapping = collapselabels(
+				[a.copy(True) for a in trees], tbmapping=tbmapping)
+		if prev is not None:  # each level refines the previous one
+			coarse = {}
+			for label in mapping:
+				assert coarse.setdefault(mapping[label], prev[label]) == (
+						prev[label])
+		prev = mapping
+	stages = expandctflevels([dict(name='pcfg', mode='pcfg', split=True),
+			dict(name='plcfrs', prune='pcfg', splitprune=True, ctflevels=2)])
+	assert [a['name'] for a in stages] == [
+			'pcfg', 'plcfrs-level0', 'plcfrs-level1', 'plcfrs']
+	assert [a.get('collapse') for a in stages] == [
+			None, ('auto', 0), ('auto', 1), None]
+	assert [a['prune'] for a in stages[1:]] == [
+			'pcfg', 'plcfrs-level0', 'plcfrs-level1']
+	assert [a['splitprune'] for a in stages[1:]] == [True, False, True]
+
+
 def test_treedraw():
 	"""Draw some trees. Only tests whether no exception occurs."""
 	trees = '''(ROOT (S (ADV 0) (VVFIN 1) (NP (PDAT 2) (NN 3)) (PTKNEG 4) \
@@ -830,6 +1182,606 @@ def test_treedraw():
 			print(drawtree.text(unicodelines=False, ansi=False), sep='\n')
 
 
+def simpleparser(**stageopts):
+	"""Create a parser with a single PLCFRS stage read off alpinosample."""
+	from discodop.parser import Parser, DictObj, DEFAULTSTAGE
+	trees, sents, grammar = samplegrammar()
+	stage = DictObj(DEFAULTSTAGE, name='plcfrs', grammar=grammar,
+			backtransform=None, outside=None)
+	stage.update(stageopts)
+	prm = DictObj(stages=[stage], verbosity=0, transformations=None,
+			binarization=DictObj(tailmarker='', headrules=None),
+			postagging=None, relationalrealizational=None, punct=None)
+	return Parser(prm), sents
+
+
+def test_parseserver():
+	import json
+	import shutil
+	import socket
+	import tempfile
+	import threading
+	from discodop.parser import makeserver
+	parser, sents = simpleparser()
+	tmpdir = tempfile.mkdtemp()
+	address = os.path.join(tmpdir, 'parser.sock')
+	server = makeserver(parser, address, False, 1, 1, 'bracket', None)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	try:
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.connect(address)
+		conn = sock.makefile('rwb')
+		for n, sent in enumerate(sents[:2]):
+			conn.write(json.dumps(dict(id=n, sent=sent)).encode('utf8') + b'\n')
+		conn.write(b'{"id": 2, "sent": ""}\n')
+		conn.flush()
+		for n, sent in enumerate(sents[:2]):
+			result = json.loads(conn.readline().decode('utf8'))
+			assert result['id'] == n
+			assert not result['noparse']
+			assert result['output'].startswith('(')
+			assert [a['name'] for a in result['stages']] == ['plcfrs']
+			assert result['stages'][0]['numitems'] > 0
+		result = json.loads(conn.readline().decode('utf8'))
+		assert result['id'] == 2 and 'error' in result
+		conn.close()
+		sock.close()
+	finally:
+		server.shutdown()
+		server.server_close()
+		shutil.rmtree(tmpdir)
+
+
+def test_parsebatch():
+	from discodop.parser import lengthbatches, inorder
+	parser, sents = simpleparser()
+	batches = lengthbatches(sents, [len(sent) for sent in sents], 10)
+	assert sorted(n for batch in batches for n, _ in batch) == list(
+			range(len(sents)))
+	assert len(sents[batches[0][0][0]]) == max(len(sent) for sent in sents)
+	assert all(sum(len(sent) for _, sent in batch) >= 10
+			for batch in batches[:-1])
+	assert list(inorder(reversed(batches))) == sents
+	expected = [str(list(parser.parse(sent))[-1].parsetree)
+			for sent in sents]
+	for numproc in (1, 2):
+		results = list(parser.parsebatch(sents, numproc=numproc))
+		assert [str(result[-1].parsetree) for result in results] == expected
+	# stop iterating early; the pool is terminated
+	results = parser.parsebatch(sents, numproc=2)
+	assert str(next(results)[-1].parsetree) == expected[0]
+	results.close()
+
+
+def test_parselimits():
+	from discodop import plcfrs
+	parser, sents = simpleparser()
+	sent = max(sents, key=len)
+	result = list(parser.parse(sent))[-1]
+	assert not result.noparse
+	for opts, reason in (
+			(dict(maxitems=10), 'chart size'),
+			(dict(maxagenda=2), 'agenda size'),
+			(dict(maxtime=1e-9), 'time')):
+		chart, msg = plcfrs.parse(sent, parser.stages[0].grammar,
+				exhaustive=True, **opts)
+		assert not chart and not chart.getitems(), opts
+		assert '%s limit exceeded' % reason in msg, msg
+		limitedparser, _ = simpleparser(**opts)
+		result1 = list(limitedparser.parse(sent))[-1]
+		assert result1.noparse and reason in result1.msg
+		assert result1.parsetree.leaves() == result.parsetree.leaves()
+
+
+def test_parseshortest():
+	"""Shortest derivation parsing breaks ties with another model.
+
+	The grammar is not switched for each sentence."""
+	from discodop import plcfrs
+	from discodop.grammar import dopreduction
+	from discodop.containers import Grammar
+	from discodop.disambiguation import getderivations, marginalize
+	from discodop.parser import Parser, DictObj, DEFAULTSTAGE
+	trees, sents = sampletrees()
+	xgrammar, altweights = dopreduction(trees, sents)
+	grammar = Grammar(xgrammar, start=trees[0].label)
+	for name in altweights:
+		grammar.register(name, altweights[name])
+	stage = DictObj(DEFAULTSTAGE, name='dop', grammar=grammar,
+			backtransform=None, outside=None, dop='reduction',
+			objective='shortest', estimator='ewe', m=100)
+	prm = DictObj(stages=[stage], verbosity=0, transformations=None,
+			binarization=DictObj(tailmarker='', headrules=None),
+			postagging=None, relationalrealizational=None, punct=None)
+	parser = Parser(prm)
+	shortest = grammar.modelnames.index('shortest')
+	assert grammar.currentmodel == shortest
+	for sent in sents:
+		result = list(parser.parse(sent))[-1]
+		assert grammar.currentmodel == shortest
+		# the same result as when switching to the model for tie breaking
+		chart, _ = plcfrs.parse(sent, grammar, exhaustive=True)
+		derivations, entries = getderivations(chart, 100)
+		grammar.switch('ewe')
+		parses, _ = marginalize('shortest', derivations, entries, chart,
+				sent=sent)
+		grammar.switch('shortest')
+		_, (numfrags, prob), _ = max(parses, key=lambda x: x[1])
+		assert result.prob[0] == numfrags, sent
+		assert abs(result.prob[1] - prob) < 1e-9, sent
+
+
+def test_parsegoldtree():
+	"""Gold items are counted for objectives decoded from the chart."""
+	from discodop.grammar import dopreduction
+	from discodop.containers import Grammar
+	from discodop.treebank import NegraCorpusReader
+	from discodop.parser import Parser, DictObj, DEFAULTSTAGE
+	corpus = NegraCorpusReader('alpinosample.export', punct='move')
+	trees, sents = sampletrees()
+	goldtrees = [binarize(a.copy(True), horzmarkov=1)
+			for a in corpus.trees().values()]
+	grammar = Grammar(dopreduction(trees, sents)[0], start=trees[0].label)
+	for objective in ('mpp', 'mrp', 'mcc-chart'):
+		stage = DictObj(DEFAULTSTAGE, name='dop', grammar=grammar,
+				backtransform=None, outside=None, dop='reduction',
+				objective=objective, m=100)
+		prm = DictObj(stages=[stage], verbosity=0, transformations=None,
+				binarization=DictObj(method=None, tailmarker='',
+					headrules=None), postagging=None,
+				relationalrealizational=None, punct=None)
+		parser = Parser(prm)
+		for sent, goldtree in zip(sents, goldtrees):
+			result = list(parser.parse(sent, goldtree=goldtree))[-1]
+			assert not result.noparse, (objective, sent)
+			assert 'gold items in derivations' in result.msg, objective
+
+
+def test_pcfgsplitpoints():
+	"""Dense PCFG charts have the same items and edges as LCFRS charts."""
+	from discodop import pcfg, plcfrs
+	from discodop.disambiguation import getderivations
+	from discodop.coarsetofine import insideoutside
+	trees, sents, grammar = samplegrammar(split=True)
+	for sent in sents:
+		chart1, _ = pcfg.parse(sent, grammar)
+		chart2, _ = plcfrs.parse(sent, grammar, exhaustive=True)
+		assert isinstance(chart1, pcfg.DenseCFGChart)
+		items1, items2 = [{(chart.itemstr(item).split('[')[0],
+				tuple(chart.indices(item))) for item in chart.getitems()}
+				for chart in (chart1, chart2)]
+		assert items1 == items2
+		# the sum over all derivations requires all edges of each item
+		assert abs(insideoutside(chart1)[3] - insideoutside(chart2)[3]) < 1e-9
+		derivs1, _ = getderivations(chart1, 10)
+		derivs2, _ = getderivations(chart2, 10)
+		assert all(abs(a[1] - b[1]) < 1e-9 for a, b in zip(derivs1, derivs2))
+
+
+def test_pcfgparallel():
+	from discodop import pcfg
+	from discodop.disambiguation import getderivations
+	trees, sents, grammar = samplegrammar(split=True)
+	for sent in sents:
+		for beam_beta in (0.0, 5.0):
+			chart1, msg1 = pcfg.parse(sent, grammar, beam_beta=beam_beta)
+			chart2, msg2 = pcfg.parse(sent, grammar, beam_beta=beam_beta,
+					numthreads=3)
+			assert msg1 == msg2
+			assert list(chart1.getitems()) == list(chart2.getitems())
+			assert str(chart1) == str(chart2)
+			if chart1:
+				derivs1, _ = getderivations(chart1, 10)
+				derivs2, _ = getderivations(chart2, 10)
+				assert derivs1 == derivs2
+
+
+def test_pcfglongsent():
+	# sentence positions beyond 255
+	import numpy as np
+	from math import log
+	from discodop import pcfg
+	from discodop.coarsetofine import insideoutside
+	from discodop.containers import Grammar
+	from discodop.disambiguation import getderivations
+	grammar = Grammar([
+			((('ROOT', 'S'), ((0, ), )), 1),
+			((('S', 'S', 'A'), ((0, 1), )), 0.5),
+			((('S', 'A'), ((0, ), )), 0.5),
+			((('A', 'Epsilon'), ('a', )), 1)], start='ROOT')
+	chart, msg = pcfg.parse(['a'] * 300, grammar)
+	assert chart, msg
+	# NB: k-best extraction is limited to derivations of depth MAX_DEPTH
+	derivs, _ = getderivations(chart, 1, kbest=False, sample=True)
+	tree = Tree(derivs[0][0])
+	assert tree.leaves() == list(range(300))
+	assert len(list(tree.subtrees(lambda t: t.label == 'S'))) == 300
+	# chart indices beyond 2 ** 32 with many labels; a sparse chart is used.
+	grammar = Grammar([
+			((('ROOT', 'S'), ((0, ), )), 1),
+			((('S', 'S', 'A'), ((0, 1), )), 1),
+			((('S', 'B'), ((0, ), )), 1),
+			((('A', 'Epsilon'), ('a', )), 1),
+			((('B', 'Epsilon'), ('b', )), 1)]
+			+ [((('X%d' % n, 'Epsilon'), ('z', )), 1) for n in range(5000)],
+			start='ROOT')
+	chart, msg = pcfg.parse(['b'] + ['a'] * 939, grammar)
+	assert chart, msg
+	assert {chart.itemstr(item) for item in chart.getitems()} == (
+			{'B[0:1]'} | {'A[%d:%d]' % (n, n + 1) for n in range(1, 940)}
+			| {'%s[0:%d]' % (label, n) for label in ('S', 'ROOT')
+				for n in range(1, 941)})
+	assert np.isclose(insideoutside(chart)[3], 940 * log(0.5))
+
+
+def test_chartpool():
+	import pickle
+	from discodop import pcfg
+	trees, sents, grammar = samplegrammar(split=True)
+	pool = pcfg.ChartPool(1)
+	# alternate between long and short sentences to exercise reuse of
+	# larger and growing of smaller buffers
+	for sent in sorted(sents, key=len)[::-1] + sents:
+		chart1, msg1 = pcfg.parse(sent, grammar)
+		chart2, msg2 = pcfg.parse(sent, grammar, pool=pool)
+		assert msg1 == msg2
+		assert str(chart1) == str(chart2)
+		assert len(pool) == 0
+		del chart2
+		assert len(pool) == 1
+	pool.clear()
+	assert len(pool) == 0
+	# buffers larger than maxbytes are not kept
+	pool = pickle.loads(pickle.dumps(pcfg.ChartPool(1, maxbytes=0)))
+	assert pool.maxbytes == 0
+	chart2, _ = pcfg.parse(sents[0], grammar, pool=pool)
+	del chart2
+	assert len(pool) == 0
+
+
+def test_packedchart():
+	from discodop import plcfrs
+	from discodop.grammar import dopreduction
+	from discodop.containers import Grammar
+	from discodop.disambiguation import getderivations
+	from discodop.coarsetofine import prunechart
+	trees, sents, grammar = samplegrammar()
+	dopgrammar = Grammar(dopreduction(trees, sents)[0],
+			start=trees[0].label)
+	dopgrammar.getmapping(grammar, striplabelre=re.compile('@.+$'),
+			neverblockre=None, splitprune=False, markorigin=False)
+	for sent in sents:
+		chart1, msg1 = plcfrs.parse(sent, grammar, exhaustive=True)
+		chart2, msg2 = plcfrs.parse(sent, grammar, exhaustive=True,
+				packedchart=True)
+		chart3, msg3 = plcfrs.parse(sent, grammar, exhaustive=True,
+				packedchart=True, indexedagenda=True)
+		assert isinstance(chart2, plcfrs.PackedLCFRSChart)
+		assert msg1 == msg2 == msg3
+		assert str(chart2) == str(chart3)
+		assert bool(chart1) == bool(chart2)
+		if not chart1:
+			continue
+		assert chart2.root() in chart2
+		derivs1, _ = getderivations(chart1, 10)
+		derivs2, _ = getderivations(chart2, 10)
+		assert derivs1 == derivs2
+		# prune DOP stage with either chart
+		results = []
+		for chart in (chart1, chart2):
+			whitelist, items, _ = prunechart(chart, dopgrammar, 10,
+					False, False, False, False)
+			assert len(items) == len(set(items))
+			dopchart, msg = plcfrs.parse(sent, dopgrammar,
+					whitelist=whitelist, packedchart=chart is chart2)
+			results.append((msg, getderivations(dopchart, 10)[0]
+					if dopchart else None))
+		assert results[0] == results[1]
+		chart2.filter()
+		assert chart2.root() in chart2
+		assert len(chart2.getitems()) <= len(chart1.getitems())
+
+
+def test_indexedagenda():
+	from random import Random
+	from discodop.plcfrs import DoubleAgenda, IndexedAgenda
+	rnd = Random(42)
+	agenda1, agenda2 = DoubleAgenda(), IndexedAgenda()
+	for _ in range(2000):
+		if rnd.random() < 0.3 and agenda1:
+			assert agenda1.popitem() == agenda2.popitem()
+		else:
+			# few distinct values to exercise tie breaking
+			key, value = rnd.randrange(300), float(rnd.randrange(10))
+			assert (key in agenda1) == (key in agenda2)
+			agenda1[key] = agenda2[key] = value
+		assert len(agenda1) == len(agenda2)
+	while agenda1:
+		assert agenda1.popitem() == agenda2.popitem()
+	assert not agenda2
+
+
+def test_insideoutside():
+	import numpy as np
+	from discodop import pcfg, plcfrs
+	from discodop.containers import Grammar
+	from math import lgamma, log
+	from discodop.coarsetofine import insideoutside, posteriorthreshold
+	from discodop.disambiguation import getderivations
+	grammar = Grammar([
+			((('ROOT', 'S'), ((0, ), )), 1),
+			((('S', 'S', 'S'), ((0, 1), )), 0.5),
+			((('S', 'A'), ((0, ), )), 0.5),
+			((('A', 'Epsilon'), ('a', )), 1)], start='ROOT')
+	sent = ['a'] * 6
+	for chart, _ in (pcfg.parse(sent, grammar),
+			plcfrs.parse(sent, grammar, exhaustive=True),
+			plcfrs.parse(sent, grammar, exhaustive=True, packedchart=True)):
+		items, inside, outside, sentprob = insideoutside(chart)
+		# compare to the sum over all 42 derivations
+		derivs, _ = getderivations(chart, 100)
+		assert len(derivs) == 42
+		assert np.isclose(sentprob, np.logaddexp.reduce(
+				[-prob for _, prob in derivs]))
+		posterior = np.exp(inside + outside - sentprob)
+		assert np.isclose(posterior[items.index(chart.root())], 1)
+		assert (posterior <= 1 + 1e-9).all()
+		remaining, _ = posteriorthreshold(chart, 0.4)
+		assert set(remaining) == {items[n] for n, prob
+				in enumerate(posterior) if prob > 0.4}
+		assert chart.root() in remaining
+	# no underflow with long sentences: each of the Catalan(n - 1) binary
+	# trees over n words has probability 0.5 ** (2 * n - 1)
+	n = 300
+	chart, _ = pcfg.parse(['a'] * n, grammar)
+	items, inside, outside, sentprob = insideoutside(chart)
+	assert np.isclose(sentprob, lgamma(2 * n - 1) - lgamma(n + 1)
+			- lgamma(n) + (2 * n - 1) * log(0.5))
+	assert np.isclose(inside[items.index(chart.root())], sentprob)
+
+
+def test_insideoutside_order():
+	"""Inside-outside with an edge from an item added later to the chart."""
+	import numpy as np
+	from math import log
+	from discodop import plcfrs
+	from discodop.containers import Grammar
+	from discodop.coarsetofine import insideoutside
+	from discodop.disambiguation import getderivations
+	# NP is added when N is popped; V is only derived after W has been popped
+	grammar = Grammar([
+			((('ROOT', 'NP'), ((0, ), )), 1),
+			((('NP', 'DT', 'N'), ((0, 1), )), 0.5),
+			((('NP', 'V'), ((0, ), )), 0.5),
+			((('V', 'DT', 'W'), ((0, 1), )), 0.5),
+			((('V', 'N', 'DT'), ((0, 1), )), 0.5),
+			((('W', 'N'), ((0, ), )), 1),
+			((('DT', 'Epsilon'), ('a', )), 1),
+			((('N', 'Epsilon'), ('b', )), 1)], start='ROOT')
+	for packedchart in (False, True):
+		chart, _ = plcfrs.parse(['a', 'b'], grammar, exhaustive=True,
+				packedchart=packedchart)
+		items, inside, outside, sentprob = insideoutside(chart)
+		derivs, _ = getderivations(chart, 10)
+		assert len(derivs) == 2
+		assert np.isclose(sentprob, log(0.5 + 0.5 * 0.5))
+		assert np.isclose(sentprob, np.logaddexp.reduce(
+				[-prob for _, prob in derivs]))
+		assert np.isclose(inside[items.index(chart.root())], sentprob)
+		assert (np.exp(inside + outside - sentprob) <= 1 + 1e-9).all()
+
+
+def test_whitelist():
+	from random import Random
+	from discodop import pcfg, plcfrs
+	from discodop.grammar import dopreduction
+	from discodop.containers import Grammar, SpanSet, CFGWhitelist, \
+			SmallChartItem
+	from discodop.coarsetofine import prunechart
+	rnd = Random(1)
+	spans, vecs = SpanSet(), set()
+	for _ in range(1000):
+		vec = rnd.randrange(1, 1 << 20)
+		assert (SmallChartItem(0, vec) in spans) == (vec in vecs)
+		spans.add(SmallChartItem(5, vec))
+		vecs.add(vec)
+	assert len(spans) == len(vecs)
+	assert set(spans) == {SmallChartItem(0, vec) for vec in vecs}
+	cells = [{1, 3}, set(), {2, 70, 100}]
+	whitelist = CFGWhitelist.fromsets(cells, 101)
+	assert [whitelist[n] for n in range(len(whitelist))] == cells
+
+	# PCFG: prune a stage with the same grammar
+	_, sents, grammar = samplegrammar(split=True)
+	grammar.getmapping(grammar, striplabelre=None, neverblockre=None,
+			splitprune=False, markorigin=False)
+	for sent in sents:
+		chart, _ = pcfg.parse(sent, grammar)
+		whitelist, _, _ = prunechart(chart, grammar, 5,
+				False, False, True, False)
+		assert isinstance(whitelist, CFGWhitelist)
+		chart1, msg1 = pcfg.parse(sent, grammar, whitelist=whitelist)
+		chart2, msg2 = pcfg.parse(sent, grammar, whitelist=[
+				whitelist[n] for n in range(len(whitelist))])
+		assert msg1 == msg2
+		assert str(chart1) == str(chart2)
+		assert len(chart1.getitems()) < len(chart.getitems())
+	# LCFRS: prune DOP reduction with SpanSets or Python sets
+	trees, sents, grammar = samplegrammar()
+	dopgrammar = Grammar(dopreduction(trees, sents)[0],
+			start=trees[0].label)
+	dopgrammar.getmapping(grammar, striplabelre=re.compile('@.+$'),
+			neverblockre=None, splitprune=False, markorigin=False)
+	for sent in sents:
+		chart, _ = plcfrs.parse(sent, grammar, exhaustive=True)
+		whitelist, _, _ = prunechart(chart, dopgrammar, 10,
+				False, False, False, False)
+		assert all(a is None or isinstance(a, SpanSet) for a in whitelist)
+		chart1, msg1 = plcfrs.parse(sent, dopgrammar, whitelist=whitelist)
+		chart2, msg2 = plcfrs.parse(sent, dopgrammar, whitelist=[
+				a if a is None else set(a) for a in whitelist])
+		assert msg1 == msg2
+		assert str(chart1) == str(chart2)
+
+
+def test_readgrammars_stale():
+	"""A compiled grammar older than the text grammar is not used."""
+	import gzip
+	import shutil
+	from discodop.grammar import treebankgrammar, writegrammar
+	from discodop.containers import Grammar
+	from discodop.parser import readgrammars, DictObj, DEFAULTSTAGE
+	trees, sents = sampletrees()
+	rules, lex = writegrammar(treebankgrammar(trees, sents))
+	grammar = Grammar(rules, lex, start=trees[0].label)
+	old = Grammar(treebankgrammar(trees[:1], sents[:1]), start=trees[0].label)
+	tmpdir = tempfile.mkdtemp()
+	try:
+		for ext, text in (('rules', rules), ('lex', lex)):
+			with gzip.open('%s/pcfg.%s.gz' % (tmpdir, ext), 'wb') as out:
+				out.write(text.encode('utf8'))
+		binfile = '%s/pcfg.grammar.bin' % tmpdir
+		old.tofile(binfile)
+		stage = DictObj(DEFAULTSTAGE, name='pcfg', mode='pcfg')
+		os.utime(binfile, (0, 0))
+		readgrammars(tmpdir, [stage], top=trees[0].label)
+		assert str(stage.grammar) == str(grammar)
+		os.utime(binfile, None)
+		readgrammars(tmpdir, [stage], top=trees[0].label)
+		assert str(stage.grammar) == str(old)
+		with open(binfile, 'r+b') as out:  # truncated by interrupted write
+			out.truncate(os.path.getsize(binfile) // 2)
+		readgrammars(tmpdir, [stage], top=trees[0].label)
+		assert str(stage.grammar) == str(grammar)
+	finally:
+		shutil.rmtree(tmpdir)
+
+
+def test_savemapping():
+	"""A stored coarse-to-fine mapping gives the same pruning."""
+	from discodop import pcfg, plcfrs
+	from discodop.grammar import treebankgrammar
+	from discodop.containers import Grammar
+	from discodop.coarsetofine import prunechart
+	from discodop.treetransforms import splitdiscnodes
+	trees, sents = sampletrees()
+	splittrees = [binarize(splitdiscnodes(a.copy(True), True),
+			childchar=':', dot=True, ids=UniqueIDs()) for a in trees]
+	coarse = Grammar(treebankgrammar(splittrees, sents),
+			start=trees[0].label)
+	rules = treebankgrammar(trees, sents)
+	fine = Grammar(rules, start=trees[0].label)
+	fine.getmapping(coarse, striplabelre=None, neverblockre=None,
+			splitprune=True, markorigin=True)
+	fd, filename = tempfile.mkstemp(suffix='.npz')
+	os.close(fd)
+	try:
+		fine.savemapping(filename, coarse)
+		fine1 = Grammar(rules, start=trees[0].label)
+		fine1.loadmapping(filename, coarse, splitprune=True,
+				markorigin=True)
+		for sent in sents:
+			chart, _ = pcfg.parse(sent, coarse)
+			results = []
+			for grammar in (fine, fine1):
+				whitelist, _, _ = prunechart(chart, grammar, 10,
+						True, True, False, False)
+				results.append(str(plcfrs.parse(
+						sent, grammar, whitelist=whitelist,
+						splitprune=True, markorigin=True)[0]))
+			assert results[0] == results[1]
+		try:  # labels of coarse grammar do not match
+			fine1.loadmapping(filename, fine, splitprune=True,
+					markorigin=True)
+		except ValueError:
+			pass
+		else:
+			raise AssertionError('expected ValueError')
+		try:  # options passed to getmapping() do not match
+			fine1.loadmapping(filename, coarse,
+					neverblockre=re.compile('.+}<'), splitprune=True,
+					markorigin=True)
+		except ValueError:
+			pass
+		else:
+			raise AssertionError('expected ValueError')
+	finally:
+		if os.path.exists(filename):
+			os.remove(filename)
+
+
+ESTIMATES = {}  # for estimatesworker()
+
+
+def estimatesworker(n):
+	"""Load a table of estimates in a worker process."""
+	return ESTIMATES['loaded'].table(n)
+
+
+def test_estimates():
+	import numpy as np
+	from discodop import plcfrs
+	from discodop.disambiguation import getderivations
+	from discodop.estimates import getestimates, OutsideEstimates
+	from discodop.util import sharedpool
+	trees, sents, grammar = samplegrammar()
+	goal = grammar.toid[trees[0].label]
+	maxlen = max(len(sent) for sent in sents)
+	lengths = sorted({1, 2, 5} | {len(sent) for sent in sents})
+	dense = getestimates(grammar, maxlen, goal)
+	outside = OutsideEstimates(grammar, goal)
+	for n in lengths:
+		table = outside.forlength(n)
+		for length in range(n + 1):
+			for lr in range(n + 1 - length):
+				gaps = n - length - lr
+				assert np.array_equal(table[:, length, lr, gaps],
+						dense[:, length, lr, gaps])
+	for sent in sents:
+		chart1, msg1 = plcfrs.parse(sent, grammar, exhaustive=False)
+		chart2, msg2 = plcfrs.parse(sent, grammar, exhaustive=False,
+				estimates=('SXlrgaps', outside))
+		chart3, msg3 = plcfrs.parse(sent, grammar, exhaustive=False,
+				estimates=('SXlrgaps', outside), packedchart=True)
+		assert chart1 and chart2 and chart3
+		# the estimates are admissible, so A* finds the best derivation
+		derivs1, _ = getderivations(chart1, 1)
+		assert getderivations(chart2, 1)[0] == derivs1
+		assert getderivations(chart3, 1)[0] == derivs1
+		assert len(chart2.getitems()) < len(chart1.getitems())
+		assert len(chart3.getitems()) == len(chart2.getitems())
+	fd, filename = tempfile.mkstemp(suffix='.npz')
+	os.close(fd)
+	try:
+		outside.tofile(filename)
+		loaded = ESTIMATES['loaded'] = OutsideEstimates.fromfile(
+				filename, grammar)
+		assert not loaded.tables and loaded.lengths() == lengths
+		# forked worker processes read tables from the file concurrently
+		pool = sharedpool(4)
+		try:
+			tables = pool.map(estimatesworker, lengths * 4, chunksize=1)
+		finally:
+			pool.close()
+			pool.join()
+		for n, table in zip(lengths * 4, tables):
+			assert np.array_equal(table, outside.table(n))
+		for n in lengths:
+			assert np.array_equal(loaded.table(n), outside.table(n))
+	finally:
+		ESTIMATES.clear()
+		os.remove(filename)
+	# keep at most two tables of the longest sentences in memory
+	maxbytes = 2 * outside.table(maxlen).nbytes
+	bounded = OutsideEstimates(grammar, goal, maxbytes=maxbytes)
+	for n in lengths + lengths[::-1]:
+		assert np.array_equal(bounded.table(n), outside.table(n))
+		assert sum(a.nbytes for a in bounded.tables.values()) <= maxbytes
+	assert list(bounded.tables)[-1] == lengths[0]
+
+
 def test_runexp():
 	"""Run ``sample.prm``."""
 	from discodop import cli